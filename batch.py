@@ -0,0 +1,193 @@
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field, asdict
+from lexer import lex
+from parsing import parse_expr, macro_env
+from typechecker import macro_effects
+from optimizer import add_arguments as add_optimizer_arguments
+from buildcache import BuildCache, DEFAULT_DIR
+import argparse
+import compiler
+import contextlib
+import io
+import json
+import modules
+import os
+import subprocess
+import sys
+import time
+
+stages = ["lex", "parse", "typecheck", "generate", "build", "run"]
+
+@dataclass
+class Options:
+  target: str = "go"
+  typed: bool = False
+  level: int = 1
+  build: bool = False
+  run: bool = False
+  timeout: float = None
+  cache_dir: str = DEFAULT_DIR
+  cache: bool = True
+
+@dataclass
+class Result:
+  source: str
+  output: str
+  ok: bool = True
+  diagnostics: str = ""
+  timings: dict = field(default_factory=dict)
+  exit_code: int = None
+  hits: dict = field(default_factory=dict)
+  misses: dict = field(default_factory=dict)
+
+# Workers are reused across files, so everything the front end accumulates at
+# module level is cleared before each one.
+def reset():
+  macro_env.clear()
+  macro_effects.clear()
+  modules.modules.clear()
+  modules.initialized.clear()
+  compiler.var_counter = 0
+
+class Stopwatch:
+  def __init__(self, timings):
+    self.timings = timings
+  @contextlib.contextmanager
+  def __call__(self, stage):
+    start = time.perf_counter()
+    try:
+      yield
+    finally:
+      self.timings[stage] = time.perf_counter() - start
+
+def build(cache, code, binary, options):
+  compiler.build_cached(cache, code, f"main.{options.target}", binary, options.target)
+
+def execute(binary, output, options):
+  try:
+    result = subprocess.run([binary], capture_output=True, timeout=options.timeout)
+  except subprocess.TimeoutExpired:
+    print(f"{binary} RUN ERROR: timed out after {options.timeout}s")
+    exit(1)
+  with open(output, "wb") as f:
+    f.write(result.stdout)
+  if result.returncode != 0:
+    print(result.stderr.decode().rstrip())
+    print(f"{binary} RUN ERROR: exited with {result.returncode}")
+    exit(1)
+  return result.returncode
+
+def process(source, output, options):
+  reset()
+  result = Result(source, output)
+  cache = BuildCache(options.cache_dir, enabled=options.cache)
+  clock = Stopwatch(result.timings)
+  diagnostics = io.StringIO()
+  try:
+    with contextlib.redirect_stdout(diagnostics):
+      with open(source) as f:
+        text = f.read()
+      with clock("lex"):
+        tokens = lex(source, text)
+      with clock("parse"):
+        tree, _ = parse_expr(tokens)
+      with clock("typecheck"):
+        compiler.check(tree)
+      with clock("generate"):
+        code = compiler.generate(source, tree, options.typed, options.target, options.level)
+      compiler.write_if_changed(output, code)
+      binary = os.path.abspath(os.path.splitext(output)[0])
+      if options.build or options.run:
+        with clock("build"):
+          build(cache, code, binary, options)
+      if options.run:
+        with clock("run"):
+          result.exit_code = execute(binary, binary + ".out", options)
+  except SystemExit as e:
+    result.ok = e.code in [0, None]
+  except Exception as e:
+    print(f"{source} INTERNAL ERROR: {type(e).__name__}: {e}", file=diagnostics)
+    result.ok = False
+  result.diagnostics = diagnostics.getvalue()
+  result.hits, result.misses = cache.hits, cache.misses
+  return result
+
+def collect(paths):
+  sources = []
+  for path in paths:
+    if os.path.isdir(path):
+      for root, _, files in os.walk(path):
+        for name in sorted(files):
+          if name.endswith(".stk"):
+            full = os.path.join(root, name)
+            sources.append((full, os.path.relpath(full, path)))
+    else:
+      sources.append((path, os.path.basename(path)))
+  return sources
+
+def output_path(source, relative, out_dir, target):
+  stem = os.path.splitext(os.path.join(out_dir, relative) if out_dir else source)[0]
+  return f"{stem}.{target}"
+
+def summary(result):
+  timings = " ".join(f"{stage} {result.timings[stage] * 1000:.1f}ms" for stage in stages if stage in result.timings)
+  return f"{'ok' if result.ok else 'FAIL':>4} {result.source}  {timings}"
+
+def run_batch(paths, options, out_dir=None, jobs=None):
+  sources = collect(paths)
+  outputs = [output_path(source, relative, out_dir, options.target) for source, relative in sources]
+  for output in outputs:
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+  files = [source for source, _ in sources]
+  chunksize = max(1, len(files) // ((jobs or os.cpu_count() or 1) * 8))
+  with ProcessPoolExecutor(max_workers=jobs) as pool:
+    for result in pool.map(process, files, outputs, [options] * len(files), chunksize=chunksize):
+      print(summary(result), file=sys.stderr)
+      if not result.ok:
+        print(result.diagnostics.rstrip(), file=sys.stderr)
+      yield result
+
+def main():
+  parser = argparse.ArgumentParser(description="Compile many Stackly programs in parallel")
+  parser.add_argument("paths", nargs="+", help=".stk files or directories to search for them")
+  parser.add_argument("-d", "--out-dir", help="write outputs here, mirroring each directory argument; defaults to next to each source")
+  parser.add_argument("-j", "--jobs", type=int, help="worker processes (default: one per CPU)")
+  parser.add_argument("--target", choices=["go", "c"], default="go")
+  parser.add_argument("--typed", action="store_true", help="emit unboxed Go code from the inferred stack types")
+  parser.add_argument("--build", action="store_true", help="also build each output into a binary next to it")
+  parser.add_argument("--run", action="store_true", help="build and run each binary, saving its stdout to BINARY.out")
+  parser.add_argument("--timeout", type=float, help="seconds each program may run")
+  parser.add_argument("--json", metavar="FILE", help="write per-file diagnostics and timings here")
+  parser.add_argument("--no-cache", action="store_true", help="build without the build cache")
+  parser.add_argument("--cache-dir", default=DEFAULT_DIR, help=f"defaults to $STACKLY_CACHE or {DEFAULT_DIR}")
+  add_optimizer_arguments(parser)
+  args = parser.parse_args()
+
+  options = Options(
+    args.target, args.typed, args.level, args.build, args.run,
+    args.timeout, os.path.abspath(args.cache_dir), not args.no_cache,
+  )
+  cache = BuildCache(options.cache_dir, enabled=options.cache)
+  start = time.perf_counter()
+  results = []
+  for result in run_batch(args.paths, options, args.out_dir, args.jobs):
+    results.append(result)
+    for stage, count in result.hits.items():
+      cache.hits[stage] = cache.hits.get(stage, 0) + count
+    for stage, count in result.misses.items():
+      cache.misses[stage] = cache.misses.get(stage, 0) + count
+  cache.close()
+  elapsed = time.perf_counter() - start
+
+  failed = [result for result in results if not result.ok]
+  totals = {stage: sum(result.timings.get(stage, 0) for result in results) for stage in stages}
+  print(f"{len(results)} files, {len(failed)} failed, {elapsed:.2f}s wall", file=sys.stderr)
+  print("  ".join(f"{stage} {seconds:.2f}s" for stage, seconds in totals.items() if seconds), file=sys.stderr)
+  if args.json:
+    with open(args.json, "w") as f:
+      json.dump({"elapsed": elapsed, "totals": totals, "files": [asdict(result) for result in results]}, f, indent=2)
+  if failed:
+    exit(1)
+
+if __name__ == "__main__":
+  main()
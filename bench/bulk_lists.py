@@ -0,0 +1,35 @@
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from lexer import lex
+from parsing import parse_expr, macro_env
+from vm import VM, lower
+
+SIZE = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+
+# Each pair does the same work once through the bulk word and once through a
+# quote the VM has to call per element ({{...} ~} is not inlined).
+cases = [
+  ("sum", f"{SIZE} range sum"),
+  ("0 {+} fold", f"{SIZE} range 0 {{+}} fold"),
+  ("{2 *} map", f"{SIZE} range {{2 *}} map len"),
+  ("{{2 *} ~} map", f"{SIZE} range {{{{2 *}} ~}} map len"),
+  ("{3 <} filter", f"{SIZE} range {{3 <}} filter len"),
+  ("{{3 <} ~} filter", f"{SIZE} range {{{{3 <}} ~}} filter len"),
+]
+
+def main():
+  print(f"{'words':>20} {'steps':>10} {'vm (s)':>10}")
+  for name, source in cases:
+    macro_env.clear()
+    tree, _ = parse_expr(lex("<bench>", source + " print"))
+    vm = VM(lower(tree), [], lambda value: None)
+    start = time.perf_counter()
+    vm.run()
+    print(f"{name:>20} {vm.steps:>10} {time.perf_counter() - start:>10.4f}")
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,40 @@
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from lexer import lex
+from parsing import parse_expr, macro_env
+from vm import VM, lower
+
+DIGITS = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+NAMES = "abcdefghij"
+
+# Macro names cannot contain digits, so ones-c pushes 10^2 ones and cons-c
+# conses 10^2 values onto a list. Each list is built and printed in turn.
+def program(digits):
+  lines = ["define ones-a 1 end", "define cons-a <: end"]
+  for i in range(1, digits + 1):
+    lines.append(f"define ones-{NAMES[i]} " + f"ones-{NAMES[i - 1]} " * 10 + "end")
+    lines.append(f"define cons-{NAMES[i]} " + f"cons-{NAMES[i - 1]} " * 10 + "end")
+  lines.append(" ".join(f"ones-{NAMES[i]} [] cons-{NAMES[i]} print" for i in range(1, digits + 1)))
+  return "\n".join(lines) + "\n"
+
+def main():
+  macro_env.clear()
+  tree, _ = parse_expr(lex("<bench>", program(DIGITS)))
+  print(f"{'length':>8} {'vm (s)':>10}")
+  lengths = []
+  def emit(value):
+    lengths.append((len(value), time.perf_counter()))
+  vm = VM(lower(tree), [], emit)
+  start = time.perf_counter()
+  vm.run()
+  previous = start
+  for length, at in lengths:
+    print(f"{length:>8} {at - previous:>10.4f}")
+    previous = at
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,47 @@
+import gc
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from lexer import lex
+from parsing import parse_expr, flatten
+
+MEGABYTES = float(sys.argv[1]) if len(sys.argv) > 1 else 1.0
+
+BLOCK = """\
+define inc 1 + end
+define square . * end
+1 {. 100 <} {. square print inc} while print
+[1 2 3 4] 5 <: print
+'a' True {'b'} {'c'} if print print
+10 {. 0 >} {1 -} while 3 square 4 / = not print
+"""
+
+def program(megabytes):
+  return BLOCK * int(megabytes * 1024 * 1024 / len(BLOCK))
+
+def measure(label, build):
+  gc.collect()
+  tracemalloc.start()
+  start = time.perf_counter()
+  value = build()
+  elapsed = time.perf_counter() - start
+  current, peak = tracemalloc.get_traced_memory()
+  tracemalloc.stop()
+  print(f"{label:>8} {current / 2**20:>10.1f} {peak / 2**20:>10.1f} {elapsed:>8.2f}")
+  return value
+
+def main():
+  source = program(MEGABYTES)
+  print(f"{len(source) / 2**20:.1f} MB of source")
+  print(f"{'stage':>8} {'kept (MB)':>10} {'peak (MB)':>10} {'time (s)':>8}")
+  tokens = measure("tokens", lambda: lex("<bench>", source))
+  tree = measure("tree", lambda: parse_expr(tokens)[0])
+  del tokens
+  measure("flat", lambda: flatten([tree]))
+
+if __name__ == "__main__":
+  main()
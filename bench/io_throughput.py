@@ -0,0 +1,41 @@
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from suite import backends
+
+LINES = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+
+# Copies stdin to stdout line by line on every backend, next to cat itself.
+PROGRAM = "{eof? not} {read-line write-line} while\n"
+
+def main():
+  with tempfile.TemporaryDirectory() as directory:
+    source = os.path.join(directory, "cat.stk")
+    with open(source, "w") as f:
+      f.write(PROGRAM)
+    data = os.path.join(directory, "input.txt")
+    with open(data, "w") as f:
+      for i in range(LINES):
+        f.write(f"{i:>8} GET /index.html 200 {i * 7919 % 65536}\n")
+    size = os.path.getsize(data)
+    commands = [("cat", ["cat"])]
+    for name, prepare in backends.items():
+      try:
+        commands.append((name, prepare(source, directory)))
+      except RuntimeError as e:
+        print(f"{name:>9}  {e}", file=sys.stderr)
+    print(f"{'backend':>9} {'wall (s)':>9} {'MB/s':>8}")
+    for name, command in commands:
+      with open(data, "rb") as f:
+        start = time.perf_counter()
+        subprocess.run(command, stdin=f, stdout=subprocess.DEVNULL, check=True)
+        elapsed = time.perf_counter() - start
+      print(f"{name:>9} {elapsed:>9.3f} {size / elapsed / 1e6:>8.1f}")
+
+if __name__ == "__main__":
+  main()
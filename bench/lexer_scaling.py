@@ -0,0 +1,43 @@
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from lexer import lex_iter, lex_file
+
+SNIPPET = """define inc 1 + end ; bump the counter
+1 {. 1000000 <} {. print inc} while print
+[1 2 3] 'c' True not print print print
+"""
+
+SIZES = [1 << 10, 10 << 10, 100 << 10, 1 << 20, 10 << 20]
+
+def make_source(size):
+  reps = size // len(SNIPPET) + 1
+  return (SNIPPET * reps)[:size].rsplit("\n", 1)[0] + "\n"
+
+def measure(tokens):
+  start = time.perf_counter()
+  count = 0
+  for _ in tokens:
+    count += 1
+  return time.perf_counter() - start, count
+
+def main():
+  print(f"{'size':>10} {'tokens':>10} {'str (s)':>10} {'mmap (s)':>10} {'us/KB':>8}")
+  for size in SIZES:
+    source = make_source(size)
+    elapsed, count = measure(lex_iter("<bench>", source))
+    with tempfile.NamedTemporaryFile("w", suffix=".stk", delete=False) as f:
+      f.write(source)
+    try:
+      mapped, _ = measure(lex_file(f.name))
+    finally:
+      os.unlink(f.name)
+    per_kb = elapsed / (len(source) / 1024) * 1e6
+    print(f"{len(source):>10} {count:>10} {elapsed:>10.4f} {mapped:>10.4f} {per_kb:>8.2f}")
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,59 @@
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from lexer import lex
+from parsing import parse_expr, macro_env
+from typechecker import macro_effects
+import modules
+
+MACROS = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+
+def name(i):
+  return "m" + "".join("abcdefghij"[int(d)] for d in str(i))
+
+def library(count):
+  lines = ["define step 1 + end"]
+  for i in range(count):
+    body = "step" if i == 0 else f"{name(i // 2)} . +"
+    lines.append(f"define {name(i)} {body} end")
+  return "\n".join(lines) + "\n"
+
+def reset():
+  macro_env.clear()
+  macro_effects.clear()
+  modules.modules.clear()
+  modules.initialized.clear()
+
+def measure(run):
+  reset()
+  start = time.perf_counter()
+  run()
+  return time.perf_counter() - start
+
+def main():
+  with tempfile.TemporaryDirectory() as directory:
+    path = os.path.join(directory, "std.stk")
+    with open(path, "w") as f:
+      f.write(library(MACROS))
+    program = os.path.join(directory, "main.stk")
+    source = f'import "std.stk"\n1 {name(MACROS - 1)} print\n'
+    with open(program, "w") as f:
+      f.write(source)
+    with open(path) as f:
+      pasted = f.read() + source.split("\n", 1)[1]
+    parse = lambda text, file: parse_expr(lex(file, text))
+    results = [
+      ("pasted", measure(lambda: parse(pasted, program))),
+      ("import (build)", measure(lambda: parse(source, program))),
+      ("import (artifact)", measure(lambda: parse(source, program))),
+    ]
+  print(f"{MACROS} macros")
+  for label, seconds in results:
+    print(f"{label:>18} {seconds * 1000:>10.2f} ms")
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,41 @@
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from suite import backends
+
+SIZE = int(sys.argv[1]) if len(sys.argv) > 1 else 400
+WORK = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+
+# The same CPU-bound quote run through map and through pmap with 1, 2, 4 and
+# one worker per CPU, on every backend that has pmap.
+PROGRAM = f"{SIZE} range {{{WORK} + range 0 {{+}} fold}} WORD sum print\n"
+
+def main():
+  counts = sorted({1, 2, 4, os.cpu_count() or 1})
+  with tempfile.TemporaryDirectory() as directory:
+    print(f"{'backend':>9} {'map (s)':>9}" + "".join(f" {f'pmap/{n} (s)':>12}" for n in counts))
+    for name in ["vm", "python", "go", "go-typed"]:
+      commands = []
+      for word in ["map", "pmap"]:
+        source = os.path.join(directory, f"{word}.stk")
+        with open(source, "w") as f:
+          f.write(PROGRAM.replace("WORD", word))
+        build = os.path.join(directory, f"{name}-{word}")
+        os.makedirs(build, exist_ok=True)
+        commands.append(backends[name](source, build))
+      times = [run(commands[0], 1)] + [run(commands[1], n) for n in counts]
+      print(f"{name:>9}" + "".join(f" {t:>{9 if i == 0 else 12}.3f}" for i, t in enumerate(times)))
+
+def run(command, workers):
+  env = {**os.environ, "STACKLY_WORKERS": str(workers)}
+  start = time.perf_counter()
+  subprocess.run(command, env=env, stdout=subprocess.DEVNULL, check=True)
+  return time.perf_counter() - start
+
+if __name__ == "__main__":
+  main()
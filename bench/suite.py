@@ -0,0 +1,180 @@
+import argparse
+import glob
+import json
+import os
+import platform
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+WORKLOADS = os.path.join(ROOT, "bench", "workloads")
+
+sys.path.insert(0, ROOT)
+
+from lexer import lex
+from parsing import parse_expr, macro_env
+from vm import execute
+
+# Each backend turns a workload into a command line, building it first if
+# needed. Python backends run in a child process so peak RSS is per backend.
+def python_backend(name):
+  def prepare(source, directory):
+    return [sys.executable, os.path.abspath(__file__), "--child", name, source]
+  return prepare
+
+def native_backend(target, *flags):
+  runtime = {"go": ["lib.go", "go.mod"], "c": ["lib.c", "lib.h"]}[target]
+  def prepare(source, directory):
+    for name in runtime:
+      shutil.copy(os.path.join(ROOT, name), directory)
+    command = [
+      sys.executable, os.path.join(ROOT, "compiler.py"), source,
+      "--target", target, "-o", f"main.{target}", "--build", "main", "--no-cache", *flags,
+    ]
+    result = subprocess.run(command, cwd=directory, capture_output=True, text=True)
+    if result.returncode != 0:
+      raise RuntimeError((result.stdout + result.stderr).strip().splitlines()[-1])
+    return [os.path.join(directory, "main")]
+  return prepare
+
+backends = {
+  "tree": python_backend("tree"),
+  "vm": python_backend("vm"),
+  "python": python_backend("python"),
+  "go": native_backend("go"),
+  "go-typed": native_backend("go", "--typed"),
+  "c": native_backend("c"),
+}
+
+def parse(path):
+  macro_env.clear()
+  with open(path) as f:
+    tree, _ = parse_expr(lex(path, f.read()))
+  return tree
+
+def child(backend, path):
+  if backend == "tree":
+    from shell import shell
+    from streams import standard
+    shell(parse(path), [], [0, 0])
+    standard.output.flush()
+  elif backend == "vm":
+    from run import run_file
+    run_file(path)
+  elif backend == "python":
+    from pycompiler import run
+    run(path)
+
+def count_ops(path):
+  return execute(parse(path), [], emit=lambda value: None).steps
+
+def run_once(command):
+  start = time.perf_counter()
+  process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+  _, status, usage = os.wait4(process.pid, 0)
+  elapsed = time.perf_counter() - start
+  if os.waitstatus_to_exitcode(status) != 0:
+    raise RuntimeError(process.stderr.read().decode().strip() or f"exit status {status}")
+  return elapsed, usage.ru_maxrss
+
+def measure(command, ops, warmup, repeat):
+  for _ in range(warmup):
+    run_once(command)
+  runs = [run_once(command) for _ in range(repeat)]
+  walls = [wall for wall, _ in runs]
+  median = statistics.median(walls)
+  return {
+    "wall": walls,
+    "median": median,
+    "min": min(walls),
+    "ops": ops,
+    "ops_per_sec": ops / median,
+    "peak_rss_kb": max(rss for _, rss in runs),
+  }
+
+def run_suite(workloads, names, warmup, repeat):
+  results = {}
+  for path in workloads:
+    workload = os.path.splitext(os.path.basename(path))[0]
+    ops = count_ops(path)
+    results[workload] = {}
+    for name in names:
+      with tempfile.TemporaryDirectory() as directory:
+        try:
+          command = backends[name](path, directory)
+          result = measure(command, ops, warmup, repeat)
+        except RuntimeError as e:
+          result = {"error": str(e)}
+      results[workload][name] = result
+      summary = result.get("error") or f"{result['median']:.3f}s {result['ops_per_sec']:,.0f} ops/s {result['peak_rss_kb']} KB"
+      print(f"{workload:>10} {name:>9}  {summary}", file=sys.stderr)
+  return results
+
+def compare(results, baseline, threshold):
+  regressions = []
+  for workload, runs in results.items():
+    for name, result in runs.items():
+      base = baseline.get(workload, {}).get(name)
+      if not base or "median" not in base or "median" not in result:
+        continue
+      ratio = result["median"] / base["median"]
+      status = "REGRESSION" if ratio > 1 + threshold else "ok"
+      print(f"{workload:>10} {name:>9} {base['median']:>8.3f}s -> {result['median']:>8.3f}s {ratio:>6.2f}x {status}", file=sys.stderr)
+      if ratio > 1 + threshold:
+        regressions.append((workload, name, ratio))
+  return regressions
+
+def main():
+  parser = argparse.ArgumentParser(description="Run the Stackly workloads on every backend")
+  parser.add_argument("workloads", nargs="*", help=f"defaults to {os.path.relpath(WORKLOADS)}/*.stk")
+  parser.add_argument("--backends", default=",".join(backends), help="comma separated subset of: " + ", ".join(backends))
+  parser.add_argument("--warmup", type=int, default=1)
+  parser.add_argument("--repeat", type=int, default=5)
+  parser.add_argument("-o", "--output", help="write the JSON report here instead of stdout")
+  parser.add_argument("--baseline", help="JSON report to compare against")
+  parser.add_argument("--threshold", type=float, default=0.10, help="allowed slowdown of the median wall time (default 0.10)")
+  parser.add_argument("--child", nargs=2, metavar=("BACKEND", "SOURCE"), help=argparse.SUPPRESS)
+  args = parser.parse_args()
+
+  if args.child:
+    child(*args.child)
+    return
+
+  names = args.backends.split(",")
+  for name in names:
+    if name not in backends:
+      parser.error(f"unknown backend '{name}'")
+  workloads = [os.path.abspath(path) for path in args.workloads] or sorted(glob.glob(os.path.join(WORKLOADS, "*.stk")))
+  report = {
+    "meta": {
+      "python": platform.python_version(),
+      "platform": platform.platform(),
+      "warmup": args.warmup,
+      "repeat": args.repeat,
+      # Children inherit the runner's high-water RSS at exec, so peak_rss_kb
+      # never drops below this.
+      "rss_floor_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    },
+    "results": run_suite(workloads, names, args.warmup, args.repeat),
+  }
+  text = json.dumps(report, indent=2)
+  if args.output:
+    with open(args.output, "w") as f:
+      f.write(text + "\n")
+  else:
+    print(text)
+  if args.baseline:
+    with open(args.baseline) as f:
+      baseline = json.load(f)["results"]
+    regressions = compare(report["results"], baseline, args.threshold)
+    if regressions:
+      print(f"{len(regressions)} regression(s) over {args.threshold:.0%}", file=sys.stderr)
+      exit(1)
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,71 @@
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from lexer import lex
+from parsing import parse_expr
+import typechecker
+
+MAX_DEPTH = int(sys.argv[1]) if len(sys.argv) > 1 else 15
+# Stop measuring the unmemoized checker once a single run exceeds this.
+BUDGET = float(sys.argv[2]) if len(sys.argv) > 2 else 5.0
+
+def nested_if(depth):
+  body = "1 +"
+  for _ in range(depth):
+    body = f". 0 > {{ {body} }} {{ 2 * }} if"
+  return f"1 {body} print"
+
+def nested_while(depth):
+  body = "1 +"
+  for _ in range(depth):
+    body = f"{{ . 10 < }} {{ {body} }} while 1 +"
+  return f"1 {body} print"
+
+def nested_mixed(depth):
+  body = "1 +"
+  for level in range(depth):
+    if level % 2:
+      body = f"{{ . 10 < }} {{ {body} }} while"
+    else:
+      body = f". 0 > {{ {body} }} {{ 1 - }} if"
+  return f"1 {body} print"
+
+SHAPES = {
+  "if": nested_if,
+  "while": nested_while,
+  "mixed": nested_mixed,
+}
+
+memoized = typechecker.check_quote
+
+def unmemoized(tree, stack):
+  return typechecker.check(tree, stack)
+
+def measure(check, tree):
+  typechecker.check_quote = check
+  try:
+    start = time.perf_counter()
+    typechecker.typecheck(tree, [])
+    return time.perf_counter() - start
+  finally:
+    typechecker.check_quote = memoized
+
+def main():
+  print(f"{'shape':>6} {'depth':>5} {'memo (ms)':>10} {'plain (ms)':>11} {'speedup':>8}")
+  for name, shape in SHAPES.items():
+    slow = False
+    for depth in range(1, MAX_DEPTH + 1):
+      tree, _ = parse_expr(lex("<bench>", shape(depth)))
+      fast = measure(memoized, tree)
+      if slow:
+        print(f"{name:>6} {depth:>5} {fast * 1000:>10.2f} {'-':>11} {'-':>8}")
+        continue
+      plain = measure(unmemoized, tree)
+      slow = plain > BUDGET
+      print(f"{name:>6} {depth:>5} {fast * 1000:>10.2f} {plain * 1000:>11.2f} {plain / fast:>7.1f}x")
+
+if __name__ == "__main__":
+  main()
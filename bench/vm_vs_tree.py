@@ -0,0 +1,42 @@
+import contextlib
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from lexer import lex
+from parsing import parse_expr
+from shell import shell, value_repr
+from vm import execute
+
+ITERATIONS = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+
+PROGRAMS = {
+  "count": f"define inc 1 + end 1 {{. {ITERATIONS} <}} {{inc}} while print",
+  "count+print": f"define inc 1 + end 1 {{. {ITERATIONS} <}} {{. print inc}} while print",
+  "generic while": f"1 {{. {ITERATIONS} <}} {{1 +}} {{}} ~ while print",
+}
+
+def tree_walker(tree):
+  shell(tree, [], [0, 0])
+
+def bytecode_vm(tree):
+  execute(tree, [], emit=lambda v: print(value_repr(v)))
+
+def measure(run, tree):
+  with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+    start = time.perf_counter()
+    run(tree)
+    return time.perf_counter() - start
+
+def main():
+  print(f"{'program':>14} {'tree (s)':>10} {'vm (s)':>10} {'speedup':>8}")
+  for name, source in PROGRAMS.items():
+    tree, _ = parse_expr(lex("<bench>", source))
+    walked = measure(tree_walker, tree)
+    vm = measure(bytecode_vm, tree)
+    print(f"{name:>14} {walked:>10.3f} {vm:>10.3f} {walked / vm:>7.1f}x")
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,158 @@
+import hashlib
+import json
+import os
+import pickle
+import shutil
+import time
+
+DEFAULT_DIR = os.environ.get("STACKLY_CACHE", ".stackly-cache")
+MAX_SIZE = 512 << 20
+MAX_AGE = 30 * 24 * 60 * 60
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+compiler_files = [
+  "lexer.py",
+  "parsing.py",
+  "typechecker.py",
+  "optimizer.py",
+  "modules.py",
+  "compiler.py",
+]
+
+def digest(*parts):
+  h = hashlib.sha256()
+  for part in parts:
+    data = part if isinstance(part, bytes) else repr(part).encode()
+    h.update(len(data).to_bytes(8, "little"))
+    h.update(data)
+  return h.hexdigest()
+
+def compiler_version(files=compiler_files):
+  sources = []
+  for name in files:
+    with open(os.path.join(HERE, name), "rb") as f:
+      sources.append(f.read())
+  return digest(*sources)
+
+class BuildCache:
+  def __init__(self, directory=DEFAULT_DIR, enabled=True, max_size=MAX_SIZE, max_age=MAX_AGE):
+    self.directory = directory
+    self.enabled = enabled
+    self.max_size = max_size
+    self.max_age = max_age
+    self.hits = {}
+    self.misses = {}
+
+  def path(self, stage, key):
+    return os.path.join(self.directory, stage, key[:2], key)
+
+  def count(self, stage, hit):
+    counts = self.hits if hit else self.misses
+    counts[stage] = counts.get(stage, 0) + 1
+
+  def lookup(self, stage, key):
+    if not self.enabled:
+      return None
+    path = self.path(stage, key)
+    if not os.path.exists(path):
+      self.count(stage, False)
+      return None
+    self.count(stage, True)
+    os.utime(path)
+    return path
+
+  def install(self, stage, key, source, copy=False):
+    if not self.enabled:
+      return
+    path = self.path(stage, key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    if copy:
+      shutil.copy2(source, tmp)
+    else:
+      with open(tmp, "wb") as f:
+        f.write(source)
+    os.replace(tmp, path)
+
+  # An entry that valid() rejects, such as one whose imports have changed,
+  # counts as a miss.
+  def load(self, stage, key, valid=None):
+    if not self.enabled:
+      return None
+    path = self.path(stage, key)
+    value = None
+    if os.path.exists(path):
+      with open(path, "rb") as f:
+        value = pickle.load(f)
+      if valid is not None and not valid(value):
+        value = None
+    self.count(stage, value is not None)
+    if value is not None:
+      os.utime(path)
+    return value
+
+  def store(self, stage, key, value):
+    self.install(stage, key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+
+  def fetch_file(self, stage, key, destination):
+    path = self.lookup(stage, key)
+    if path is None:
+      return False
+    shutil.copy2(path, destination)
+    return True
+
+  def store_file(self, stage, key, source):
+    self.install(stage, key, source, copy=True)
+
+  def entries(self):
+    for root, _, files in os.walk(self.directory):
+      for name in files:
+        if name != "stats.json":
+          path = os.path.join(root, name)
+          stat = os.stat(path)
+          yield stat.st_mtime, stat.st_size, path
+
+  def evict(self):
+    now = time.time()
+    kept = []
+    for mtime, size, path in self.entries():
+      if now - mtime > self.max_age:
+        os.remove(path)
+      else:
+        kept.append((mtime, size, path))
+    total = sum(size for _, size, _ in kept)
+    for mtime, size, path in sorted(kept):
+      if total <= self.max_size:
+        break
+      os.remove(path)
+      total -= size
+
+  def totals(self):
+    path = os.path.join(self.directory, "stats.json")
+    if not os.path.exists(path):
+      return {"hits": {}, "misses": {}}
+    with open(path) as f:
+      return json.load(f)
+
+  def close(self):
+    if not self.enabled or not os.path.isdir(self.directory):
+      return
+    totals = self.totals()
+    for name, counts in [("hits", self.hits), ("misses", self.misses)]:
+      for stage, count in counts.items():
+        totals[name][stage] = totals[name].get(stage, 0) + count
+    with open(os.path.join(self.directory, "stats.json"), "w") as f:
+      json.dump(totals, f, indent=2)
+    self.evict()
+
+  def report(self):
+    totals = self.totals()
+    stages = sorted(set(self.hits) | set(self.misses) | set(totals["hits"]) | set(totals["misses"]))
+    lines = [f"{'stage':>8} {'run hits':>9} {'run misses':>11} {'total hits':>11} {'total misses':>13}"]
+    for stage in stages:
+      lines.append(
+        f"{stage:>8} {self.hits.get(stage, 0):>9} {self.misses.get(stage, 0):>11}"
+        f" {totals['hits'].get(stage, 0):>11} {totals['misses'].get(stage, 0):>13}"
+      )
+    return "\n".join(lines)
@@ -1,6 +1,15 @@
 from parsing import parse_expr, Tree, TreeType
 from lexer import lex
-from typechecker import typecheck
+from typechecker import typecheck, Kind
+from optimizer import optimize, element_expr, add_arguments as add_optimizer_arguments
+from modules import dependencies, stale
+from buildcache import BuildCache, compiler_version, digest, DEFAULT_DIR, HERE
+from dataclasses import dataclass
+import argparse
+import os
+import shutil
+import subprocess
+import tempfile
 
 var_counter = 0
 def new_quote():
@@ -13,8 +22,242 @@ def new_list():
   result = var_counter
   var_counter += 1
   return f"list_{result}"
+def new_cond():
+  global var_counter
+  result = var_counter
+  var_counter += 1
+  return f"cond_{result}"
+def new_counter():
+  global var_counter
+  result = var_counter
+  var_counter += 1
+  return f"count_{result}"
+def new_node():
+  global var_counter
+  result = var_counter
+  var_counter += 1
+  return f"node_{result}"
+
+const_operations = [TreeType.AddConst, TreeType.SubConst, TreeType.DupLtConst]
+
+# Quotes capture nothing but the stack they are called on, so each one becomes
+# a top-level Go function, shared by every quote with the same structure.
+class Lifted:
+  def __init__(self):
+    self.names = {}
+    self.functions = []
+    self.shapes = {}
+
+def shape(quotes, tree):
+  key = quotes.shapes.get(id(tree))
+  if key is None:
+    nodes = tuple(shape(quotes, node) if isinstance(node, Tree) else node for node in tree.nodes)
+    key = quotes.shapes[id(tree)] = (tree.type, nodes)
+  return key
+
+def lift(quotes, tree):
+  key = shape(quotes, tree)
+  if key not in quotes.names:
+    body = compile("", quotes, tree)
+    name = new_quote()
+    quotes.functions.append(f"func {name}(stack []interface{{}}) []interface{{}} {{\n{body}    return stack\n}}\n")
+    quotes.names[key] = name
+  return quotes.names[key]
+
+def is_quote(node):
+  return node.type == TreeType.PushQuote
+
+def pop_bool(code, stack):
+  a = new_cond()
+  code += f"    {a} := {stack}[len({stack})-1].(bool)\n"
+  code += f"    {stack} = {stack}[:len({stack})-1]\n"
+  return code, a
+
+def flat_nodes(tree):
+  if tree.type == TreeType.Expr:
+    return [leaf for node in tree.nodes for leaf in flat_nodes(node)]
+  if tree.type in [TreeType.Noop, TreeType.PrintType]:
+    return []
+  return [tree]
+
+def is_int(node):
+  return node.type == TreeType.PushInt
+
+loop_compares = {TreeType.Lt: "<", TreeType.Lte: "<="}
+
+def loop_bound(nodes):
+  if len(nodes) == 1 and nodes[0].type == TreeType.DupLtConst:
+    return "<", nodes[0].nodes[0]
+  if len(nodes) == 3 and nodes[0].type == TreeType.Dup and is_int(nodes[1]) and nodes[2].type in loop_compares:
+    return loop_compares[nodes[2].type], nodes[1].nodes[0]
+  return None
+
+def loop_step(nodes):
+  if nodes and nodes[-1].type == TreeType.AddConst:
+    return nodes[:-1], nodes[-1].nodes[0]
+  if len(nodes) >= 2 and is_int(nodes[-2]) and nodes[-1].type == TreeType.Add:
+    return nodes[:-2], nodes[-2].nodes[0]
+  return None, None
+
+# (pops, pushes) of the nodes a counted loop body may contain besides the step.
+stack_effects = {
+  TreeType.PushInt: (0, 1),
+  TreeType.PushBool: (0, 1),
+  TreeType.PushChar: (0, 1),
+  TreeType.PushQuote: (0, 1),
+  TreeType.PushList: (0, 1),
+  TreeType.Dup: (1, 2),
+  TreeType.DupLtConst: (1, 2),
+  TreeType.AddConst: (1, 1),
+  TreeType.SubConst: (1, 1),
+  TreeType.Not: (1, 1),
+  TreeType.Print: (1, 0),
+  TreeType.Add: (2, 1),
+  TreeType.Sub: (2, 1),
+  TreeType.Mul: (2, 1),
+  TreeType.Div: (2, 1),
+  TreeType.Lt: (2, 1),
+  TreeType.Gt: (2, 1),
+  TreeType.Lte: (2, 1),
+  TreeType.Gte: (2, 1),
+  TreeType.Eq: (2, 1),
+  TreeType.Cons: (2, 1),
+  TreeType.ReadLine: (0, 1),
+  TreeType.ReadInt: (0, 1),
+  TreeType.ReadChar: (0, 1),
+  TreeType.Eof: (0, 1),
+  TreeType.WriteLine: (1, 0),
+  TreeType.Flush: (0, 0),
+}
+
+# `{. N <} {... k +} while` with the counter on top of the stack becomes a Go
+# for loop over a local int, as long as the body only reads the counter
+# through `.` and leaves the stack as it found it. Anything else keeps the
+# generic loop.
+def counted_loop(code, quotes, cond, body, stack):
+  bound = loop_bound(flat_nodes(cond))
+  nodes, step = loop_step(flat_nodes(body))
+  if bound is None or nodes is None or step <= 0:
+    return None
+  count = new_counter()
+  loop = ""
+  height = 0
+  for node in nodes:
+    if node.type not in stack_effects:
+      return None
+    pops, pushes = stack_effects[node.type]
+    if node.type == TreeType.Dup and height == 0:
+      loop += f"    {stack} = append({stack}, {count})\n"
+    elif height < pops:
+      return None
+    else:
+      loop = compile(loop, quotes, node, stack)
+    height += pushes - pops
+  if height != 0:
+    return None
+  op, limit = bound
+  code += f"    {count} := {stack}[len({stack})-1].(int)\n"
+  code += f"    {stack} = {stack}[:len({stack})-1]\n"
+  code += f"    for ; {count} {op} {limit}; {count} += {step} {{\n"
+  code += loop
+  code += "    }\n"
+  code += f"    {stack} = append({stack}, {count})\n"
+  return code
+
+go_exprs = {
+  TreeType.Add: "{a} + {b}",
+  TreeType.Sub: "{a} - {b}",
+  TreeType.Mul: "{a} * {b}",
+  TreeType.Div: "{a} / {b}",
+  TreeType.Lt: "{a} < {b}",
+  TreeType.Gt: "{a} > {b}",
+  TreeType.Lte: "{a} <= {b}",
+  TreeType.Gte: "{a} >= {b}",
+  TreeType.Eq: "{a} == {b}",
+  TreeType.Not: "!{a}",
+}
+
+unbox = {"int": ".(int)", "bool": ".(bool)", None: ""}
+
+# `{...} map` and `{...} filter` whose quote is plain arithmetic become a Go
+# loop over the list with the element unboxed once, instead of a quote call
+# per element. Returns the loop's lines and the expression for the new list.
+def element_loop(quote, type, source):
+  found = element_expr(quote, go_exprs)
+  if found is None:
+    return None, None
+  expr, kind = found
+  # `{} filter` keeps the elements that are true, so they are Bools.
+  if type == TreeType.Filter and expr == "x":
+    kind = "bool"
+  items = new_list()
+  node = new_node()
+  lines = [
+    f"{items} := make([]interface{{}}, 0, {source}.Len())",
+    f"for {node} := {source}; {node} != nil; {node} = {node}.tail {{",
+    f"    x := {node}.head{unbox[kind]}",
+  ]
+  if type == TreeType.Map:
+    lines.append(f"    {items} = append({items}, {expr})")
+  else:
+    lines.append(f"    if {expr} {{")
+    lines.append(f"        {items} = append({items}, x)")
+    lines.append("    }")
+  lines.append("}")
+  return lines, f"ListOf({items})"
 
-def compile(code, tree: Tree, stack="stack"):
+def compile_expr(code, quotes, nodes, stack):
+  i = 0
+  while i < len(nodes):
+    node = nodes[i]
+    rest = nodes[i+1:i+3]
+    if len(rest) == 2 and is_quote(node) and is_quote(rest[0]) and rest[1].type == TreeType.If:
+      then = lift(quotes, node.nodes[0])
+      other = lift(quotes, rest[0].nodes[0])
+      code, a = pop_bool(code, stack)
+      code += f"    if {a} {{\n"
+      code += f"    {stack} = {then}({stack})\n"
+      code += "    } else {\n"
+      code += f"    {stack} = {other}({stack})\n"
+      code += "    }\n"
+      i += 3
+      continue
+    if len(rest) == 2 and is_quote(node) and is_quote(rest[0]) and rest[1].type == TreeType.While:
+      loop = counted_loop(code, quotes, node.nodes[0], rest[0].nodes[0], stack)
+      if loop is not None:
+        code = loop
+        i += 3
+        continue
+      cond = lift(quotes, node.nodes[0])
+      body = lift(quotes, rest[0].nodes[0])
+      code += "    for {\n"
+      code += f"    {stack} = {cond}({stack})\n"
+      code, a = pop_bool(code, stack)
+      code += f"    if !{a} {{\n"
+      code += "    break\n"
+      code += "    }\n"
+      code += f"    {stack} = {body}({stack})\n"
+      code += "    }\n"
+      i += 3
+      continue
+    if rest and is_quote(node) and rest[0].type == TreeType.Eval:
+      code += f"    {stack} = {lift(quotes, node.nodes[0])}({stack})\n"
+      i += 2
+      continue
+    if rest and is_quote(node) and rest[0].type in [TreeType.Map, TreeType.Filter]:
+      source = new_list()
+      lines, result = element_loop(node.nodes[0], rest[0].type, source)
+      if lines is not None:
+        code += f"    {source} := {stack}[len({stack})-1].(*List)\n"
+        code += "".join(f"    {line}\n" for line in lines)
+        code += f"    {stack}[len({stack})-1] = {result}\n"
+        i += 2
+        continue
+    code = compile(code, quotes, node, stack)
+    i += 1
+  return code
+
+def compile(code, quotes, tree: Tree, stack="stack"):
   if tree.type == TreeType.PushInt:
     code += f"    {stack} = append({stack}, {tree.nodes[0]})\n"
     return code
@@ -28,46 +271,536 @@ def compile(code, tree: Tree, stack="stack"):
   if tree.type == TreeType.PushList:
     a = new_list()
     code += f"    {a} := []interface{{}}{{}}\n"
-    code = compile(code, tree.nodes[0], a)
-    code += f"    {stack} = append({stack}, {a})\n"
+    code = compile(code, quotes, tree.nodes[0], a)
+    code += f"    {stack} = append({stack}, ListOf({a}))\n"
+    return code
   if tree.type == TreeType.PushQuote:
-    a = new_quote()
-    code += f"    {a} := func({stack} []interface{{}}) []interface{{}} {{\n"
-    code = compile(code, tree.nodes[0], stack)
-    code += f"    return {stack}\n"
-    code += "    }\n"
-    code += f"    {stack} = append({stack}, ({a}))\n"
+    code += f"    {stack} = append({stack}, {lift(quotes, tree.nodes[0])})\n"
     return code
   if tree.type == TreeType.PrintType:
     return code
   if tree.type == TreeType.Expr:
-    for node in tree.nodes:
-      code = compile(code, node, stack)
-    return code
+    return compile_expr(code, quotes, tree.nodes, stack)
   if tree.type == TreeType.Noop:
     return code
   name = tree.type.name
+  if tree.type in const_operations:
+    code += f"    {stack} = {name}({stack}, {tree.nodes[0]})\n"
+    return code
   code += f"    {stack} = {name}({stack})\n"
   return code
 
-def compile_source_code(file, source_code: str):
-  tokens = lex(file, source_code)
-  tree, _ = parse_expr(tokens)
+class Unsupported(Exception):
+  def __init__(self, tree, reason):
+    super().__init__(f"{tree.location} {reason}")
+
+# Typed mode simulates the stack at compile time. The typechecker guarantees
+# that the depth and kind of every slot is fixed, so each slot is held in a Go
+# local (or is a literal) and only lists are boxed. Quote values never reach
+# the runtime: a slot records which quote body it holds, and '~', 'if' and
+# 'while' call a Go function specialised for the stack the quote runs on.
+# That function takes the slots the quote reads as parameters and returns the
+# slots it leaves, so the Go compiler can inline it and keep values in
+# registers.
+go_types = {
+  Kind.Int: "int",
+  Kind.Bool: "bool",
+  Kind.Char: "rune",
+  Kind.List: "*List",
+}
+
+binary_ops = {
+  TreeType.Add: ("+", Kind.Int),
+  TreeType.Sub: ("-", Kind.Int),
+  TreeType.Mul: ("*", Kind.Int),
+  TreeType.Div: ("/", Kind.Int),
+  TreeType.Lt: ("<", Kind.Bool),
+  TreeType.Gt: (">", Kind.Bool),
+  TreeType.Lte: ("<=", Kind.Bool),
+  TreeType.Gte: (">=", Kind.Bool),
+  TreeType.Eq: ("==", Kind.Bool),
+}
+
+typed_reads = {
+  TreeType.ReadLine: (Kind.List, "NextLine()"),
+  TreeType.ReadInt: (Kind.Int, "NextInt()"),
+  TreeType.ReadChar: (Kind.Char, "NextChar()"),
+  TreeType.Eof: (Kind.Bool, "AtEof()"),
+}
+
+class Typed:
+  def __init__(self):
+    self.functions = []
+    self.specialized = {}
+    self.quotes = Lifted()
+
+class Function:
+  def __init__(self, depth):
+    self.code = ""
+    self.indent = "    "
+    self.low = depth
+    self.count = 0
+  def emit(self, line):
+    self.code += self.indent + line + "\n"
+  def local(self, prefix="v"):
+    self.count += 1
+    return f"{prefix}{self.count}"
+  def touch(self, depth):
+    self.low = min(self.low, depth)
+
+def signature(slots):
+  return tuple((kind, id(value) if kind == Kind.Quote else None) for kind, value in slots)
+
+def same_slots(a, b):
+  return signature(a) == signature(b)
+
+def go_type(tree, kind):
+  if kind not in go_types:
+    raise Unsupported(tree, f"'{tree.type.name}' needs a runtime value of kind {kind.name}")
+  return go_types[kind]
+
+def materialize(fn, tree, kind, expr):
+  name = fn.local()
+  fn.emit(f"var {name} {go_type(tree, kind)} = {expr}")
+  return (kind, name)
+
+def values(slots):
+  return [value for kind, value in slots if kind != Kind.Quote]
+
+@dataclass
+class Specialization:
+  name: str
+  low: int
+  exit: list
+
+def specialize(ctx, tree, slots, site):
+  key = (id(tree), signature(slots))
+  if key in ctx.specialized:
+    if ctx.specialized[key] is None:
+      raise Unsupported(site, "recursive quote evaluation")
+    return ctx.specialized[key]
+  ctx.specialized[key] = None
+  fn = Function(len(slots))
+  entry = [(kind, value if kind == Kind.Quote else f"p{i}") for i, (kind, value) in enumerate(slots)]
+  exit = compile_typed(ctx, fn, tree, entry)
+  params = ", ".join(f"p{i} {go_type(site, kind)}" for i, (kind, _) in enumerate(slots) if i >= fn.low and kind != Kind.Quote)
+  results = [go_type(site, kind) for kind, _ in exit[fn.low:] if kind != Kind.Quote]
+  returns = ", ".join(values(exit[fn.low:]))
+  result_types = f" ({', '.join(results)})" if len(results) > 1 else "".join(f" {r}" for r in results)
+  name = new_quote()
+  code = f"func {name}({params}){result_types} {{\n{fn.code}"
+  if results:
+    code += f"    return {returns}\n"
+  code += "}\n"
+  ctx.functions.append(code)
+  ctx.specialized[key] = Specialization(name, fn.low, exit)
+  return ctx.specialized[key]
+
+def call(fn, spec, slots, targets=None):
+  args = ", ".join(values(slots[spec.low:]))
+  outputs = spec.exit[spec.low:]
+  count = len(values(outputs))
+  if not count:
+    fn.emit(f"{spec.name}({args})")
+    return slots[:spec.low] + outputs
+  if targets is None:
+    targets = [fn.local() for _ in range(count)]
+    fn.emit(f"{', '.join(targets)} := {spec.name}({args})")
+  else:
+    fn.emit(f"{', '.join(targets)} = {spec.name}({args})")
+  names = iter(targets)
+  return slots[:spec.low] + [(kind, value if kind == Kind.Quote else next(names)) for kind, value in outputs]
+
+def assign(fn, targets, sources):
+  pairs = [(t, s) for t, s in zip(targets, sources) if t != s]
+  if pairs:
+    fn.emit(f"{', '.join(t for t, _ in pairs)} = {', '.join(s for _, s in pairs)}")
+
+def declare(fn, tree, slots, prefix, init=False):
+  names = []
+  for kind, value in slots:
+    if kind != Kind.Quote:
+      names.append(fn.local(prefix))
+      fn.emit(f"var {names[-1]} {go_type(tree, kind)}" + (f" = {value}" if init else ""))
+  return names
+
+def rename(slots, names):
+  names = iter(names)
+  return [(kind, value if kind == Kind.Quote else next(names)) for kind, value in slots]
+
+def branch(fn, spec, entry, low, joins):
+  targets = iter(joins)
+  passed = [next(targets) for kind, _ in entry[low:spec.low] if kind != Kind.Quote]
+  assign(fn, passed, values(entry[low:spec.low]))
+  call(fn, spec, entry, list(targets))
+
+def compile_typed(ctx, fn, tree: Tree, slots):
+  if tree.type in [TreeType.Noop, TreeType.PrintType]:
+    return slots
+  if tree.type == TreeType.Expr:
+    for node in tree.nodes:
+      slots = compile_typed(ctx, fn, node, slots)
+    return slots
+  if tree.type == TreeType.PushInt:
+    return slots + [(Kind.Int, str(tree.nodes[0]))]
+  if tree.type == TreeType.PushBool:
+    return slots + [(Kind.Bool, "true" if tree.nodes[0] == "True" else "false")]
+  if tree.type == TreeType.PushChar:
+    return slots + [(Kind.Char, f"rune({ord(tree.nodes[0])})")]
+  if tree.type == TreeType.PushQuote:
+    return slots + [(Kind.Quote, tree.nodes[0])]
+  if tree.type == TreeType.PushList:
+    a = new_list()
+    fn.emit(f"{a} := []interface{{}}{{}}")
+    fn.code = compile(fn.code, ctx.quotes, tree.nodes[0], a)
+    return slots + [materialize(fn, tree, Kind.List, f"ListOf({a})")]
+  if tree.type in binary_ops:
+    fn.touch(len(slots) - 2)
+    (kind, a), (_, b) = slots[-2:]
+    op, result = binary_ops[tree.type]
+    if kind not in [Kind.Int, Kind.Bool, Kind.Char]:
+      raise Unsupported(tree, f"'{tree.type.name}' on {kind.name} values")
+    return slots[:-2] + [materialize(fn, tree, result, f"{a} {op} {b}")]
+  if tree.type in [TreeType.AddConst, TreeType.SubConst]:
+    fn.touch(len(slots) - 1)
+    op = "+" if tree.type == TreeType.AddConst else "-"
+    return slots[:-1] + [materialize(fn, tree, Kind.Int, f"{slots[-1][1]} {op} {tree.nodes[0]}")]
+  if tree.type == TreeType.DupLtConst:
+    fn.touch(len(slots) - 1)
+    return slots + [materialize(fn, tree, Kind.Bool, f"{slots[-1][1]} < {tree.nodes[0]}")]
+  if tree.type == TreeType.Not:
+    fn.touch(len(slots) - 1)
+    return slots[:-1] + [materialize(fn, tree, Kind.Bool, f"!{slots[-1][1]}")]
+  if tree.type == TreeType.Dup:
+    fn.touch(len(slots) - 1)
+    return slots + [slots[-1]]
+  if tree.type == TreeType.Print:
+    fn.touch(len(slots) - 1)
+    kind, value = slots[-1]
+    go_type(tree, kind)
+    if kind == Kind.Int:
+      fn.emit(f"PrintInt({value})")
+    elif kind == Kind.Bool:
+      fn.emit(f"PrintBool({value})")
+    elif kind == Kind.Char:
+      fn.emit(f"PrintInt(int({value}))")
+    else:
+      fn.emit(f"PrintValue({value})")
+    return slots[:-1]
+  if tree.type == TreeType.Cons:
+    fn.touch(len(slots) - 2)
+    (kind, a), (_, b) = slots[-2:]
+    go_type(tree, kind)
+    return slots[:-2] + [materialize(fn, tree, Kind.List, f"Prepend({a}, {b})")]
+  if tree.type == TreeType.Range:
+    fn.touch(len(slots) - 1)
+    return slots[:-1] + [materialize(fn, tree, Kind.List, f"RangeList({slots[-1][1]})")]
+  if tree.type == TreeType.Len:
+    fn.touch(len(slots) - 1)
+    return slots[:-1] + [materialize(fn, tree, Kind.Int, f"{slots[-1][1]}.Len()")]
+  if tree.type == TreeType.Sum:
+    fn.touch(len(slots) - 1)
+    return slots[:-1] + [materialize(fn, tree, Kind.Int, f"SumList({slots[-1][1]})")]
+  if tree.type in typed_reads:
+    kind, expr = typed_reads[tree.type]
+    return slots + [materialize(fn, tree, kind, expr)]
+  if tree.type == TreeType.WriteLine:
+    fn.touch(len(slots) - 1)
+    fn.emit(f"WriteChars({slots[-1][1]})")
+    return slots[:-1]
+  if tree.type == TreeType.Flush:
+    fn.emit("writer.Flush()")
+    return slots
+  if tree.type in [TreeType.Map, TreeType.Filter]:
+    fn.touch(len(slots) - 2)
+    (_, a), (_, quote) = slots[-2:]
+    lines, result = element_loop(quote, tree.type, a)
+    if lines is None:
+      result = f"{tree.type.name}List({a}, {lift(ctx.quotes, quote)})"
+    for line in lines or []:
+      fn.emit(line)
+    return slots[:-2] + [materialize(fn, tree, Kind.List, result)]
+  if tree.type == TreeType.PMap:
+    fn.touch(len(slots) - 2)
+    (_, a), (_, quote) = slots[-2:]
+    return slots[:-2] + [materialize(fn, tree, Kind.List, f"PMapList({a}, {lift(ctx.quotes, quote)})")]
+  if tree.type == TreeType.Fold:
+    fn.touch(len(slots) - 3)
+    (_, a), (kind, b), (_, quote) = slots[-3:]
+    result = f"FoldList({a}, {b}, {lift(ctx.quotes, quote)}).({go_type(tree, kind)})"
+    return slots[:-3] + [materialize(fn, tree, kind, result)]
+  if tree.type == TreeType.Eval:
+    fn.touch(len(slots) - 1)
+    spec = specialize(ctx, slots[-1][1], slots[:-1], tree)
+    fn.touch(spec.low)
+    return call(fn, spec, slots[:-1])
+  if tree.type == TreeType.If:
+    fn.touch(len(slots) - 3)
+    (_, cond), (_, b), (_, c) = slots[-3:]
+    entry = slots[:-3]
+    then = specialize(ctx, b, entry, tree)
+    other = specialize(ctx, c, entry, tree)
+    if not same_slots(then.exit, other.exit):
+      raise Unsupported(tree, "'if' branches leave differently shaped stacks")
+    low = min(then.low, other.low)
+    fn.touch(low)
+    joins = declare(fn, tree, then.exit[low:], "j")
+    fn.emit(f"if {cond} {{")
+    fn.indent += "    "
+    branch(fn, then, entry, low, joins)
+    fn.indent = fn.indent[:-4]
+    fn.emit("} else {")
+    fn.indent += "    "
+    branch(fn, other, entry, low, joins)
+    fn.indent = fn.indent[:-4]
+    fn.emit("}")
+    return entry[:low] + rename(then.exit[low:], joins)
+  if tree.type == TreeType.While:
+    fn.touch(len(slots) - 2)
+    (_, a), (_, b) = slots[-2:]
+    entry = slots[:-2]
+    cond = specialize(ctx, a, entry, tree)
+    body = specialize(ctx, b, entry, tree)
+    if not same_slots(cond.exit, entry + [(Kind.Bool, None)]) or not same_slots(body.exit, entry):
+      raise Unsupported(tree, "'while' quotes change the shape of the stack")
+    low = min(cond.low, body.low)
+    fn.touch(low)
+    loop = declare(fn, tree, entry[low:], "l", init=True)
+    state = entry[:low] + rename(entry[low:], loop)
+    flag = fn.local("c")
+    fn.emit(f"var {flag} bool")
+    fn.emit("for {")
+    fn.indent += "    "
+    call(fn, cond, state, [n for n in values(state[cond.low:])] + [flag])
+    fn.emit(f"if !{flag} {{")
+    fn.emit("    break")
+    fn.emit("}")
+    call(fn, body, state, values(state[body.low:]))
+    fn.indent = fn.indent[:-4]
+    fn.emit("}")
+    return state
+  assert False, f"Not implemented: {tree.type.name}"
+
+def compile_typed_program(tree):
+  ctx = Typed()
+  fn = Function(0)
+  compile_typed(ctx, fn, tree, [])
+  code = "package main\n"
+  code += "".join(ctx.functions)
+  code += "".join(ctx.quotes.functions)
+  code += "func main() {\n"
+  code += fn.code
+  code += "    writer.Flush()\n"
+  code += "}\n"
+  return code
+
+c_operations = {
+  TreeType.Add: "add",
+  TreeType.Sub: "sub",
+  TreeType.Mul: "mul",
+  TreeType.Div: "div",
+  TreeType.Cons: "cons",
+  TreeType.Lt: "lt",
+  TreeType.Gt: "gt",
+  TreeType.Lte: "lte",
+  TreeType.Gte: "gte",
+  TreeType.Eq: "eq",
+  TreeType.Not: "not",
+  TreeType.Eval: "eval",
+  TreeType.Print: "print",
+  TreeType.Dup: "dup",
+  TreeType.If: "if",
+  TreeType.While: "while",
+  TreeType.AddConst: "add_const",
+  TreeType.SubConst: "sub_const",
+  TreeType.DupLtConst: "dup_lt_const",
+}
+
+def compile_c(code, quotes, tree: Tree, stack="stack", indent="  "):
+  if tree.type == TreeType.PushInt:
+    code += f"{indent}push_int({stack}, {tree.nodes[0]});\n"
+    return code
+  if tree.type == TreeType.PushBool:
+    val = 1 if tree.nodes[0] == "True" else 0
+    code += f"{indent}push_bool({stack}, {val});\n"
+    return code
+  if tree.type == TreeType.PushChar:
+    code += f"{indent}push_char({stack}, {ord(tree.nodes[0])});\n"
+    return code
+  if tree.type == TreeType.PushList:
+    a = new_list()
+    code += f"{indent}Stack *{a} = malloc(sizeof(Stack));\n"
+    code += f"{indent}init_stack({a});\n"
+    code = compile_c(code, quotes, tree.nodes[0], a, indent)
+    code += f"{indent}push_list({stack}, {a});\n"
+    return code
+  if tree.type == TreeType.PushQuote:
+    a = new_quote()
+    body = compile_c("", quotes, tree.nodes[0])
+    quotes.append(f"static void {a}(Stack *stack) {{\n{body}}}\n\n")
+    code += f"{indent}push_quote({stack}, {a});\n"
+    return code
+  if tree.type == TreeType.Expr:
+    for node in tree.nodes:
+      code = compile_c(code, quotes, node, stack, indent)
+    return code
+  if tree.type in [TreeType.Noop, TreeType.PrintType]:
+    return code
+  if tree.type in const_operations:
+    code += f"{indent}{c_operations[tree.type]}_operation({stack}, {tree.nodes[0]});\n"
+    return code
+  if tree.type not in c_operations:
+    print(f"{tree.location} COMPILE ERROR: '{tree.type.value}' is not supported by the C backend")
+    exit(1)
+  code += f"{indent}{c_operations[tree.type]}_operation({stack});\n"
+  return code
+
+def compile_c_program(tree):
+  quotes = []
+  body = compile_c("", quotes, tree)
+  code = "#include <stdlib.h>\n"
+  code += "#include \"lib.h\"\n\n"
+  code += "".join(quotes)
+  code += "int main(void) {\n"
+  code += "  Stack stack_value;\n"
+  code += "  Stack *stack = &stack_value;\n"
+  code += "  init_stack(stack);\n"
+  code += body
+  code += "  free_stack(stack);\n"
+  code += "  return 0;\n"
+  code += "}\n"
+  return code
+
+def check(tree):
   stack = typecheck(tree)
   if stack:
     top = stack.pop()
     print(f"{top.location} TYPE ERROR: Program finished with unhandled data on the stack")
     exit(1)
+  return stack
+
+def generate(file, tree, typed=False, target="go", level=1, report=False):
+  tree, stats = optimize(tree, level)
+  if report:
+    print(f"{file}: optimizer {stats}")
+  if target == "c":
+    return compile_c_program(tree)
+  if typed:
+    try:
+      return compile_typed_program(tree)
+    except Unsupported as e:
+      print(f"{e} NOTE: Falling back to boxed code generation")
+  quotes = Lifted()
+  body = compile("", quotes, tree)
   code = "package main\n"
+  code += "".join(quotes.functions)
   code += "func main() {\n"
   code += "    stack := []interface{}{}\n"
-  code = compile(code, tree)
+  code += body
   code += "    writer.Flush()\n"
   code += "}\n"
   return code
 
-with open("main.stk") as f:
-  text = f.read()
+def compile_source_code(file, source_code: str, typed=False, target="go", level=1, report=False):
+  tokens = lex(file, source_code)
+  tree, _ = parse_expr(tokens)
+  check(tree)
+  return generate(file, tree, typed, target, level, report)
+
+def fresh(entry):
+  return not stale(entry[1])
+
+def frontend_cached(cache, file, source_code, version):
+  key = digest(file, source_code, version)
+  entry = cache.load("tree", key, fresh)
+  if entry is None:
+    tokens = cache.load("tokens", key)
+    if tokens is None:
+      tokens = lex(file, source_code)
+      cache.store("tokens", key, tokens)
+    tree, _ = parse_expr(tokens)
+    entry = (tree, dependencies())
+    cache.store("tree", key, entry)
+  tree, deps = entry
+  types = digest(key, deps)
+  if cache.load("types", types) is None:
+    cache.store("types", types, check(tree))
+  return tree, deps
+
+def compile_cached(cache, file, source_code: str, typed=False, target="go", level=1, report=False):
+  version = compiler_version()
+  key = digest(file, source_code, version, typed, target, level)
+  entry = cache.load("code", key, fresh)
+  if entry is None:
+    tree, deps = frontend_cached(cache, file, source_code, version)
+    entry = (generate(file, tree, typed, target, level, report), deps)
+    cache.store("code", key, entry)
+  return entry[0]
+
+runtimes = {
+  "go": ["lib.go", "go.mod"],
+  "c": ["lib.c", "lib.h"],
+}
+
+def build_command(target, binary):
+  if target == "c":
+    return ["cc", "-O2", "-o", binary, "main.c", "lib.c"]
+  return ["go", "build", "-o", binary, "main.go", "lib.go"]
+
+# The program is built in a scratch directory next to copies of the runtime
+# from the compiler's directory, so it builds from anywhere, and the key only
+# covers what goes into the binary, not where it is written.
+def build_cached(cache, code, output, binary, target="go"):
+  runtime = []
+  for name in runtimes[target]:
+    with open(os.path.join(HERE, name), "rb") as f:
+      runtime.append(f.read())
+  key = digest(code, build_command(target, "main"), *runtime)
+  if cache.fetch_file("binary", key, binary):
+    return
+  with tempfile.TemporaryDirectory() as directory:
+    for name in runtimes[target]:
+      shutil.copy(os.path.join(HERE, name), directory)
+    with open(os.path.join(directory, f"main.{target}"), "w") as f:
+      f.write(code)
+    command = build_command(target, os.path.abspath(binary))
+    result = subprocess.run(command, cwd=directory, capture_output=True, text=True)
+  if result.returncode != 0:
+    print((result.stdout + result.stderr).rstrip())
+    print(f"{output} BUILD ERROR: {' '.join(command)} exited with {result.returncode}")
+    exit(1)
+  cache.store_file("binary", key, binary)
+
+def write_if_changed(path, text):
+  if os.path.exists(path):
+    with open(path) as f:
+      if f.read() == text:
+        return
+  with open(path, "w") as f:
+    f.write(text)
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Compile a Stackly program to Go or C")
+  parser.add_argument("source", nargs="?", default="main.stk")
+  parser.add_argument("-o", "--output", help="defaults to main.go or main.c")
+  parser.add_argument("--target", choices=["go", "c"], default="go", help="c output builds with 'cc main.c lib.c'")
+  parser.add_argument("--typed", action="store_true", help="emit unboxed Go code from the inferred stack types")
+  parser.add_argument("--build", nargs="?", const="main", metavar="BINARY", help="also build the output into BINARY (default main)")
+  parser.add_argument("--no-cache", action="store_true", help="recompute every stage and leave the build cache untouched")
+  parser.add_argument("--cache-dir", default=DEFAULT_DIR, help=f"defaults to $STACKLY_CACHE or {DEFAULT_DIR}")
+  parser.add_argument("--cache-stats", action="store_true", help="print build cache hits and misses")
+  add_optimizer_arguments(parser)
+  args = parser.parse_args()
+
+  with open(args.source) as f:
+    text = f.read()
 
-with open("main.go", "w") as f:
-  f.write(compile_source_code("main.stk", text))
+  cache = BuildCache(args.cache_dir, enabled=not args.no_cache)
+  output = args.output or f"main.{args.target}"
+  code = compile_cached(cache, args.source, text, args.typed, args.target, args.level, args.opt_stats)
+  write_if_changed(output, code)
+  if args.build:
+    build_cached(cache, code, output, args.build, args.target)
+  cache.close()
+  if args.cache_stats:
+    print(cache.report())
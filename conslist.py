@@ -0,0 +1,79 @@
+# Immutable cons list shared by the Python executors. `<:` allocates one cell
+# and shares the tail, so building a list by consing is linear. The printed
+# form matches Python's list repr, which the value printers relied on before.
+class List:
+  __slots__ = ("head", "tail", "size")
+
+  def __init__(self, head, tail):
+    self.head = head
+    self.tail = tail
+    self.size = tail.size + 1
+
+  def __iter__(self):
+    node = self
+    while node.size:
+      yield node.head
+      node = node.tail
+
+  def __len__(self):
+    return self.size
+
+  def __eq__(self, other):
+    if not isinstance(other, List) or self.size != other.size:
+      return False
+    return all(a == b for a, b in zip(self, other))
+
+  __hash__ = None
+
+  def __repr__(self):
+    return "[" + ", ".join(repr(value) for value in self) + "]"
+
+  def __reduce__(self):
+    return (from_items, (list(self),))
+
+EMPTY = object.__new__(List)
+EMPTY.head = None
+EMPTY.tail = None
+EMPTY.size = 0
+
+# The characters of a line as read by read-line, backed by the str itself.
+# Cells are only made as the list is taken apart, so a line that is passed
+# straight to write-line never builds them.
+class Text(List):
+  __slots__ = ("text", "start")
+
+  def __init__(self, text, start=0):
+    self.text = text
+    self.start = start
+    self.size = len(text) - start
+
+  @property
+  def head(self):
+    return self.text[self.start] if self.size else None
+
+  @property
+  def tail(self):
+    return Text(self.text, self.start + 1) if self.size else None
+
+  def __iter__(self):
+    return iter(self.text[self.start:])
+
+def to_text(items):
+  if isinstance(items, Text):
+    return items.text[items.start:]
+  return "".join(items)
+
+def cons(head, tail):
+  return List(head, tail)
+
+def from_items(items):
+  result = EMPTY
+  for value in reversed(items):
+    result = List(value, result)
+  return result
+
+def reverse(items):
+  result = EMPTY
+  for value in items:
+    result = List(value, result)
+  return result
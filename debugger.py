@@ -1,11 +1,20 @@
 from parsing import Tree, TreeType, parse_expr
-from lexer import lex
+from lexer import lex_file
 from typechecker import typecheck
+from vm import VM, lower, op_names, BREAK, CALL, IF, LOOP_CALL, EACH_CALL
+from recorder import all_codes
+from optimizer import optimize, add_arguments as add_optimizer_arguments
+from dataclasses import dataclass
+from conslist import List
+from streams import Streams, Output, standard
+import recorder
+import argparse
+import sys
 import time
 import os
 
 def value_repr(value):
-    if isinstance(value, list):
+    if isinstance(value, List):
         return "[" + " ".join([str(v) for v in value]) + "]"
     return repr(value)
 
@@ -32,146 +41,287 @@ def print_stack(stack):
 
 print_queue = []
 
-def debug(tree, stack):
-  global print_queue
-  if tree.type == TreeType.PushInt:
-    stack.append(int(tree.nodes[0]))
-    return stack
-  if tree.type == TreeType.PushChar:
-    stack.append(tree.nodes[0])
-    return stack
-  if tree.type == TreeType.PushBool:
-    stack.append(tree.nodes[0] == "True")
-    return stack
-  if tree.type == TreeType.PushList:
-    list = debug(tree.nodes[0], [])
-    stack.append(list)
-    return stack
-  if tree.type == TreeType.Add:
-    b = stack.pop()
-    a = stack.pop()
-    stack.append(a + b)
-    return stack
-  if tree.type == TreeType.Sub:
-    b = stack.pop()
-    a = stack.pop()
-    stack.append(a - b)
-    return stack
-  if tree.type == TreeType.Mul:
-    b = stack.pop()
-    a = stack.pop()
-    stack.append(a * b)
-    return stack
-  if tree.type == TreeType.Div:
-    b = stack.pop()
-    a = stack.pop()
-    stack.append(int(a / b))
-    return stack
-  if tree.type == TreeType.Lt:
-    b = stack.pop()
-    a = stack.pop()
-    stack.append(a < b)
-    return stack
-  if tree.type == TreeType.Gt:
-    b = stack.pop()
-    a = stack.pop()
-    stack.append(a > b)
-    return stack
-  if tree.type == TreeType.Lte:
-    b = stack.pop()
-    a = stack.pop()
-    stack.append(a <= b)
-    return stack
-  if tree.type == TreeType.Gte:
-    b = stack.pop()
-    a = stack.pop()
-    stack.append(a >= b)
-    return stack
-  if tree.type == TreeType.Eq:
-    b = stack.pop()
-    a = stack.pop()
-    stack.append(a == b)
-    return stack
-  if tree.type == TreeType.Not:
-    a = stack.pop()
-    stack.append(not a)
-    return stack
-  if tree.type == TreeType.Cons:
-    b = stack.pop()
-    a = stack.pop()
-    stack.append([a] + b)
-    return stack
-  if tree.type == TreeType.PushQuote:
-    stack.append(tree.nodes[0])
-    return stack
-  if tree.type == TreeType.Eval:
-    a = stack.pop()
-    stack = debug(a, stack)
-    return stack
-  if tree.type == TreeType.Dup:
-    a = stack.pop()
-    stack.append(a)
-    stack.append(a)
-    return stack
-  if tree.type == TreeType.If:
-    c = stack.pop()
-    b = stack.pop()
-    a = stack.pop()
-    if a:
-      stack = debug(b, stack)
-    else:
-      stack = debug(c, stack)
-    return stack
-  if tree.type == TreeType.While:
-    b = stack.pop()
-    a = stack.pop()
-    while True:
-      stack = debug(a, stack)
-      if not stack.pop():
-        break
-      stack = debug(b, stack)
-    return stack
-  if tree.type == TreeType.Print:
-    a = stack.pop()
-    print_queue.append(a)
-    return stack
-  if tree.type == TreeType.Expr:
-    for node in tree.nodes:
-      stack = debug(node, stack)
-    return stack
-
-def debug_program(tree):
-  global print_queue
-  nodes = tree.nodes
-  stack = []
-  prev = []
-  for node in nodes:
-    os.system("clear")
-    print_stack(prev)
-    for q in print_queue:
-      print(q)
-    print_queue = []
-    print("Executing node:", node, "(ENTER)")
-    input("")
-    stack = debug(node, stack)
-    print_stack(stack)
-    prev = stack.copy()
+# Breakpoints patch a BREAK over the first instruction of each matching site;
+# the VM stops in front of it, so everything in between runs at full speed.
+# The original instruction is put back for the single step that resumes.
+@dataclass
+class Breakpoint:
+  spec: str
+  sites: list
+  condition: str = None
+  hits: int = 0
+  check: object = None
+
+def location_matches(spec, location, file):
+  parts = spec.split(":")
+  name, numbers = (file, parts) if parts[0].isdigit() else (parts[0], parts[1:])
+  if not numbers or len(numbers) > 2 or not all(n.isdigit() for n in numbers):
+    return False
+  if location.file != name and os.path.abspath(location.file) != os.path.abspath(name):
+    return False
+  wanted = [location.line, location.col][:len(numbers)]
+  return wanted == [int(n) for n in numbers]
+
+def find_sites(codes, spec, file):
+  names = {name: op for op, name in op_names.items() if op != BREAK}
+  sites = []
+  for code in codes:
+    for pc, (op, _) in enumerate(code.ops):
+      if spec.upper() in names:
+        if op == names[spec.upper()]:
+          sites.append((code, pc))
+      elif location_matches(spec, code.locations[pc], file):
+        if pc == 0 or code.locations[pc - 1] != code.locations[pc]:
+          sites.append((code, pc))
+  return sites
+
+def holds(breakpoint, vm):
+  if breakpoint.check is None:
+    return True
+  stack = vm.stack
+  names = {"stack": stack, "top": stack[-1] if stack else None, "depth": len(stack), "steps": vm.steps, "len": len}
+  try:
+    return bool(eval(breakpoint.check, {"__builtins__": {}}, names))
+  except Exception:
+    return False
+
+class Debugger:
+  def __init__(self, tree, file):
+    self.file = file
+    self.vm = VM(lower(tree), [], emit=print_queue.append, streams=Streams(output=Output(size=0)))
+    self.codes = all_codes(self.vm.code)
+    self.breakpoints = []
+    self.originals = {}
+    self.users = {}
+
+  def patch(self, code, pc, owner):
+    key = (id(code), pc)
+    if key not in self.originals:
+      self.originals[key] = code.ops[pc]
+      code.ops[pc] = (BREAK, None)
+    self.users.setdefault(key, []).append(owner)
+
+  def unpatch(self, code, pc, owner):
+    key = (id(code), pc)
+    self.users[key].remove(owner)
+    if not self.users[key]:
+      code.ops[pc] = self.originals.pop(key)
+      del self.users[key]
+
+  def add(self, spec, condition=None):
+    sites = find_sites(self.codes, spec, self.file)
+    if not sites:
+      return None
+    breakpoint = Breakpoint(spec, sites, condition)
+    if condition:
+      breakpoint.check = compile(condition, "<condition>", "eval")
+    for code, pc in sites:
+      self.patch(code, pc, breakpoint)
+    self.breakpoints.append(breakpoint)
+    return breakpoint
+
+  def delete(self, index):
+    breakpoint = self.breakpoints.pop(index)
+    for code, pc in breakpoint.sites:
+      self.unpatch(code, pc, breakpoint)
+
+  def step(self):
+    vm = self.vm
+    code, pc = vm.code, vm.pc
+    patched = self.originals.get((id(code), pc))
+    if patched:
+      code.ops[pc] = patched
+    vm.stop = vm.steps + 1
+    vm.run()
+    if patched:
+      code.ops[pc] = (BREAK, None)
+
+  # Runs until a breakpoint whose condition holds, or until the VM is back in
+  # `depth` frames at a temporary stop. Returns the breakpoints that fired.
+  def resume(self, until=None, depth=None):
+    vm = self.vm
+    if until:
+      self.patch(*until, "until")
+    try:
+      while not vm.done:
+        self.step()
+        if vm.done:
+          break
+        vm.stop = None
+        vm.run()
+        if vm.done:
+          break
+        owners = self.users[(id(vm.code), vm.pc)]
+        if "until" in owners and len(vm.frames) == depth:
+          return []
+        fired = [b for b in owners if b != "until" and holds(b, vm)]
+        for breakpoint in fired:
+          breakpoint.hits += 1
+        if fired:
+          return fired
+      return []
+    finally:
+      if until:
+        self.unpatch(*until, "until")
+
+  def current(self):
+    return self.originals.get((id(self.vm.code), self.vm.pc), self.vm.code.ops[self.vm.pc])
+
+  def step_over(self):
+    op, _ = self.current()
+    if op in [CALL, IF, LOOP_CALL, EACH_CALL]:
+      return self.resume((self.vm.code, self.vm.pc + 1), len(self.vm.frames))
+    self.step()
+    return []
+
+  def step_out(self):
+    if not self.vm.frames:
+      return self.resume()
+    code, pc = self.vm.frames[-1]
+    return self.resume((code, pc), len(self.vm.frames) - 1)
+
+def debug_help():
+  print("ENTER/n: step over   s: step into   o: step out   c: continue")
+  print("b FILE:LINE:COL|LINE[:COL]|OP [if CONDITION]: add a breakpoint")
+  print("  CONDITION is a Python expression over top, stack, depth and steps")
+  print("l: list breakpoints   d N: delete breakpoint N   q: quit")
+
+def show(debugger, fired):
+  vm = debugger.vm
   os.system("clear")
-  print_stack(prev)
+  print_stack(vm.stack)
   for q in print_queue:
-    print(q)
-  print_queue = []
-    
-  print("\n\nProgram finished with no abnormalities")
+    print(value_repr(q))
+  print_queue.clear()
+  for breakpoint in fired:
+    print(f"Breakpoint {debugger.breakpoints.index(breakpoint)}: {breakpoint.spec}")
+  if vm.done:
+    print("\n\nProgram finished with no abnormalities")
+    return
+  op, arg = debugger.current()
+  text = "" if arg is None else f" {arg!r}"
+  print(f"Step {vm.steps}, depth {len(vm.frames)}: next {vm.code.locations[vm.pc]} {op_names[op]}{text}")
+
+def add_breakpoint(debugger, text):
+  spec, _, condition = text.partition(" if ")
+  try:
+    if debugger.add(spec.strip(), condition.strip() or None):
+      return True
+    print(f"No instructions at '{spec.strip()}'")
+  except SyntaxError as e:
+    print(f"Invalid condition '{condition.strip()}': {e.msg}")
+  return False
+
+def debug_program(tree, file="main.stk", breakpoints=()):
+  debugger = Debugger(tree, file)
+  for spec in breakpoints:
+    add_breakpoint(debugger, spec)
+  fired = debugger.resume() if breakpoints else []
+  while True:
+    show(debugger, fired)
+    if debugger.vm.done:
+      return
+    fired = []
+    command = input("> ").strip()
+    if command in ["", "n"]:
+      fired = debugger.step_over()
+    elif command == "s":
+      debugger.step()
+    elif command == "o":
+      fired = debugger.step_out()
+    elif command == "c":
+      fired = debugger.resume()
+    elif command.startswith("b "):
+      if not add_breakpoint(debugger, command[2:]):
+        input("(ENTER)")
+    elif command == "l":
+      for i, breakpoint in enumerate(debugger.breakpoints):
+        condition = f" if {breakpoint.condition}" if breakpoint.condition else ""
+        print(f"{i}: {breakpoint.spec}{condition} ({len(breakpoint.sites)} sites, {breakpoint.hits} hits)")
+      input("(ENTER)")
+    elif command.startswith("d ") and command[2:].strip().isdigit() and int(command[2:]) < len(debugger.breakpoints):
+      debugger.delete(int(command[2:]))
+    elif command == "q":
+      return
+    else:
+      debug_help()
+      input("(ENTER)")
+
+def describe(vm):
+  op, arg = vm.code.ops[vm.pc]
+  text = "" if arg is None else f" {arg!r}"
+  return f"{vm.code.locations[vm.pc]} {op_names[op]}{text}"
+
+def replay_help():
+  print("ENTER/n: next step   p: previous step   +N/-N: move N steps")
+  print("g N: go to step N   e: go to the end   q: quit")
+
+def replay(trace):
+  step = trace.first
+  while True:
+    vm, printed = trace.seek(step)
+    os.system("clear")
+    print_stack(vm.stack)
+    for value in trace.output(printed, 10):
+      print(value_repr(value))
+    status = "program finished" if vm.done else f"next {describe(vm)}"
+    print(f"Step {vm.steps} of {trace.first}..{trace.steps}: {status}")
+    command = input("> ").strip()
+    if command in ["", "n"]:
+      step = vm.steps + 1
+    elif command == "p":
+      step = vm.steps - 1
+    elif command[:1] in "+-" and command[1:].isdigit():
+      step = vm.steps + int(command)
+    elif command.startswith("g ") and command[2:].strip().isdigit():
+      step = int(command[2:])
+    elif command == "e":
+      step = trace.steps
+    elif command == "q":
+      return
+    else:
+      replay_help()
+      input("(ENTER)")
 
 if __name__ == "__main__":
-  with open("main.stk") as f:
-    text = f.read()
+  parser = argparse.ArgumentParser(description="Step through a Stackly program")
+  parser.add_argument("source", nargs="?", default="main.stk")
+  parser.add_argument("--record", action="store_true", help="run at full speed keeping a trace, then replay it")
+  parser.add_argument("--trace", metavar="PATH", help="with --record, save the trace to PATH instead of replaying it")
+  parser.add_argument("--replay", metavar="TRACE", help="replay a saved trace")
+  parser.add_argument("-b", "--break", dest="breakpoints", action="append", default=[], metavar="SPEC", help="start with a breakpoint at FILE:LINE:COL, LINE[:COL] or an op name, optionally followed by 'if CONDITION'; the program runs until it is hit")
+  parser.add_argument("--interval", type=int, default=recorder.INTERVAL, help="steps between checkpoints")
+  parser.add_argument("--ring", type=int, default=recorder.CAPACITY, help="checkpoints kept in memory when not saving, 0 for all")
+  add_optimizer_arguments(parser, 0)
+  args = parser.parse_args()
+  if args.trace and not args.record:
+    parser.error("--trace needs --record")
+  if args.trace and os.path.realpath(args.trace) == os.path.realpath(args.source):
+    parser.error(f"--trace {args.trace} would overwrite the source file")
+
+  if args.replay:
+    trace, _ = recorder.load(args.replay)
+    replay(trace)
+    exit(0)
 
-  tokens = lex("main.stk", text)
+  tokens = list(lex_file(args.source))
   tree, _ = parse_expr(tokens)
   stack = typecheck(tree)
   if stack:
     print(f"{stack.pop().location} TYPE ERROR: Progran finished with unhandled data on the stack")
     exit(1)
-  debug_program(tree)
+  tree, stats = optimize(tree, args.level)
+  if args.opt_stats:
+    print(f"{args.source}: optimizer {stats}", file=sys.stderr)
+  if not args.record:
+    debug_program(tree, args.source, args.breakpoints)
+  elif args.trace:
+    trace = recorder.record(args.source, lower(tree), lambda v: standard.output.write(value_repr(v) + "\n"), args.interval, 0)
+    trace.level = args.level
+    standard.output.flush()
+    recorder.save(trace, args.trace, args.source)
+    print(f"Recorded {trace.steps} steps in {len(trace.checkpoints)} checkpoints to {args.trace}")
+  else:
+    trace = recorder.record(args.source, lower(tree), lambda v: None, args.interval, args.ring)
+    standard.output.flush()
+    replay(trace)
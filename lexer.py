@@ -1,6 +1,8 @@
 from dataclasses import dataclass
 from enum import Enum, auto
+import mmap
 import re
+import sys
 
 class TokenType(Enum):
   Int = auto()
@@ -10,16 +12,35 @@ class TokenType(Enum):
   CloseQuote = auto()
   OpenBracket = auto()
   CloseBracket = auto()
+  String = auto()
+
+# Line and column share one int: the column takes the low COL_BITS bits, so
+# a line may be up to 4 GiB long. The flat AST stores the int in 64 bits.
+COL_BITS = 32
 
-@dataclass
 class Location:
-  file: str
-  line: int
-  col: int
+  __slots__ = ("file", "pos")
+  def __init__(self, file: str, line: int, col: int):
+    if col >> COL_BITS:
+      raise ValueError(f"{file}:{line}: column {col} does not fit in {COL_BITS} bits")
+    self.file = file
+    self.pos = line << COL_BITS | col
+  @property
+  def line(self):
+    return self.pos >> COL_BITS
+  @property
+  def col(self):
+    return self.pos & ((1 << COL_BITS) - 1)
+  def __eq__(self, other):
+    return isinstance(other, Location) and self.file == other.file and self.pos == other.pos
+  def __hash__(self):
+    return hash((self.file, self.pos))
+  def __reduce__(self):
+    return (Location, (self.file, self.line, self.col))
   def __repr__(self):
     return f"{self.file}:{self.line}:{self.col}:"
 
-@dataclass
+@dataclass(slots=True)
 class Token:
   type: TokenType
   value: str
@@ -27,61 +48,94 @@ class Token:
   def __repr__(self):
     return f"[{self.type.name}:'{self.value}']"
 
-def lex(file: str, code: str) -> list[Token]:
-  tokens = []
-  int_p = r"^(\d+)"
+# One alternative per token kind, tried in the same order as the original
+# chain of `re.findall` checks, so the first matching group decides the kind.
+token_pattern = r"""
+  (?P<ws>[ \t\r]+)
+| (?P<nl>\n)
+| (?P<comment>;.*)
+| (?P<Int>\d+)
+| '(?P<Char>[^'])'
+| "(?P<String>[^"\n]*)"
+| (?P<Word>[^\s\d{}\[\]]+)
+| (?P<OpenQuote>\{)
+| (?P<CloseQuote>\})
+| (?P<OpenBracket>\[)
+| (?P<CloseBracket>\])
+"""
+
+pattern = re.compile(token_pattern, re.VERBOSE)
+
+# lex_file decodes a mapped file a chunk at a time. A chunk ends after a
+# newline that no token can span, which is any newline not preceded by a
+# quote (only a Char literal like '\n' holds one), so the chunks lex exactly
+# like the whole text and never split a UTF-8 sequence.
+CHUNK_SIZE = 1 << 20
+
+token_types = {
+  "Int": TokenType.Int,
+  "Char": TokenType.Char,
+  "Word": TokenType.Word,
+  "OpenQuote": TokenType.OpenQuote,
+  "CloseQuote": TokenType.CloseQuote,
+  "OpenBracket": TokenType.OpenBracket,
+  "CloseBracket": TokenType.CloseBracket,
+  "String": TokenType.String,
+}
+
+def scan(file, chunks):
+  intern = sys.intern
+  file = intern(file)
+  match = pattern.match
   line = 1
   col = 1
-  while code:
-    if ws := re.findall(r"^([ \t]+)", code):
-      col += len(ws[0])
-      code = code[len(ws[0]):]
-      continue
-    if re.findall(r"^(\n)", code):
-      col = 1
-      line += 1
-      code = code[1:]
-      continue
-    if c := re.findall(r"^(;.*)", code):
-      col += len(c[0])
-      code = code[len(c[0]):]
-      continue
-    loc = Location(file, line, col)
-    if n := re.findall(int_p, code):
-      col += len(n[0])
-      code = code[len(n[0]):]
-      tokens.append(Token(TokenType.Int, n[0], loc))
-      continue
-    if c := re.findall(r"^'([^'])'", code):
-      col += len(c[0]) + 2
-      code = code[len(c[0])+2:]
-      tokens.append(Token(TokenType.Char, c[0], loc))
-      continue
-    if w := re.findall(r"^([^\s\d{}\[\]]+)", code):
-      col += len(w[0])
-      code = code[len(w[0]):]
-      tokens.append(Token(TokenType.Word, w[0], loc))
-      continue
-    if re.findall(r"^(\{)", code):
-      col += 1
-      code = code[1:]
-      tokens.append(Token(TokenType.OpenQuote, "{", loc))
-      continue
-    if re.findall(r"^(\})", code):
-      col += 1
-      code = code[1:]
-      tokens.append(Token(TokenType.CloseQuote, "}", loc))
-      continue
-    if re.findall(r"^(\[)", code):
-      col += 1
-      code = code[1:]
-      tokens.append(Token(TokenType.OpenBracket, "[", loc))
-      continue
-    if re.findall(r"^(\])", code):
-      col += 1
-      code = code[1:]
-      tokens.append(Token(TokenType.CloseBracket, "]", loc))
-      continue
-  
-  return tokens
+  for code in chunks:
+    pos = 0
+    end = len(code)
+    while pos < end:
+      m = match(code, pos)
+      if not m:
+        print(f"{Location(file, line, col)} LEX ERROR: Unexpected character: {code[pos]!r}")
+        exit(1)
+      kind = m.lastgroup
+      pos = m.end()
+      if kind == "nl":
+        line += 1
+        col = 1
+        continue
+      text = m.group(kind)
+      if kind == "ws" or kind == "comment":
+        col += len(text)
+        continue
+      if kind == "Word":
+        text = intern(text)
+      if kind == "Char" or kind == "String":
+        yield Token(token_types[kind], text, Location(file, line, col))
+        col += len(text) + 2
+        continue
+      yield Token(token_types[kind], text, Location(file, line, col))
+      col += len(text)
+
+def lex_iter(file: str, code: str):
+  return scan(file, [code])
+
+def lex(file: str, code: str) -> list[Token]:
+  return list(lex_iter(file, code))
+
+def chunks(data):
+  start = 0
+  size = len(data)
+  while start < size:
+    end = data.find(b"\n", start + CHUNK_SIZE)
+    while end > 0 and data[end - 1] == ord("'"):
+      end = data.find(b"\n", end + 1)
+    end = size if end < 0 else end + 1
+    yield data[start:end].decode()
+    start = end
 
+def lex_file(path: str):
+  with open(path, "rb") as f:
+    if not f.seek(0, 2):
+      return
+    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+      yield from scan(path, chunks(data))
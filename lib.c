@@ -0,0 +1,251 @@
+#include <inttypes.h>
+#include <stdio.h>
+#include <stdlib.h>
+#include "lib.h"
+
+static void *allocate(size_t size) {
+  void *memory = malloc(size);
+  if (!memory) {
+    fprintf(stderr, "Out of memory\n");
+    exit(1);
+  }
+  return memory;
+}
+
+void init_stack(Stack *stack) {
+  stack->top = 0;
+  stack->capacity = STACK_CAPACITY;
+  stack->elements = allocate(sizeof(Data) * STACK_CAPACITY);
+}
+
+void push(Stack *stack, Data elem) {
+  if (stack->top == stack->capacity) {
+    stack->capacity *= 2;
+    stack->elements = realloc(stack->elements, sizeof(Data) * stack->capacity);
+    if (!stack->elements) {
+      fprintf(stderr, "Out of memory\n");
+      exit(1);
+    }
+  }
+  stack->elements[stack->top++] = elem;
+}
+
+Data pop(Stack *stack) {
+  if (stack->top == 0) {
+    fprintf(stderr, "Stack underflow\n");
+    exit(1);
+  }
+  return stack->elements[--stack->top];
+}
+
+static Data *peek(Stack *stack) {
+  if (stack->top == 0) {
+    fprintf(stderr, "Stack underflow\n");
+    exit(1);
+  }
+  return &stack->elements[stack->top - 1];
+}
+
+void free_stack(Stack *stack) {
+  free(stack->elements);
+  stack->elements = NULL;
+  stack->top = 0;
+  stack->capacity = 0;
+}
+
+void push_int(Stack *stack, int64_t elem) {
+  push(stack, (Data){.type = TYPE_INT, .int_value = elem});
+}
+
+void push_bool(Stack *stack, int elem) {
+  push(stack, (Data){.type = TYPE_BOOL, .bool_value = elem != 0});
+}
+
+void push_char(Stack *stack, int32_t elem) {
+  push(stack, (Data){.type = TYPE_CHAR, .char_value = elem});
+}
+
+static List *prepend(Data head, List *tail) {
+  List *list = allocate(sizeof(List));
+  list->head = head;
+  list->tail = tail;
+  list->size = tail ? tail->size + 1 : 1;
+  return list;
+}
+
+// Turns the stack a list literal was built on into a list and frees it.
+void push_list(Stack *stack, Stack *elem) {
+  List *list = NULL;
+  for (int i = elem->top - 1; i >= 0; i--) {
+    list = prepend(elem->elements[i], list);
+  }
+  free_stack(elem);
+  free(elem);
+  push(stack, (Data){.type = TYPE_LIST, .list_value = list});
+}
+
+void push_quote(Stack *stack, void (*elem)(Stack *)) {
+  push(stack, (Data){.type = TYPE_QUOTE, .quote_value = elem});
+}
+
+#define INT_OPERATION(name, result, field, op) \
+  void name##_operation(Stack *stack) {        \
+    int64_t b = pop(stack).int_value;          \
+    Data *a = peek(stack);                     \
+    a->type = result;                          \
+    a->field = a->int_value op b;              \
+  }
+
+INT_OPERATION(add, TYPE_INT, int_value, +)
+INT_OPERATION(sub, TYPE_INT, int_value, -)
+INT_OPERATION(mul, TYPE_INT, int_value, *)
+INT_OPERATION(div, TYPE_INT, int_value, /)
+INT_OPERATION(lt, TYPE_BOOL, bool_value, <)
+INT_OPERATION(gt, TYPE_BOOL, bool_value, >)
+INT_OPERATION(lte, TYPE_BOOL, bool_value, <=)
+INT_OPERATION(gte, TYPE_BOOL, bool_value, >=)
+
+void add_const_operation(Stack *stack, int64_t k) {
+  peek(stack)->int_value += k;
+}
+
+void sub_const_operation(Stack *stack, int64_t k) {
+  peek(stack)->int_value -= k;
+}
+
+void dup_lt_const_operation(Stack *stack, int64_t k) {
+  push_bool(stack, peek(stack)->int_value < k);
+}
+
+static int data_equal(Data a, Data b) {
+  if (a.type != b.type) {
+    return 0;
+  }
+  switch (a.type) {
+  case TYPE_INT:
+    return a.int_value == b.int_value;
+  case TYPE_BOOL:
+    return a.bool_value == b.bool_value;
+  case TYPE_CHAR:
+    return a.char_value == b.char_value;
+  case TYPE_QUOTE:
+    return a.quote_value == b.quote_value;
+  case TYPE_LIST: {
+    List *x = a.list_value;
+    List *y = b.list_value;
+    if ((x ? x->size : 0) != (y ? y->size : 0)) {
+      return 0;
+    }
+    for (; x != y; x = x->tail, y = y->tail) {
+      if (!data_equal(x->head, y->head)) {
+        return 0;
+      }
+    }
+    return 1;
+  }
+  }
+  return 0;
+}
+
+void eq_operation(Stack *stack) {
+  Data b = pop(stack);
+  Data a = pop(stack);
+  push_bool(stack, data_equal(a, b));
+}
+
+void not_operation(Stack *stack) {
+  Data *a = peek(stack);
+  a->bool_value = !a->bool_value;
+}
+
+void dup_operation(Stack *stack) {
+  push(stack, *peek(stack));
+}
+
+void cons_operation(Stack *stack) {
+  List *list = pop(stack).list_value;
+  Data *elem = peek(stack);
+  *elem = (Data){.type = TYPE_LIST, .list_value = prepend(*elem, list)};
+}
+
+static void print_char(int32_t c) {
+  if (c < 0x80) {
+    putchar(c);
+  } else if (c < 0x800) {
+    putchar(0xc0 | c >> 6);
+    putchar(0x80 | (c & 0x3f));
+  } else if (c < 0x10000) {
+    putchar(0xe0 | c >> 12);
+    putchar(0x80 | (c >> 6 & 0x3f));
+    putchar(0x80 | (c & 0x3f));
+  } else {
+    putchar(0xf0 | c >> 18);
+    putchar(0x80 | (c >> 12 & 0x3f));
+    putchar(0x80 | (c >> 6 & 0x3f));
+    putchar(0x80 | (c & 0x3f));
+  }
+}
+
+static void print_data(Data data, int nested) {
+  switch (data.type) {
+  case TYPE_INT:
+    printf("%" PRId64, data.int_value);
+    break;
+  case TYPE_BOOL:
+    fputs(data.bool_value ? "True" : "False", stdout);
+    break;
+  case TYPE_CHAR:
+    if (!nested) {
+      putchar('\'');
+    }
+    print_char(data.char_value);
+    if (!nested) {
+      putchar('\'');
+    }
+    break;
+  case TYPE_QUOTE:
+    printf("<quote %p>", (void *)data.quote_value);
+    break;
+  case TYPE_LIST:
+    putchar('[');
+    for (List *list = data.list_value; list; list = list->tail) {
+      if (list != data.list_value) {
+        putchar(' ');
+      }
+      print_data(list->head, 1);
+    }
+    putchar(']');
+    break;
+  }
+}
+
+void print_operation(Stack *stack) {
+  print_data(pop(stack), 0);
+  putchar('\n');
+}
+
+void eval_operation(Stack *stack) {
+  pop(stack).quote_value(stack);
+}
+
+void if_operation(Stack *stack) {
+  void (*otherwise)(Stack *) = pop(stack).quote_value;
+  void (*then)(Stack *) = pop(stack).quote_value;
+  if (pop(stack).bool_value) {
+    then(stack);
+  } else {
+    otherwise(stack);
+  }
+}
+
+void while_operation(Stack *stack) {
+  void (*body)(Stack *) = pop(stack).quote_value;
+  void (*cond)(Stack *) = pop(stack).quote_value;
+  for (;;) {
+    cond(stack);
+    if (!pop(stack).bool_value) {
+      break;
+    }
+    body(stack);
+  }
+}
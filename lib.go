@@ -4,10 +4,35 @@ import (
 	"bufio"
 	"fmt"
 	"os"
+	"runtime"
+	"strconv"
+	"strings"
+	"sync"
+	"sync/atomic"
+	"unicode/utf8"
 )
 
-var writer = bufio.NewWriter(os.Stdout)
-var print_counter = 0
+// Output and input are buffered in blocks of $STACKLY_BUFFER bytes, 64 KiB
+// by default. Output is written when the buffer fills, on flush and at exit.
+var writer = bufio.NewWriterSize(os.Stdout, bufferSize())
+var reader = bufio.NewReaderSize(os.Stdin, bufferSize())
+
+func bufferSize() int {
+	if n, err := strconv.Atoi(os.Getenv("STACKLY_BUFFER")); err == nil && n > 0 {
+		return n
+	}
+	return 1 << 16
+}
+
+// pmap runs on $STACKLY_WORKERS goroutines, one per CPU by default.
+var workers = workerCount()
+
+func workerCount() int {
+	if n, err := strconv.Atoi(os.Getenv("STACKLY_WORKERS")); err == nil && n > 0 {
+		return n
+	}
+	return runtime.NumCPU()
+}
 
 func Add(s []interface{}) []interface{} {
 	b := s[len(s)-1]
@@ -15,6 +40,20 @@ func Add(s []interface{}) []interface{} {
 	return append(s[:len(s)-2], a.(int)+b.(int))
 }
 
+func AddConst(s []interface{}, k int) []interface{} {
+	s[len(s)-1] = s[len(s)-1].(int) + k
+	return s
+}
+
+func SubConst(s []interface{}, k int) []interface{} {
+	s[len(s)-1] = s[len(s)-1].(int) - k
+	return s
+}
+
+func DupLtConst(s []interface{}, k int) []interface{} {
+	return append(s, s[len(s)-1].(int) < k)
+}
+
 func Sub(s []interface{}) []interface{} {
 	b := s[len(s)-1]
 	a := s[len(s)-2]
@@ -33,21 +72,315 @@ func Div(s []interface{}) []interface{} {
 	return append(s[:len(s)-2], a.(int)/b.(int))
 }
 
-func Print(s []interface{}) []interface{} {
-	a := s[len(s)-1]
+func PrintValue(a interface{}) {
 	fmt.Fprintf(writer, "%v\n", a)
-	print_counter += 1
-	if print_counter > 100000 {
+}
+
+func PrintInt(a int) {
+	writer.WriteString(strconv.Itoa(a))
+	writer.WriteByte('\n')
+}
+
+func PrintBool(a bool) {
+	writer.WriteString(strconv.FormatBool(a))
+	writer.WriteByte('\n')
+}
+
+func Print(s []interface{}) []interface{} {
+	PrintValue(s[len(s)-1])
+	return s[:len(s)-1]
+}
+
+// List is an immutable cons list; nil is the empty list. Prepend shares the
+// tail, so building a list with <: is linear.
+type List struct {
+	head interface{}
+	tail *List
+	size int
+}
+
+func (l *List) Len() int {
+	if l == nil {
+		return 0
+	}
+	return l.size
+}
+
+func Prepend(head interface{}, tail *List) *List {
+	return &List{head, tail, tail.Len() + 1}
+}
+
+// The cells of a list built at once share one allocation.
+func ListOf(items []interface{}) *List {
+	if len(items) == 0 {
+		return nil
+	}
+	cells := make([]List, len(items))
+	for i, item := range items {
+		cells[i] = List{item, nil, len(items) - i}
+		if i > 0 {
+			cells[i-1].tail = &cells[i]
+		}
+	}
+	return &cells[0]
+}
+
+func (l *List) String() string {
+	var b strings.Builder
+	b.WriteByte('[')
+	for n := l; n != nil; n = n.tail {
+		if n != l {
+			b.WriteByte(' ')
+		}
+		fmt.Fprintf(&b, "%v", n.head)
+	}
+	b.WriteByte(']')
+	return b.String()
+}
+
+func RangeList(n int) *List {
+	var l *List
+	for i := n - 1; i >= 0; i-- {
+		l = &List{i, l, n - i}
+	}
+	return l
+}
+
+func SumList(l *List) int {
+	total := 0
+	for n := l; n != nil; n = n.tail {
+		total += n.head.(int)
+	}
+	return total
+}
+
+// The quotes given to map, filter and fold only see the values passed to
+// them, so every call runs on a small scratch stack that is reused.
+func MapList(l *List, q func([]interface{}) []interface{}) *List {
+	items := make([]interface{}, 0, l.Len())
+	scratch := make([]interface{}, 0, 4)
+	for n := l; n != nil; n = n.tail {
+		scratch = q(append(scratch[:0], n.head))
+		items = append(items, scratch[0])
+	}
+	return ListOf(items)
+}
+
+func FilterList(l *List, q func([]interface{}) []interface{}) *List {
+	items := make([]interface{}, 0, l.Len())
+	scratch := make([]interface{}, 0, 4)
+	for n := l; n != nil; n = n.tail {
+		scratch = q(append(scratch[:0], n.head))
+		if scratch[0].(bool) {
+			items = append(items, n.head)
+		}
+	}
+	return ListOf(items)
+}
+
+func FoldList(l *List, acc interface{}, q func([]interface{}) []interface{}) interface{} {
+	scratch := make([]interface{}, 0, 4)
+	for n := l; n != nil; n = n.tail {
+		scratch = q(append(scratch[:0], acc, n.head))
+		acc = scratch[0]
+	}
+	return acc
+}
+
+// The quote given to pmap is pure, so copies of it can run at once. Each
+// worker claims a chunk of elements at a time and calls the quote on a stack
+// of its own; results are stored at their element's index to keep the order.
+func PMapList(l *List, q func([]interface{}) []interface{}) *List {
+	items := make([]interface{}, 0, l.Len())
+	for n := l; n != nil; n = n.tail {
+		items = append(items, n.head)
+	}
+	if len(items) == 0 {
+		return nil
+	}
+	results := make([]interface{}, len(items))
+	count := min(workers, len(items))
+	chunk := max(len(items)/(count*4), 1)
+	var next int64
+	var wg sync.WaitGroup
+	for w := 0; w < count; w++ {
+		wg.Add(1)
+		go func() {
+			defer wg.Done()
+			scratch := make([]interface{}, 0, 4)
+			for {
+				end := int(atomic.AddInt64(&next, int64(chunk)))
+				start := end - chunk
+				if start >= len(items) {
+					return
+				}
+				for i := start; i < min(end, len(items)); i++ {
+					scratch = q(append(scratch[:0], items[i]))
+					results[i] = scratch[0]
+				}
+			}
+		}()
+	}
+	wg.Wait()
+	return ListOf(results)
+}
+
+func Range(s []interface{}) []interface{} {
+	s[len(s)-1] = RangeList(s[len(s)-1].(int))
+	return s
+}
+
+func Len(s []interface{}) []interface{} {
+	s[len(s)-1] = s[len(s)-1].(*List).Len()
+	return s
+}
+
+func Sum(s []interface{}) []interface{} {
+	s[len(s)-1] = SumList(s[len(s)-1].(*List))
+	return s
+}
+
+func Map(s []interface{}) []interface{} {
+	q := s[len(s)-1].(func([]interface{}) []interface{})
+	s = s[:len(s)-1]
+	s[len(s)-1] = MapList(s[len(s)-1].(*List), q)
+	return s
+}
+
+func Filter(s []interface{}) []interface{} {
+	q := s[len(s)-1].(func([]interface{}) []interface{})
+	s = s[:len(s)-1]
+	s[len(s)-1] = FilterList(s[len(s)-1].(*List), q)
+	return s
+}
+
+func PMap(s []interface{}) []interface{} {
+	q := s[len(s)-1].(func([]interface{}) []interface{})
+	s = s[:len(s)-1]
+	s[len(s)-1] = PMapList(s[len(s)-1].(*List), q)
+	return s
+}
+
+func Fold(s []interface{}) []interface{} {
+	q := s[len(s)-1].(func([]interface{}) []interface{})
+	acc := s[len(s)-2]
+	s = s[:len(s)-2]
+	s[len(s)-1] = FoldList(s[len(s)-1].(*List), acc, q)
+	return s
+}
+
+// At the end of the input NextLine gives an empty line, NextChar a NUL and
+// NextInt 0; AtEof tells them apart from real input.
+func NextLine() *List {
+	line, err := reader.ReadString('\n')
+	if err == nil {
+		line = line[:len(line)-1]
+	}
+	if line == "" {
+		return nil
+	}
+	cells := make([]List, utf8.RuneCountInString(line))
+	i := 0
+	for _, r := range line {
+		cells[i] = List{r, nil, len(cells) - i}
+		if i > 0 {
+			cells[i-1].tail = &cells[i]
+		}
+		i++
+	}
+	return &cells[0]
+}
+
+func NextChar() rune {
+	r, _, err := reader.ReadRune()
+	if err != nil {
+		return 0
+	}
+	return r
+}
+
+func isSpace(b byte) bool {
+	return b == ' ' || b == '\n' || b == '\t' || b == '\r' || b == '\v' || b == '\f'
+}
+
+func NextInt() int {
+	b, err := reader.ReadByte()
+	for err == nil && isSpace(b) {
+		b, err = reader.ReadByte()
+	}
+	sign := 1
+	if err == nil && b == '-' {
+		sign = -1
+		b, err = reader.ReadByte()
+	}
+	if err != nil {
+		return 0
+	}
+	if b < '0' || b > '9' {
+		token := []byte{b}
+		for next, err := reader.ReadByte(); err == nil && !isSpace(next) && len(token) < 20; next, err = reader.ReadByte() {
+			token = append(token, next)
+		}
+		if sign < 0 {
+			token = append([]byte{'-'}, token...)
+		}
 		writer.Flush()
-		print_counter = 0
+		fmt.Printf("<stdin> INPUT ERROR: Expected an integer, got '%s'\n", token)
+		os.Exit(1)
 	}
+	n := 0
+	for err == nil && b >= '0' && b <= '9' {
+		n = n*10 + int(b-'0')
+		b, err = reader.ReadByte()
+	}
+	if err == nil {
+		reader.UnreadByte()
+	}
+	return sign * n
+}
+
+func AtEof() bool {
+	_, err := reader.Peek(1)
+	return err != nil
+}
+
+func WriteChars(l *List) {
+	for n := l; n != nil; n = n.tail {
+		writer.WriteRune(n.head.(rune))
+	}
+	writer.WriteByte('\n')
+}
+
+func ReadLine(s []interface{}) []interface{} {
+	return append(s, NextLine())
+}
+
+func ReadInt(s []interface{}) []interface{} {
+	return append(s, NextInt())
+}
+
+func ReadChar(s []interface{}) []interface{} {
+	return append(s, NextChar())
+}
+
+func Eof(s []interface{}) []interface{} {
+	return append(s, AtEof())
+}
+
+func WriteLine(s []interface{}) []interface{} {
+	WriteChars(s[len(s)-1].(*List))
 	return s[:len(s)-1]
 }
 
+func Flush(s []interface{}) []interface{} {
+	writer.Flush()
+	return s
+}
+
 func Cons(s []interface{}) []interface{} {
 	b := s[len(s)-1]
 	a := s[len(s)-2]
-	return append(s[:len(s)-2], append([]interface{}{b}, a.([]interface{})...))
+	return append(s[:len(s)-2], Prepend(a, b.(*List)))
 }
 
 func Eval(s []interface{}) []interface{} {
@@ -131,10 +464,30 @@ func Eq(s []interface{}) []interface{} {
 	b := s[len(s)-1]
 	a := s[len(s)-2]
 	s = s[:len(s)-2]
-	s = append(s, a.(int) == b.(int))
+	s = append(s, Equal(a, b))
 	return s
 }
 
+// Lists are equal when their elements are, as in the Python executors.
+func Equal(a, b interface{}) bool {
+	if l, ok := a.(*List); ok {
+		return ListEqual(l, b.(*List))
+	}
+	return a == b
+}
+
+func ListEqual(a, b *List) bool {
+	if a.Len() != b.Len() {
+		return false
+	}
+	for ; a != b; a, b = a.tail, b.tail {
+		if !Equal(a.head, b.head) {
+			return false
+		}
+	}
+	return true
+}
+
 func Not(s []interface{}) []interface{} {
 	a := s[len(s)-1]
 	s = s[:len(s)-1]
@@ -2,10 +2,12 @@
 #define LIB_H
 
 #include <stddef.h>
+#include <stdint.h>
 
 #define STACK_CAPACITY 100
 
 typedef struct Stack Stack;
+typedef struct List List;
 
 typedef enum {
   TYPE_INT,
@@ -15,20 +17,29 @@ typedef enum {
   TYPE_QUOTE
 } DataType;
 
-
+// Two words: a one-byte tag and a 64-bit payload. Ints are 64 bits and chars
+// are Unicode code points, as in the other backends.
 typedef struct {
-  DataType type;
+  uint8_t type;
   union {
-    int int_value;
+    int64_t int_value;
     int bool_value;
-    char char_value;
-    Stack *list_value;
+    int32_t char_value;
+    List *list_value;
     void (*quote_value)(Stack *);
   };
 } Data;
 
+// An immutable cons list; NULL is the empty list. Cons shares the tail.
+struct List {
+  Data head;
+  List *tail;
+  size_t size;
+};
+
 struct Stack {
   int top;
+  int capacity;
   Data *elements;
 };
 
@@ -36,14 +47,29 @@ void init_stack(Stack *stack);
 void push(Stack *stack, Data elem);
 Data pop(Stack *stack);
 void free_stack(Stack *stack);
-void push_int(Stack *stack, int elem);
+void push_int(Stack *stack, int64_t elem);
 void push_bool(Stack *stack, int elem);
-void push_char(Stack *stack, char elem);
+void push_char(Stack *stack, int32_t elem);
 void push_list(Stack *stack, Stack *elem);
 void push_quote(Stack *stack, void (*elem)(Stack *));
 void add_operation(Stack *stack);
+void sub_operation(Stack *stack);
+void mul_operation(Stack *stack);
+void div_operation(Stack *stack);
+void lt_operation(Stack *stack);
+void gt_operation(Stack *stack);
+void lte_operation(Stack *stack);
+void gte_operation(Stack *stack);
+void eq_operation(Stack *stack);
+void not_operation(Stack *stack);
+void dup_operation(Stack *stack);
 void cons_operation(Stack *stack);
 void print_operation(Stack *stack);
 void eval_operation(Stack *stack);
+void if_operation(Stack *stack);
+void while_operation(Stack *stack);
+void add_const_operation(Stack *stack, int64_t k);
+void sub_const_operation(Stack *stack, int64_t k);
+void dup_lt_const_operation(Stack *stack, int64_t k);
 
 #endif // LIB_H
@@ -0,0 +1,165 @@
+from dataclasses import dataclass
+from lexer import lex, Location
+from parsing import Tree, TreeType, parse_expr, macro_env, flatten, expand
+from typechecker import infer_effect, macro_effects
+import hashlib
+import os
+import pickle
+import re
+
+VERSION = 5
+MAGIC = b"STKM"
+
+@dataclass
+class Module:
+  path: str
+  digest: str
+  deps: list
+  macros: dict
+  effects: dict
+  body: Tree
+
+modules = {}
+initialized = set()
+building = []
+
+def source_digest(source: bytes):
+  return hashlib.sha256(source + f"\0{VERSION}".encode()).hexdigest()[:16]
+
+def file_digest(path):
+  try:
+    with open(path, "rb") as f:
+      return source_digest(f.read())
+  except OSError:
+    return None
+
+def stale(deps):
+  return any(file_digest(path) != digest for path, digest in deps)
+
+def dependencies():
+  return sorted((module.path, module.digest) for module in modules.values())
+
+def artifact_path(path, digest):
+  directory = os.path.join(os.path.dirname(path), "__pycache__")
+  return os.path.join(directory, f"{os.path.basename(path)}.{digest}.stkm")
+
+# Removes the other cached versions of path in the same directory, such as
+# those left by earlier edits of the source.
+def prune(path):
+  directory, name = os.path.split(path)
+  stem, digest, suffix = name.rsplit(".", 2)
+  pattern = re.compile(re.escape(stem) + r"\.[0-9a-f]{16}\." + re.escape(suffix))
+  for other in os.listdir(directory):
+    if other != name and pattern.fullmatch(other):
+      try:
+        os.remove(os.path.join(directory, other))
+      except OSError:
+        pass
+
+def header(digest):
+  return MAGIC + bytes([VERSION]) + digest.encode()
+
+def read_artifact(path, digest):
+  artifact = artifact_path(path, digest)
+  if not os.path.exists(artifact):
+    return None
+  with open(artifact, "rb") as f:
+    data = f.read()
+  if not data.startswith(header(digest)):
+    return None
+  try:
+    deps, names, effects, flat = pickle.loads(data[len(header(digest)):])
+  except Exception:
+    return None
+  body, *trees = expand(flat)
+  return Module(path, digest, deps, dict(zip(names, trees)), effects, body)
+
+def write_artifact(module):
+  artifact = artifact_path(module.path, module.digest)
+  try:
+    os.makedirs(os.path.dirname(artifact), exist_ok=True)
+    with open(artifact + ".tmp", "wb") as f:
+      names = list(module.macros)
+      flat = flatten([module.body] + [module.macros[name] for name in names])
+      data = (module.deps, names, module.effects, flat)
+      f.write(header(module.digest) + pickle.dumps(data, pickle.HIGHEST_PROTOCOL))
+    os.replace(artifact + ".tmp", artifact)
+    prune(artifact)
+  except OSError:
+    pass
+
+def defined_elsewhere(name, tree):
+  return any(module.macros.get(name) is tree for module in modules.values())
+
+def build(path, source, digest):
+  outside = dict(macro_env)
+  macro_env.clear()
+  building.append((path, []))
+  body, _ = parse_expr(lex(path, source.decode()))
+  _, deps = building.pop()
+  macros = {
+    name: tree for name, tree in macro_env.items()
+    if not defined_elsewhere(name, tree)
+  }
+  macro_env.clear()
+  macro_env.update(outside)
+  effects = {name: infer_effect(tree) for name, tree in macros.items()}
+  module = Module(path, digest, deps, macros, effects, body)
+  write_artifact(module)
+  return module
+
+def install(module):
+  for dep, _ in module.deps:
+    install(modules[dep])
+  macro_env.update(module.macros)
+  for name, tree in module.macros.items():
+    if module.effects.get(name) is not None:
+      macro_effects[id(tree)] = (tree, module.effects[name])
+  modules[module.path] = module
+
+def load(path, location):
+  if path in modules:
+    return modules[path]
+  if any(path == p for p, _ in building):
+    print(f"{location} PARSE ERROR: Circular import of '{os.path.relpath(path)}'")
+    exit(1)
+  if not os.path.isfile(path):
+    print(f"{location} PARSE ERROR: Cannot import '{os.path.relpath(path)}': no such file")
+    exit(1)
+  with open(path, "rb") as f:
+    source = f.read()
+  digest = source_digest(source)
+  module = read_artifact(path, digest)
+  if module is not None:
+    dep_location = Location(path, 1, 1)
+    for dep, dep_digest in module.deps:
+      if load(dep, dep_location).digest != dep_digest:
+        module = None
+        break
+  if module is None:
+    module = build(path, source, digest)
+  install(module)
+  return module
+
+def initialize(module, nodes):
+  if module.path in initialized:
+    return
+  initialized.add(module.path)
+  for dep, _ in module.deps:
+    initialize(modules[dep], nodes)
+  nodes.append(module.body)
+
+# Modules are built in isolation: a module only sees its own macros and those
+# of the modules it imports, and importing it makes all of them visible. The
+# top-level code of every module runs once, dependencies first, at the first
+# import from a program.
+def import_module(name, location):
+  base = os.path.dirname(location.file) if os.path.isfile(location.file) else ""
+  path = os.path.abspath(os.path.join(base, name))
+  module = load(path, location)
+  if building:
+    building[-1][1].append((module.path, module.digest))
+    return Tree(TreeType.Noop, (), location)
+  nodes = []
+  initialize(module, nodes)
+  return Tree(TreeType.Expr, nodes, location)
@@ -0,0 +1,193 @@
+from parsing import Tree, TreeType
+from dataclasses import dataclass
+import argparse
+
+@dataclass
+class OptStats:
+  removed: int = 0
+  folded: int = 0
+  fused: int = 0
+  inlined: int = 0
+  def __repr__(self):
+    return f"removed {self.removed}, folded {self.folded}, fused {self.fused}, inlined {self.inlined} nodes"
+
+literal_types = [TreeType.PushInt, TreeType.PushBool, TreeType.PushChar]
+
+int_folds = {
+  TreeType.Add: lambda a, b: a + b,
+  TreeType.Sub: lambda a, b: a - b,
+  TreeType.Mul: lambda a, b: a * b,
+  TreeType.Div: lambda a, b: a // b if (a < 0) == (b < 0) else -(-a // b),
+  TreeType.Lt: lambda a, b: a < b,
+  TreeType.Gt: lambda a, b: a > b,
+  TreeType.Lte: lambda a, b: a <= b,
+  TreeType.Gte: lambda a, b: a >= b,
+}
+
+fusions = {
+  TreeType.Add: TreeType.AddConst,
+  TreeType.Sub: TreeType.SubConst,
+}
+
+def literal(value, location):
+  if isinstance(value, bool):
+    return Tree(TreeType.PushBool, ("True" if value else "False",), location)
+  return Tree(TreeType.PushInt, (value,), location)
+
+def is_int(node):
+  return node.type == TreeType.PushInt
+
+def fold(out, node, stats):
+  if node.type in int_folds and len(out) >= 2 and is_int(out[-2]) and is_int(out[-1]):
+    if node.type == TreeType.Div and out[-1].nodes[0] == 0:
+      return False
+    value = int_folds[node.type](out[-2].nodes[0], out[-1].nodes[0])
+    location = out[-2].location
+    del out[-2:]
+    out.append(literal(value, location))
+    stats.folded += 2
+    return True
+  if node.type == TreeType.Eq and len(out) >= 2 and out[-2].type in literal_types and out[-2].type == out[-1].type:
+    value = out[-2].nodes[0] == out[-1].nodes[0]
+    location = out[-2].location
+    del out[-2:]
+    out.append(literal(value, location))
+    stats.folded += 2
+    return True
+  if node.type == TreeType.Not and out and out[-1].type == TreeType.PushBool:
+    value = out[-1].nodes[0] != "True"
+    out[-1] = literal(value, out[-1].location)
+    stats.folded += 1
+    return True
+  if node.type == TreeType.Dup and out and out[-1].type in literal_types:
+    out.append(Tree(out[-1].type, out[-1].nodes, node.location))
+    return True
+  return False
+
+def fuse(out, node, stats):
+  if node.type in fusions and out and is_int(out[-1]):
+    out[-1] = Tree(fusions[node.type], out[-1].nodes, out[-1].location)
+    stats.fused += 1
+    return True
+  if node.type == TreeType.Lt and len(out) >= 2 and is_int(out[-1]) and out[-2].type == TreeType.Dup:
+    location = out[-2].location
+    value = out[-1].nodes
+    del out[-2:]
+    out.append(Tree(TreeType.DupLtConst, value, location))
+    stats.fused += 2
+    return True
+  return False
+
+def optimize_nodes(nodes, level, stats, memo):
+  out = []
+  pending = list(reversed(nodes))
+  while pending:
+    node = pending.pop()
+    if node.type == TreeType.Expr:
+      pending.extend(reversed(node.nodes))
+      continue
+    if node.type in [TreeType.Noop, TreeType.PrintType]:
+      stats.removed += 1
+      continue
+    if node.type in [TreeType.PushQuote, TreeType.PushList]:
+      out.append(Tree(node.type, (optimize_tree(node.nodes[0], level, stats, memo),), node.location))
+      continue
+    if fold(out, node, stats):
+      continue
+    if level >= 2 and node.type == TreeType.Eval and out and out[-1].type == TreeType.PushQuote:
+      body = out.pop().nodes[0]
+      pending.extend(reversed(body.nodes))
+      stats.inlined += 1
+      continue
+    if level >= 2 and fuse(out, node, stats):
+      continue
+    out.append(node)
+  return out
+
+def optimize_tree(tree, level, stats, memo):
+  if id(tree) in memo:
+    return memo[id(tree)]
+  result = Tree(TreeType.Expr, optimize_nodes(tree.nodes, level, stats, memo), tree.location)
+  memo[id(tree)] = result
+  memo[id(result)] = result
+  return result
+
+def optimize(tree: Tree, level=1):
+  stats = OptStats()
+  if level <= 0:
+    return tree, stats
+  if tree.type != TreeType.Expr:
+    tree = Tree(TreeType.Expr, [tree], tree.location)
+  return optimize_tree(tree, level, stats, {}), stats
+
+EXPR_LIMIT = 256
+
+int_operands = [
+  TreeType.Add, TreeType.Sub, TreeType.Mul, TreeType.Div,
+  TreeType.Lt, TreeType.Gt, TreeType.Lte, TreeType.Gte,
+]
+
+const_bases = {
+  TreeType.AddConst: TreeType.Add,
+  TreeType.SubConst: TreeType.Sub,
+  TreeType.DupLtConst: TreeType.Lt,
+}
+
+def leaves(tree):
+  if tree.type == TreeType.Expr:
+    for node in tree.nodes:
+      yield from leaves(node)
+  elif tree.type not in [TreeType.Noop, TreeType.PrintType]:
+    yield tree
+
+# The body of a quote given to map or filter as a single expression over the
+# element `name`, if it only uses int literals and operators. `spell` maps each
+# operator to a format string over {a} and {b} in the target language. Returns
+# the expression and the kind ("int" or "bool") the element is used as, which
+# is None when the body never looks at it; or None if the quote has to run.
+def element_expr(tree, spell, name="x"):
+  stack = [(name, None)]
+  used = None
+  def operand(entry, kind):
+    nonlocal used
+    expr, known = entry
+    if known is None and expr == name:
+      used = used or kind
+    return expr
+  for node in leaves(tree):
+    type = node.type
+    if type == TreeType.PushInt:
+      stack.append((str(node.nodes[0]), "int"))
+    elif type == TreeType.Dup and stack:
+      stack.append(stack[-1])
+    elif type in const_bases and stack:
+      base = const_bases[type]
+      a = operand(stack[-1], "int")
+      result = (f"({spell[base].format(a=a, b=node.nodes[0])})", "bool" if base == TreeType.Lt else "int")
+      if type == TreeType.DupLtConst:
+        stack.append(result)
+      else:
+        stack[-1] = result
+    elif type == TreeType.Not and stack:
+      stack[-1] = (f"({spell[type].format(a=operand(stack[-1], 'bool'))})", "bool")
+    elif type in int_operands and len(stack) >= 2:
+      b = operand(stack.pop(), "int")
+      a = operand(stack.pop(), "int")
+      kind = "int" if type in [TreeType.Add, TreeType.Sub, TreeType.Mul, TreeType.Div] else "bool"
+      stack.append((f"({spell[type].format(a=a, b=b)})", kind))
+    elif type == TreeType.Eq and len(stack) >= 2:
+      (b, kb), (a, ka) = stack.pop(), stack.pop()
+      operand((a, ka), kb)
+      operand((b, kb), ka)
+      stack.append((f"({spell[type].format(a=a, b=b)})", "bool"))
+    else:
+      return None
+    if len(stack[-1][0]) > EXPR_LIMIT:
+      return None
+  if len(stack) != 1:
+    return None
+  return stack[0][0], used
+
+def add_arguments(parser, level=1):
+  parser.add_argument("-O", dest="level", type=int, choices=[0, 1, 2], default=level, help="optimization level")
+  parser.add_argument("--opt-stats", action="store_true", help="report what the optimizer removed and fused")
@@ -0,0 +1,43 @@
+# The process pool behind pmap, shared by the Python executors. The list is
+# cut into a few chunks per worker, so that each task carries enough elements
+# to pay for sending it, and the results of the chunks are joined in order.
+# Workers are forked where the platform allows it, so they start with the
+# running program already loaded. $STACKLY_WORKERS sets their number, one per
+# CPU by default.
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+WORKERS = int(os.environ.get("STACKLY_WORKERS", 0)) or os.cpu_count() or 1
+CHUNKS_PER_WORKER = 4
+
+pool = None
+pool_size = 0
+in_worker = False
+
+def enter_worker():
+  global in_worker
+  in_worker = True
+
+def get_pool():
+  global pool, pool_size
+  if pool is None or pool_size != WORKERS:
+    if pool is not None:
+      pool.shutdown()
+    methods = multiprocessing.get_all_start_methods()
+    context = multiprocessing.get_context("fork" if "fork" in methods else None)
+    pool = ProcessPoolExecutor(WORKERS, context, initializer=enter_worker)
+    pool_size = WORKERS
+  return pool
+
+# Calls function(*args, chunk) on chunks of items and returns the concatenated
+# results. A pmap inside a worker runs in that worker.
+def parallel_map(function, items, *args):
+  items = list(items)
+  workers = min(WORKERS, len(items))
+  if workers <= 1 or in_worker:
+    return function(*args, items)
+  size = -(-len(items) // (workers * CHUNKS_PER_WORKER))
+  executor = get_pool()
+  futures = [executor.submit(function, *args, items[i:i + size]) for i in range(0, len(items), size)]
+  return [value for future in futures for value in future.result()]
@@ -1,4 +1,5 @@
-from lexer import lex, Token, TokenType, Location
+from lexer import lex, Token, TokenType, Location, COL_BITS
+from array import array
 from dataclasses import dataclass
 from enum import Enum, auto
 
@@ -28,11 +29,29 @@ class TreeType(Enum):
   While = "while"
   Noop = "noop"
   PrintType = "type?"
+  AddConst = "+ const"
+  SubConst = "- const"
+  DupLtConst = ". const <"
+  Range = "range"
+  Len = "len"
+  Sum = "sum"
+  Map = "map"
+  Filter = "filter"
+  Fold = "fold"
+  ReadLine = "read-line"
+  ReadInt = "read-int"
+  ReadChar = "read-char"
+  Eof = "eof?"
+  WriteLine = "write-line"
+  Flush = "flush"
+  PMap = "pmap"
 
-@dataclass
+# Leaf operators share the empty tuple and single-child nodes use 1-tuples;
+# only Expr nodes keep a list. PushInt holds an int.
+@dataclass(slots=True)
 class Tree:
   type: TreeType
-  nodes: list
+  nodes: tuple
   location: Location
   def __repr__(self):
     if self.type == TreeType.Expr:
@@ -42,98 +61,195 @@ class Tree:
     if self.type == TreeType.PushInt:
       return str(self.nodes[0])
     if self.type.name.startswith("Push"):
-      return str(self.nodes)[1:-1]
-    return f"{self.type.name}{{{self.nodes}}}"
+      return ", ".join(repr(n) for n in self.nodes)
+    return f"{self.type.name}{{{list(self.nodes)}}}"
+
+tree_types = list(TreeType)
+type_index = {type: i for i, type in enumerate(tree_types)}
+
+# A whole file's AST as parallel arrays with one entry per distinct node, so
+# subtrees shared through macros are stored once. Node i's children are
+# edges[offsets[i]:offsets[i + 1]]; literal nodes keep their value in values[i].
+@dataclass(slots=True)
+class FlatTree:
+  files: list
+  types: bytearray
+  values: list
+  file_ids: array
+  positions: array
+  offsets: array
+  edges: array
+  roots: list
+
+def flatten(roots):
+  index = {}
+  order = []
+  work = list(roots)
+  while work:
+    node = work.pop()
+    if id(node) in index:
+      continue
+    index[id(node)] = len(order)
+    order.append(node)
+    work.extend(child for child in node.nodes if isinstance(child, Tree))
+  files = {}
+  flat = FlatTree([], bytearray(), [], array("H"), array("q"), array("l", [0]), array("l"), [])
+  for node in order:
+    flat.types.append(type_index[node.type])
+    flat.file_ids.append(files.setdefault(node.location.file, len(files)))
+    flat.positions.append(node.location.pos)
+    if node.nodes and not isinstance(node.nodes[0], Tree):
+      flat.values.append(node.nodes[0])
+    else:
+      flat.values.append(None)
+      flat.edges.extend(index[id(child)] for child in node.nodes)
+    flat.offsets.append(len(flat.edges))
+  flat.files = list(files)
+  flat.roots = [index[id(root)] for root in roots]
+  return flat
+
+def expand(flat):
+  locations = {}
+  trees = []
+  for type, file_id, pos in zip(flat.types, flat.file_ids, flat.positions):
+    location = locations.get((file_id, pos))
+    if location is None:
+      location = locations[file_id, pos] = Location(flat.files[file_id], pos >> COL_BITS, pos & ((1 << COL_BITS) - 1))
+    trees.append(Tree(tree_types[type], (), location))
+  edges = flat.edges.tolist()
+  offsets = flat.offsets.tolist()
+  for tree, value, start, end in zip(trees, flat.values, offsets, offsets[1:]):
+    if value is not None:
+      tree.nodes = (value,)
+    elif tree.type == TreeType.Expr:
+      tree.nodes = [trees[j] for j in edges[start:end]]
+    elif start < end:
+      tree.nodes = tuple([trees[j] for j in edges[start:end]])
+  return [trees[root] for root in flat.roots]
 
 macro_env = {}
 
-def parse_atom(tokens):
-  first = tokens[0]
-  if first.type == TokenType.Int:
-    return Tree(TreeType.PushInt, [first.value], first.location), tokens[1:]
-  if first.type == TokenType.Char:
-    return Tree(TreeType.PushChar, [first.value], first.location), tokens[1:]
-  if first.type == TokenType.Word:
-    if first.value == "True" or first.value == "False":
-      return Tree(TreeType.PushBool, [first.value], first.location), tokens[1:]
-    if first.value == "+":
-      return Tree(TreeType.Add, [], first.location), tokens[1:]
-    if first.value == "-":
-      return Tree(TreeType.Sub, [], first.location), tokens[1:]
-    if first.value == "*":
-      return Tree(TreeType.Mul, [], first.location), tokens[1:]
-    if first.value == "/":
-      return Tree(TreeType.Div, [], first.location), tokens[1:]
-    if first.value == "<:":
-      return Tree(TreeType.Cons, [], first.location), tokens[1:]
-    if first.value == "<":
-      return Tree(TreeType.Lt, [], first.location), tokens[1:]
-    if first.value == ">":
-      return Tree(TreeType.Gt, [], first.location), tokens[1:]
-    if first.value == "<=":
-      return Tree(TreeType.Lte, [], first.location), tokens[1:]
-    if first.value == ">=":
-      return Tree(TreeType.Gte, [], first.location), tokens[1:]
-    if first.value == "=":
-      return Tree(TreeType.Eq, [], first.location), tokens[1:]
-    if first.value == "not":
-      return Tree(TreeType.Not, [], first.location), tokens[1:]
-    if first.value == "~":
-      return Tree(TreeType.Eval, [], first.location), tokens[1:]
-    if first.value == "print":
-      return Tree(TreeType.Print, [], first.location), tokens[1:]
-    if first.value == "if":
-      return Tree(TreeType.If, [], first.location), tokens[1:]
-    if first.value == "while":
-      return Tree(TreeType.While, [], first.location), tokens[1:]
-    if first.value == ".":
-      return Tree(TreeType.Dup, [], first.location), tokens[1:]
-    if first.value == "type?":
-      return Tree(TreeType.PrintType, [], first.location), tokens[1:]
-    if first.value == "define":
-      name = tokens[1]
-      body, tokens = parse_expr(tokens[2:])
-      end = tokens[0]
-      if end.value != "end":
-        print(f"{first.location} PARSE ERROR: Unterminated macro declaration")
-        exit(1)
-      macro_env[name.value] = body
-      return Tree(TreeType.Noop, [], first.location), tokens[1:]
-    if macro_env.get(first.value):
-      return macro_env[first.value], tokens[1:]
-    if first.value not in ["define", "end"]:
-      print(f"{first.location} PARSE ERROR: Unknown word: '{first.value}'")
-      exit(1)
-  if first.type == TokenType.OpenQuote:
-    body, tokens = parse_expr(tokens[1:])
-    if not tokens:
-      print(f"{first.location} PARSE ERROR: Unterminated quote definition")
-      exit(1)
-    if tokens[0].type != TokenType.CloseQuote:
+word_table = {
+  "+": TreeType.Add,
+  "-": TreeType.Sub,
+  "*": TreeType.Mul,
+  "/": TreeType.Div,
+  "<:": TreeType.Cons,
+  "<": TreeType.Lt,
+  ">": TreeType.Gt,
+  "<=": TreeType.Lte,
+  ">=": TreeType.Gte,
+  "=": TreeType.Eq,
+  "not": TreeType.Not,
+  "~": TreeType.Eval,
+  "print": TreeType.Print,
+  "if": TreeType.If,
+  "while": TreeType.While,
+  ".": TreeType.Dup,
+  "type?": TreeType.PrintType,
+  "range": TreeType.Range,
+  "len": TreeType.Len,
+  "sum": TreeType.Sum,
+  "map": TreeType.Map,
+  "filter": TreeType.Filter,
+  "fold": TreeType.Fold,
+  "read-line": TreeType.ReadLine,
+  "read-int": TreeType.ReadInt,
+  "read-char": TreeType.ReadChar,
+  "eof?": TreeType.Eof,
+  "write-line": TreeType.WriteLine,
+  "flush": TreeType.Flush,
+  "pmap": TreeType.PMap,
+}
+
+@dataclass
+class Frame:
+  kind: TreeType
+  opener: Token
+  nodes: list
+  location: Location
+  name: Token = None
+
+def expr_location(tokens, pos):
+  if pos < len(tokens):
+    return tokens[pos].location
+  return Location("", 0, 0)
+
+def close_frame(frame, tokens, pos):
+  first = frame.opener
+  end = tokens[pos] if pos < len(tokens) else None
+  body = Tree(TreeType.Expr, frame.nodes, frame.location)
+  if frame.kind == TreeType.PushQuote:
+    if not end or end.type != TokenType.CloseQuote:
       print(f"{first.location} PARSE ERROR: Unterminated quote definition")
       exit(1)
-    return Tree(TreeType.PushQuote, [body], first.location), tokens[1:]
-  if first.type == TokenType.OpenBracket:
-    body, tokens = parse_expr(tokens[1:])
-    if not tokens:
+    return Tree(TreeType.PushQuote, (body,), first.location)
+  if frame.kind == TreeType.PushList:
+    if not end or end.type != TokenType.CloseBracket:
       print(f"{first.location} PARSE ERROR: Unterminated list definition")
       exit(1)
-    if tokens[0].type != TokenType.CloseBracket:
-      print(f"{first.location} PARSE ERROR: Unterminated list definition")
-      exit(1)
-    return Tree(TreeType.PushList, [body], first.location), tokens[1:]
-  return None, tokens
+    return Tree(TreeType.PushList, (body,), first.location)
+  if not end or end.value != "end":
+    print(f"{first.location} PARSE ERROR: Unterminated macro declaration")
+    exit(1)
+  macro_env[frame.name.value] = body
+  return Tree(TreeType.Noop, (), first.location)
 
 def parse_expr(tokens):
-  if not tokens:
-    return Tree(TreeType.Expr, [], Location("", 0, 0)), tokens
-  first = tokens[0]
-  nodes = []
-  while tokens:
-    node, new_tokens = parse_atom(tokens)
-    if node == None:
-      break
-    tokens = new_tokens
-    nodes.append(node)
-  return Tree(TreeType.Expr, nodes, first.location), tokens
-
+  if not isinstance(tokens, list):
+    tokens = list(tokens)
+  pos = 0
+  end = len(tokens)
+  frames = [Frame(TreeType.Expr, None, [], expr_location(tokens, pos))]
+  while True:
+    nodes = frames[-1].nodes
+    first = tokens[pos] if pos < end else None
+    type = first and first.type
+    if type == TokenType.Word and first.value in word_table:
+      nodes.append(Tree(word_table[first.value], (), first.location))
+      pos += 1
+    elif type == TokenType.Int:
+      nodes.append(Tree(TreeType.PushInt, (int(first.value),), first.location))
+      pos += 1
+    elif type == TokenType.Word and first.value in ("True", "False"):
+      nodes.append(Tree(TreeType.PushBool, (first.value,), first.location))
+      pos += 1
+    elif type == TokenType.Word and first.value == "define":
+      if pos + 1 >= end:
+        print(f"{first.location} PARSE ERROR: Unterminated macro declaration")
+        exit(1)
+      frames.append(Frame(TreeType.Noop, first, [], expr_location(tokens, pos + 2), tokens[pos + 1]))
+      pos += 2
+    elif type == TokenType.Word and first.value == "import":
+      name = tokens[pos + 1] if pos + 1 < end else None
+      if not name or name.type != TokenType.String:
+        print(f"{first.location} PARSE ERROR: Expected a quoted file name after 'import'")
+        exit(1)
+      from modules import import_module
+      nodes.append(import_module(name.value, first.location))
+      pos += 2
+    elif type == TokenType.String:
+      print(f"{first.location} PARSE ERROR: Unexpected string literal")
+      exit(1)
+    elif type == TokenType.Word and macro_env.get(first.value):
+      nodes.append(macro_env[first.value])
+      pos += 1
+    elif type == TokenType.Word and first.value != "end":
+      print(f"{first.location} PARSE ERROR: Unknown word: '{first.value}'")
+      exit(1)
+    elif type == TokenType.Char:
+      nodes.append(Tree(TreeType.PushChar, (first.value,), first.location))
+      pos += 1
+    elif type == TokenType.OpenQuote:
+      frames.append(Frame(TreeType.PushQuote, first, [], expr_location(tokens, pos + 1)))
+      pos += 1
+    elif type == TokenType.OpenBracket:
+      frames.append(Frame(TreeType.PushList, first, [], expr_location(tokens, pos + 1)))
+      pos += 1
+    elif len(frames) == 1:
+      frame = frames[0]
+      return Tree(TreeType.Expr, frame.nodes, frame.location), tokens[pos:]
+    else:
+      node = close_frame(frames.pop(), tokens, pos)
+      frames[-1].nodes.append(node)
+      pos += 1
@@ -0,0 +1,197 @@
+from collections import defaultdict
+from time import perf_counter_ns as clock
+from parsing import Tree, TreeType, macro_env
+from conslist import List, Text, from_items, to_text
+from streams import standard
+import sys
+
+TOP = 20
+
+def int_div(a, b):
+  return a // b if (a < 0) == (b < 0) else -(-a // b)
+
+binary_ops = {
+  TreeType.Add: lambda a, b: a + b,
+  TreeType.Sub: lambda a, b: a - b,
+  TreeType.Mul: lambda a, b: a * b,
+  TreeType.Div: int_div,
+  TreeType.Lt: lambda a, b: a < b,
+  TreeType.Gt: lambda a, b: a > b,
+  TreeType.Lte: lambda a, b: a <= b,
+  TreeType.Gte: lambda a, b: a >= b,
+  TreeType.Eq: lambda a, b: a == b,
+  TreeType.Cons: List,
+}
+
+const_ops = {
+  TreeType.AddConst: lambda a, b: a + b,
+  TreeType.SubConst: lambda a, b: a - b,
+}
+
+def where(location):
+  return f"{location.file}:{location.line}:{location.col}"
+
+# A tree walker that times every node it runs. It lives apart from the VM and
+# shell.shell so those stay untouched when profiling is off. Quotes entered by
+# ~, if and while, and macro bodies (visible at -O 0, before the optimizer
+# splices them), become frames of the collapsed stacks.
+class Profiler:
+  def __init__(self, emit=print, streams=None):
+    self.emit = emit
+    self.streams = standard if streams is None else streams
+    self.macros = {id(tree): name for name, tree in macro_env.items()}
+    self.labels = {}
+    self.counts = defaultdict(int)
+    self.total = defaultdict(int)
+    self.own = defaultdict(int)
+    self.stacks = defaultdict(int)
+    self.frames = []
+    self.inner = 0
+
+  def label(self, tree):
+    label = self.labels.get(id(tree))
+    if label is None:
+      name = self.macros.get(id(tree), tree.type.name)
+      label = self.labels[id(tree)] = (name, where(tree.location))
+    return label
+
+  def run(self, tree: Tree, stack, name="main"):
+    self.frames.append(name)
+    self.visit(tree, stack)
+    self.frames.pop()
+    return stack
+
+  def call(self, quote, stack):
+    self.frames.append(f"quote {where(quote.location)}")
+    self.visit(quote, stack)
+    self.frames.pop()
+
+  def visit(self, tree, stack):
+    type = tree.type
+    if type == TreeType.Expr and id(tree) not in self.macros:
+      for node in tree.nodes:
+        self.visit(node, stack)
+      return
+    if type in [TreeType.Noop, TreeType.PrintType]:
+      return
+    label = self.label(tree)
+    outer = self.inner
+    self.inner = 0
+    self.frames.append(" ".join(label))
+    start = clock()
+    self.execute(tree, stack)
+    elapsed = clock() - start
+    own = elapsed - self.inner
+    self.stacks[tuple(self.frames)] += own
+    self.frames.pop()
+    self.inner = outer + elapsed
+    self.counts[label] += 1
+    self.total[label] += elapsed
+    self.own[label] += own
+
+  def execute(self, tree, stack):
+    type = tree.type
+    if type in binary_ops:
+      b = stack.pop()
+      stack[-1] = binary_ops[type](stack[-1], b)
+    elif type in const_ops:
+      stack[-1] = const_ops[type](stack[-1], tree.nodes[0])
+    elif type in [TreeType.PushInt, TreeType.PushChar]:
+      stack.append(tree.nodes[0])
+    elif type == TreeType.PushBool:
+      stack.append(tree.nodes[0] == "True")
+    elif type == TreeType.PushQuote:
+      stack.append(tree.nodes[0])
+    elif type == TreeType.PushList:
+      items = []
+      self.visit(tree.nodes[0], items)
+      stack.append(from_items(items))
+    elif type == TreeType.DupLtConst:
+      stack.append(stack[-1] < tree.nodes[0])
+    elif type == TreeType.Dup:
+      stack.append(stack[-1])
+    elif type == TreeType.Not:
+      stack[-1] = not stack[-1]
+    elif type == TreeType.Print:
+      self.emit(stack.pop())
+    elif type == TreeType.Eval:
+      self.call(stack.pop(), stack)
+    elif type == TreeType.If:
+      c = stack.pop()
+      b = stack.pop()
+      self.call(b if stack.pop() else c, stack)
+    elif type == TreeType.While:
+      b = stack.pop()
+      a = stack.pop()
+      while True:
+        self.call(a, stack)
+        if not stack.pop():
+          break
+        self.call(b, stack)
+    elif type == TreeType.Range:
+      stack[-1] = from_items(range(stack[-1]))
+    elif type == TreeType.Len:
+      stack[-1] = len(stack[-1])
+    elif type == TreeType.Sum:
+      stack[-1] = sum(stack[-1])
+    elif type in [TreeType.Map, TreeType.Filter, TreeType.PMap]:
+      # pmap runs in this process too, so the time of its quote is measured.
+      quote = stack.pop()
+      result = []
+      for value in stack.pop():
+        stack.append(value)
+        self.call(quote, stack)
+        if type != TreeType.Filter:
+          result.append(stack.pop())
+        elif stack.pop():
+          result.append(value)
+      stack.append(from_items(result))
+    elif type == TreeType.Fold:
+      quote = stack.pop()
+      value = stack.pop()
+      items = stack.pop()
+      stack.append(value)
+      for value in items:
+        stack.append(value)
+        self.call(quote, stack)
+    elif type == TreeType.ReadLine:
+      stack.append(Text(self.streams.input.read_line()))
+    elif type == TreeType.ReadInt:
+      stack.append(self.streams.input.read_int())
+    elif type == TreeType.ReadChar:
+      stack.append(self.streams.input.read_char())
+    elif type == TreeType.Eof:
+      stack.append(self.streams.input.eof())
+    elif type == TreeType.WriteLine:
+      self.streams.output.write(to_text(stack.pop()) + "\n")
+    elif type == TreeType.Flush:
+      self.streams.output.flush()
+    elif type == TreeType.Expr:
+      for node in tree.nodes:
+        self.visit(node, stack)
+    else:
+      assert False, f"Not implemented: {type.name}"
+
+  def report(self, top=TOP, file=sys.stderr):
+    total = sum(self.stacks.values()) or 1
+    rows = sorted(self.counts, key=lambda label: self.own[label], reverse=True)
+    print(f"{'self %':>7} {'self ms':>10} {'total ms':>10} {'calls':>10}  node", file=file)
+    for label in rows[:top]:
+      name, location = label
+      own = self.own[label]
+      print(
+        f"{own / total:>7.1%} {own / 1e6:>10.2f} {self.total[label] / 1e6:>10.2f} {self.counts[label]:>10}  {location} {name}",
+        file=file,
+      )
+
+  # One "frame;frame;frame weight" line per distinct stack, weighted by self
+  # time in nanoseconds, as read by flamegraph.pl, inferno and speedscope.
+  def write_folded(self, path):
+    with open(path, "w") as f:
+      for frames, own in sorted(self.stacks.items()):
+        f.write(";".join(frames) + f" {max(own, 0)}\n")
+
+def profile(tree, stack=None, emit=print, streams=None):
+  profiler = Profiler(emit, streams)
+  profiler.run(tree, [] if stack is None else stack)
+  return profiler
@@ -0,0 +1,372 @@
+from parsing import parse_expr, Tree, TreeType
+from lexer import lex
+from typechecker import typecheck
+from modules import dependencies, stale, prune
+from buildcache import compiler_version
+from optimizer import optimize, element_expr, add_arguments as add_optimizer_arguments
+import argparse
+import builtins
+import hashlib
+import importlib.util
+import marshal
+import os
+import sys
+import types
+
+VERSION = 6
+
+# Generated programs are standalone, so they carry their own copy of the cons
+# list and the buffered streams the other executors import.
+def runtime_source(name):
+  with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), name)) as f:
+    return f.read()
+
+CONSLIST = runtime_source("conslist.py")
+STREAMS = runtime_source("streams.py")
+PARALLEL = runtime_source("parallel.py")
+
+RUNTIME = CONSLIST + STREAMS + PARALLEL + """
+def show(value):
+  return value.__doc__ if callable(value) else str(value)
+
+def value_repr(value):
+  if isinstance(value, List):
+    return "[" + " ".join([show(v) for v in value]) + "]"
+  return value.__doc__ if callable(value) else repr(value)
+
+def int_div(a, b):
+  return a // b if (a < 0) == (b < 0) else -(-a // b)
+
+"""
+
+binary_exprs = {
+  TreeType.Add: "{a} + {b}",
+  TreeType.Sub: "{a} - {b}",
+  TreeType.Mul: "{a} * {b}",
+  TreeType.Div: "int_div({a}, {b})",
+  TreeType.Lt: "{a} < {b}",
+  TreeType.Gt: "{a} > {b}",
+  TreeType.Lte: "{a} <= {b}",
+  TreeType.Gte: "{a} >= {b}",
+  TreeType.Eq: "{a} == {b}",
+  TreeType.Cons: "List({a}, {b})",
+}
+
+element_exprs = {**binary_exprs, TreeType.Not: "not {a}"}
+
+list_exprs = {
+  TreeType.Range: "from_items(range({a}))",
+  TreeType.Len: "len({a})",
+  TreeType.Sum: "sum({a})",
+}
+
+io_statements = {
+  TreeType.ReadLine: "push(Text(read_line()))",
+  TreeType.ReadInt: "push(read_int())",
+  TreeType.ReadChar: "push(read_char())",
+  TreeType.Eof: "push(eof())",
+  TreeType.WriteLine: "write(to_text(pop()) + \"\\n\")",
+  TreeType.Flush: "standard.output.flush()",
+}
+
+# Top-level functions for the quotes given to pmap, which the worker processes
+# look up by name.
+workers = []
+
+var_counter = 0
+def new_name(prefix):
+  global var_counter
+  result = var_counter
+  var_counter += 1
+  return f"{prefix}_{result}"
+
+def literal(tree):
+  if tree.type == TreeType.PushInt:
+    return str(tree.nodes[0])
+  if tree.type == TreeType.PushBool:
+    return "True" if tree.nodes[0] == "True" else "False"
+  if tree.type == TreeType.PushChar:
+    return repr(tree.nodes[0])
+  return None
+
+def block(lines, quotes, tree, indent):
+  start = len(lines)
+  compile(lines, quotes, tree, indent)
+  if len(lines) == start:
+    lines.append(f"{indent}pass")
+
+def compile_quote(quotes, tree):
+  name = new_name("quote")
+  body = [f"    {repr(repr(tree))}"]
+  compile(body, quotes, tree, "    ")
+  quotes.append(f"  def {name}():")
+  quotes.extend(body)
+  return name
+
+def compile_worker(tree):
+  name = new_name("pmap")
+  quotes = []
+  lines = []
+  compile(lines, quotes, tree, "    ")
+  workers.append(f"def {name}(chunk):")
+  workers.append("  done = []")
+  workers.extend(quotes)
+  workers.append("  for value in chunk:")
+  workers.append("    stack = [value]")
+  workers.append("    push = stack.append")
+  workers.append("    pop = stack.pop")
+  workers.extend(lines)
+  workers.append("    done.append(stack[0])")
+  workers.append("  return done")
+  return name
+
+def compile_nodes(lines, quotes, nodes, indent):
+  i = 0
+  while i < len(nodes):
+    node = nodes[i]
+    rest = nodes[i+1:i+3]
+    quoted = node.type == TreeType.PushQuote
+    if quoted and len(rest) == 2 and rest[0].type == TreeType.PushQuote and rest[1].type == TreeType.If:
+      lines.append(f"{indent}if pop():")
+      block(lines, quotes, node.nodes[0], indent + "  ")
+      lines.append(f"{indent}else:")
+      block(lines, quotes, rest[0].nodes[0], indent + "  ")
+      i += 3
+      continue
+    if quoted and len(rest) == 2 and rest[0].type == TreeType.PushQuote and rest[1].type == TreeType.While:
+      lines.append(f"{indent}while True:")
+      compile(lines, quotes, node.nodes[0], indent + "  ")
+      lines.append(f"{indent}  if not pop():")
+      lines.append(f"{indent}    break")
+      compile(lines, quotes, rest[0].nodes[0], indent + "  ")
+      i += 3
+      continue
+    if quoted and rest and rest[0].type == TreeType.Eval:
+      compile(lines, quotes, node.nodes[0], indent)
+      i += 2
+      continue
+    if quoted and rest and rest[0].type in [TreeType.Map, TreeType.Filter]:
+      found = element_expr(node.nodes[0], element_exprs)
+      if found is not None:
+        expr, _ = found
+        if rest[0].type == TreeType.Map:
+          lines.append(f"{indent}stack[-1] = from_items([{expr} for x in stack[-1]])")
+        else:
+          lines.append(f"{indent}stack[-1] = from_items([x for x in stack[-1] if {expr}])")
+        i += 2
+        continue
+    if quoted and rest and rest[0].type == TreeType.PMap:
+      name = compile_worker(node.nodes[0])
+      lines.append(f"{indent}stack[-1] = from_items(parallel_map({name}, stack[-1]))")
+      i += 2
+      continue
+    value = literal(node)
+    if value is not None and rest and rest[0].type in binary_exprs:
+      expr = binary_exprs[rest[0].type].format(a="stack[-1]", b=value)
+      lines.append(f"{indent}stack[-1] = {expr}")
+      i += 2
+      continue
+    compile(lines, quotes, node, indent)
+    i += 1
+
+def compile(lines, quotes, tree: Tree, indent):
+  value = literal(tree)
+  if value is not None:
+    lines.append(f"{indent}push({value})")
+    return
+  if tree.type == TreeType.PushList:
+    values = [literal(node) for node in tree.nodes[0].nodes]
+    if None not in values:
+      lines.append(f"{indent}push(from_items([{', '.join(values)}]))")
+      return
+    mark = new_name("mark")
+    lines.append(f"{indent}{mark} = len(stack)")
+    compile(lines, quotes, tree.nodes[0], indent)
+    lines.append(f"{indent}items = stack[{mark}:]")
+    lines.append(f"{indent}del stack[{mark}:]")
+    lines.append(f"{indent}push(from_items(items))")
+    return
+  if tree.type == TreeType.PushQuote:
+    name = compile_quote(quotes, tree.nodes[0])
+    lines.append(f"{indent}push({name})")
+    return
+  if tree.type in binary_exprs:
+    expr = binary_exprs[tree.type].format(a="stack[-1]", b="b")
+    lines.append(f"{indent}b = pop()")
+    lines.append(f"{indent}stack[-1] = {expr}")
+    return
+  if tree.type == TreeType.Not:
+    lines.append(f"{indent}stack[-1] = not stack[-1]")
+    return
+  if tree.type in list_exprs:
+    lines.append(f"{indent}stack[-1] = {list_exprs[tree.type].format(a='stack[-1]')}")
+    return
+  # A pmap whose quote is not a literal next to it is a closure over main's
+  # stack, which can not be sent to a worker, so it runs here as a map.
+  if tree.type in [TreeType.Map, TreeType.Filter, TreeType.PMap]:
+    quote = new_name("quote")
+    result = new_name("result")
+    value = new_name("value")
+    lines.append(f"{indent}{quote} = pop()")
+    lines.append(f"{indent}{result} = []")
+    lines.append(f"{indent}for {value} in pop():")
+    lines.append(f"{indent}  push({value})")
+    lines.append(f"{indent}  {quote}()")
+    if tree.type != TreeType.Filter:
+      lines.append(f"{indent}  {result}.append(pop())")
+    else:
+      lines.append(f"{indent}  if pop():")
+      lines.append(f"{indent}    {result}.append({value})")
+    lines.append(f"{indent}push(from_items({result}))")
+    return
+  if tree.type == TreeType.Fold:
+    quote = new_name("quote")
+    value = new_name("value")
+    items = new_name("items")
+    lines.append(f"{indent}{quote} = pop()")
+    lines.append(f"{indent}{value} = pop()")
+    lines.append(f"{indent}{items} = pop()")
+    lines.append(f"{indent}push({value})")
+    lines.append(f"{indent}for {value} in {items}:")
+    lines.append(f"{indent}  push({value})")
+    lines.append(f"{indent}  {quote}()")
+    return
+  if tree.type == TreeType.AddConst:
+    lines.append(f"{indent}stack[-1] = stack[-1] + {tree.nodes[0]}")
+    return
+  if tree.type == TreeType.SubConst:
+    lines.append(f"{indent}stack[-1] = stack[-1] - {tree.nodes[0]}")
+    return
+  if tree.type == TreeType.DupLtConst:
+    lines.append(f"{indent}push(stack[-1] < {tree.nodes[0]})")
+    return
+  if tree.type == TreeType.Dup:
+    lines.append(f"{indent}push(stack[-1])")
+    return
+  if tree.type == TreeType.Print:
+    lines.append(f"{indent}write(value_repr(pop()) + \"\\n\")")
+    return
+  if tree.type in io_statements:
+    lines.append(f"{indent}{io_statements[tree.type]}")
+    return
+  if tree.type == TreeType.Eval:
+    lines.append(f"{indent}pop()()")
+    return
+  if tree.type == TreeType.If:
+    lines.append(f"{indent}c = pop()")
+    lines.append(f"{indent}b = pop()")
+    lines.append(f"{indent}(b if pop() else c)()")
+    return
+  if tree.type == TreeType.While:
+    cond = new_name("cond")
+    body = new_name("body")
+    lines.append(f"{indent}{body} = pop()")
+    lines.append(f"{indent}{cond} = pop()")
+    lines.append(f"{indent}while True:")
+    lines.append(f"{indent}  {cond}()")
+    lines.append(f"{indent}  if not pop():")
+    lines.append(f"{indent}    break")
+    lines.append(f"{indent}  {body}()")
+    return
+  if tree.type == TreeType.Expr:
+    compile_nodes(lines, quotes, tree.nodes, indent)
+    return
+  if tree.type in [TreeType.Noop, TreeType.PrintType]:
+    return
+  assert False, f"Not implemented: {tree.type.name}"
+
+def compile_source_code(file, source_code: str, level=1, report=False):
+  tokens = lex(file, source_code)
+  tree, _ = parse_expr(tokens)
+  stack = typecheck(tree)
+  if stack:
+    top = stack.pop()
+    print(f"{top.location} TYPE ERROR: Program finished with unhandled data on the stack")
+    exit(1)
+  tree, stats = optimize(tree, level)
+  if report:
+    print(f"{file}: optimizer {stats}", file=sys.stderr)
+  lines = []
+  quotes = []
+  workers.clear()
+  compile(lines, quotes, tree, "  ")
+  code = f"# Generated from {file}\n"
+  code += RUNTIME
+  code += "".join(line + "\n" for line in workers)
+  code += "def main():\n"
+  code += "  stack = []\n"
+  code += "  push = stack.append\n"
+  code += "  pop = stack.pop\n"
+  code += "  write = standard.output.write\n"
+  code += "  read_line = standard.input.read_line\n"
+  code += "  read_int = standard.input.read_int\n"
+  code += "  read_char = standard.input.read_char\n"
+  code += "  eof = standard.input.eof\n"
+  code += "".join(line + "\n" for line in quotes + lines)
+  code += "\n"
+  code += "if __name__ == \"__main__\":\n"
+  code += "  try:\n"
+  code += "    main()\n"
+  code += "  finally:\n"
+  code += "    standard.output.flush()\n"
+  return code
+
+# The generated code depends on the front end, this module and the runtime it
+# embeds, so a change to any of them invalidates the cached programs.
+compiler_files = [
+  "lexer.py", "parsing.py", "typechecker.py", "optimizer.py", "modules.py",
+  "pycompiler.py", "conslist.py", "streams.py", "parallel.py",
+]
+
+def cache_path(file, source: bytes, level=1):
+  version = f"\0{VERSION}\0{level}\0{compiler_version(compiler_files)}"
+  digest = hashlib.sha256(source + version.encode()).hexdigest()[:16]
+  directory = os.path.join(os.path.dirname(os.path.abspath(file)), "__pycache__")
+  name = os.path.basename(file)
+  return os.path.join(directory, f"{name}.{digest}.pyc"), digest
+
+def load(file, level=1, report=False):
+  with open(file, "rb") as f:
+    source = f.read()
+  path, digest = cache_path(file, source, level)
+  header = importlib.util.MAGIC_NUMBER + digest.encode()
+  if os.path.exists(path):
+    with open(path, "rb") as f:
+      data = f.read()
+    if data.startswith(header):
+      deps, code = marshal.loads(data[len(header):])
+      if not stale(deps):
+        return code
+  python = compile_source_code(file, source.decode(), level, report)
+  code = builtins.compile(python, file + ".py", "exec")
+  os.makedirs(os.path.dirname(path), exist_ok=True)
+  with open(path + ".tmp", "wb") as f:
+    f.write(header + marshal.dumps((dependencies(), code)))
+  os.replace(path + ".tmp", path)
+  prune(path)
+  return code
+
+# The program becomes the __main__ module while it runs, where pmap workers
+# find its functions.
+def run(file, level=1, report=False):
+  main = sys.modules["__main__"]
+  module = types.ModuleType("__main__")
+  sys.modules["__main__"] = module
+  try:
+    exec(load(file, level, report), module.__dict__)
+  finally:
+    sys.modules["__main__"] = main
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Run a Stackly program compiled to Python")
+  parser.add_argument("source", nargs="?", default="main.stk")
+  parser.add_argument("-o", "--output", help="write the generated Python here instead of running it")
+  add_optimizer_arguments(parser)
+  args = parser.parse_args()
+  if args.output:
+    with open(args.source) as f:
+      text = f.read()
+    with open(args.output, "w") as f:
+      f.write(compile_source_code(args.source, text, args.level, args.opt_stats))
+  else:
+    run(args.source, args.level, args.opt_stats)
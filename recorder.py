@@ -0,0 +1,222 @@
+from bisect import bisect_right
+from collections import deque
+from itertools import islice
+from dataclasses import dataclass
+from vm import VM, Code, PUSH_QUOTE, lower
+from lexer import lex_file
+from parsing import parse_expr
+from modules import file_digest, dependencies, stale
+from optimizer import optimize
+from streams import Streams, Output, standard
+import io
+import os
+import pickle
+
+MAGIC = b"STKT"
+VERSION = 5
+INTERVAL = 1024
+CAPACITY = 4096
+
+# The VM is deterministic, so a trace only needs the machine state every
+# `interval` steps; any step in between is reached by running forward from the
+# checkpoint before it. Each checkpoint stores its stack as a delta against the
+# previous one: how many bottom values it kept and the values above them.
+@dataclass(slots=True)
+class Checkpoint:
+  steps: int
+  code: Code
+  pc: int
+  frames: list
+  aux: list
+  keep: int
+  suffix: list
+  printed: int
+  read: int
+
+def delta(old, new):
+  keep = 0
+  limit = min(len(old), len(new))
+  while keep < limit and old[keep] is new[keep]:
+    keep += 1
+  return keep, new[keep:]
+
+# Values the program read from its input are kept in order, like the printed
+# ones, so replaying from a checkpoint reads the same values again.
+class Recording:
+  def __init__(self, input, values):
+    self.input = input
+    self.values = values
+  def keep(self, value):
+    self.values.append(value)
+    return value
+  def read_line(self):
+    return self.keep(self.input.read_line())
+  def read_int(self):
+    return self.keep(self.input.read_int())
+  def read_char(self):
+    return self.keep(self.input.read_char())
+  def eof(self):
+    return self.keep(self.input.eof())
+
+# The values read are consumed in order from `start`.
+class Replayed:
+  def __init__(self, values, start):
+    self.values = values
+    self.next = start
+  def take(self):
+    self.next += 1
+    return self.values[self.next - 1]
+  read_line = read_int = read_char = eof = take
+
+def all_codes(root):
+  codes = [root]
+  for code in codes:
+    codes.extend(code.consts[arg] for op, arg in code.ops if op == PUSH_QUOTE)
+  return codes
+
+class Trace:
+  def __init__(self, code, interval=INTERVAL, capacity=CAPACITY):
+    self.code = code
+    self.interval = interval
+    self.checkpoints = deque()
+    self.capacity = capacity
+    self.printed = []
+    self.read = []
+    self.printed_base = 0
+    self.read_base = 0
+    self.steps = 0
+    self.last = []
+    self.digest = None
+    self.deps = []
+    self.level = 0
+
+  def checkpoint(self, vm):
+    keep, suffix = delta(self.last, vm.stack)
+    self.last = list(vm.stack)
+    self.checkpoints.append(Checkpoint(
+      vm.steps, vm.code, vm.pc, list(vm.frames), list(vm.aux), keep, suffix,
+      self.printed_base + len(self.printed), self.read_base + len(self.read),
+    ))
+    self.steps = vm.steps
+    if self.capacity and len(self.checkpoints) > self.capacity:
+      second = self.checkpoints[1]
+      second.suffix = self.stack(1)
+      second.keep = 0
+      self.checkpoints.popleft()
+      self.trim(second)
+
+  # The printed and read values before the oldest checkpoint can no longer be
+  # reached, so they leave the ring with it. printed[0] is value number
+  # printed_base of the run, and likewise for read.
+  def trim(self, first):
+    del self.printed[:first.printed - self.printed_base]
+    del self.read[:first.read - self.read_base]
+    self.printed_base = first.printed
+    self.read_base = first.read
+
+  def stack(self, index):
+    stack = []
+    for checkpoint in islice(self.checkpoints, index + 1):
+      stack = stack[:checkpoint.keep] + checkpoint.suffix
+    return stack
+
+  @property
+  def first(self):
+    return self.checkpoints[0].steps
+
+  # Returns the VM stopped at `step` and how many values the program had
+  # printed by then. Replaying prints the recorded values again, so they are
+  # only counted.
+  def seek(self, step):
+    step = min(max(step, self.first), self.steps)
+    index = bisect_right([c.steps for c in self.checkpoints], step) - 1
+    checkpoint = self.checkpoints[index]
+    printed = [checkpoint.printed]
+    def count(value):
+      printed[0] += 1
+    streams = Streams(Replayed(self.read, checkpoint.read - self.read_base), Output(io.StringIO()))
+    vm = VM(checkpoint.code, self.stack(index), count, streams)
+    vm.pc = checkpoint.pc
+    vm.frames = list(checkpoint.frames)
+    vm.aux = list(checkpoint.aux)
+    vm.steps = checkpoint.steps
+    vm.done = index == len(self.checkpoints) - 1 and checkpoint.steps == self.steps
+    vm.stop = step
+    if not vm.done:
+      vm.run()
+    return vm, printed[0]
+
+  # The last `count` values printed among the first `total`.
+  def output(self, total, count):
+    end = total - self.printed_base
+    return self.printed[max(end - count, 0):end]
+
+def record(file, code, emit=print, interval=INTERVAL, capacity=CAPACITY):
+  trace = Trace(code, interval, capacity)
+  trace.digest = file_digest(file)
+  trace.deps = dependencies()
+  def output(value):
+    trace.printed.append(value)
+    emit(value)
+  vm = VM(code, [], output, Streams(Recording(standard.input, trace.read), standard.output))
+  trace.checkpoint(vm)
+  while not vm.done:
+    vm.stop = vm.steps + interval
+    vm.run()
+    trace.checkpoint(vm)
+  return trace
+
+# Quotes on the stack and in frames are the VM's own Code objects. A trace file
+# refers to them by their index in the lowered program, which is rebuilt from
+# the source at the recorded optimization level when the trace is loaded.
+class TraceWriter(pickle.Pickler):
+  def __init__(self, file, codes):
+    super().__init__(file, pickle.HIGHEST_PROTOCOL)
+    self.index = {id(code): i for i, code in enumerate(codes)}
+  def persistent_id(self, obj):
+    return self.index[id(obj)] if isinstance(obj, Code) else None
+
+class TraceReader(pickle.Unpickler):
+  def __init__(self, file, codes):
+    super().__init__(file)
+    self.codes = codes
+  def persistent_load(self, index):
+    return self.codes[index]
+
+def save(trace, path, file):
+  with open(path, "wb") as f:
+    f.write(MAGIC + bytes([VERSION]))
+    pickle.dump((os.path.abspath(file), trace.digest, trace.deps, trace.level), f, pickle.HIGHEST_PROTOCOL)
+    data = (
+      trace.interval, trace.capacity, trace.steps, trace.printed, trace.read,
+      trace.printed_base, trace.read_base, list(trace.checkpoints),
+    )
+    TraceWriter(f, all_codes(trace.code)).dump(data)
+
+def load(path):
+  with open(path, "rb") as f:
+    if f.read(len(MAGIC) + 1) != MAGIC + bytes([VERSION]):
+      print(f"{path} TRACE ERROR: Not a version {VERSION} trace file")
+      exit(1)
+    file, digest, deps, level = pickle.load(f)
+    if file_digest(file) != digest:
+      print(f"{path} TRACE ERROR: '{file}' changed since it was recorded")
+      exit(1)
+    if stale(deps):
+      print(f"{path} TRACE ERROR: A module imported by '{file}' changed since it was recorded")
+      exit(1)
+    tree, _ = parse_expr(list(lex_file(file)))
+    tree, _ = optimize(tree, level)
+    code = lower(tree)
+    interval, capacity, steps, printed, read, printed_base, read_base, checkpoints = TraceReader(f, all_codes(code)).load()
+  trace = Trace(code, interval, capacity)
+  trace.digest = digest
+  trace.deps = deps
+  trace.level = level
+  trace.steps = steps
+  trace.printed = printed
+  trace.read = read
+  trace.printed_base = printed_base
+  trace.read_base = read_base
+  trace.checkpoints.extend(checkpoints)
+  return trace, tree
@@ -0,0 +1,56 @@
+import argparse
+import os
+import sys
+from lexer import lex_file
+from parsing import parse_expr
+from typechecker import typecheck
+from debugger import value_repr
+from optimizer import optimize, add_arguments as add_optimizer_arguments
+from vm import execute
+from streams import standard, BUFFER_SIZE
+import parallel
+
+def run_file(file, level=1, report=False, folded=None):
+  try:
+    return run_tree(file, level, report, folded)
+  finally:
+    standard.output.flush()
+
+def run_tree(file, level, report, folded):
+  tokens = list(lex_file(file))
+  tree, _ = parse_expr(tokens)
+  stack = typecheck(tree)
+  if stack:
+    print(f"{stack.pop().location} TYPE ERROR: Program finished with unhandled data on the stack")
+    exit(1)
+  tree, stats = optimize(tree, level)
+  if report:
+    print(f"{file}: optimizer {stats}", file=sys.stderr)
+  write = lambda v: standard.output.write(value_repr(v) + "\n")
+  if folded:
+    from profiler import profile
+    profiler = profile(tree, [], emit=write)
+    profiler.report()
+    profiler.write_folded(folded)
+    print(f"{file}: collapsed stacks written to {folded}", file=sys.stderr)
+    return profiler
+  return execute(tree, [], emit=write)
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Run a Stackly program on the bytecode VM")
+  parser.add_argument("source", nargs="?", default="main.stk")
+  add_optimizer_arguments(parser)
+  parser.add_argument(
+    "--profile", action="store_true",
+    help="run on the profiling tree walker, print the hot nodes and write collapsed stacks to --folded; use -O 0 to keep macros as frames",
+  )
+  parser.add_argument("--folded", default="profile.folded", metavar="PATH", help="where --profile writes collapsed stacks (default profile.folded)")
+  parser.add_argument("--buffer-size", type=int, default=BUFFER_SIZE, metavar="BYTES", help=f"input and output buffer size, defaults to $STACKLY_BUFFER or {BUFFER_SIZE}")
+  parser.add_argument("--workers", type=int, default=parallel.WORKERS, metavar="N", help=f"worker processes for pmap, defaults to $STACKLY_WORKERS or {parallel.WORKERS}")
+  args = parser.parse_args()
+  if args.profile and os.path.realpath(args.folded) == os.path.realpath(args.source):
+    parser.error(f"--folded {args.folded} would overwrite the source file")
+  parallel.WORKERS = args.workers
+  standard.output.size = args.buffer_size
+  standard.input.size = args.buffer_size
+  run_file(args.source, args.level, args.opt_stats, args.folded if args.profile else None)
@@ -1,3 +1,2 @@
 clear
-python compiler.py && \
-go build -o main main.go lib.go
+python compiler.py --build main
@@ -3,9 +3,16 @@ from lexer import lex
 from parsing import parse_expr, Tree, TreeType
 from typechecker import typecheck
 from debugger import print_stack
+from vm import execute, lower, map_quote, int_div, VM
+from parallel import parallel_map
+from optimizer import optimize
+from conslist import List, Text, from_items, to_text
+from streams import Streams, Output, standard
+import io
 import readline
 import os
 import atexit
+import statistics
 
 HISTORY_FILE = os.path.expanduser("~/.my_repl_history")
 
@@ -15,16 +22,19 @@ if os.path.exists(HISTORY_FILE):
 atexit.register(readline.write_history_file, HISTORY_FILE)
 
 def value_repr(value):
-    if isinstance(value, list):
+    if isinstance(value, List):
         return "[" + " ".join([str(v) for v in value]) + "]"
     return repr(value)
 
+def write(value):
+    standard.output.write(value_repr(value) + "\n")
+
 def shell(tree: Tree, stack, info=[0, 0]):
     info_pop, info_push = info
     if tree.type == TreeType.Noop:
         return stack, info
     if tree.type == TreeType.PushInt:
-        stack.append(int(tree.nodes[0]))
+        stack.append(tree.nodes[0])
         return stack, [info_pop, info_push+1]
     if tree.type == TreeType.PushBool:
         stack.append(tree.nodes[0] == "True")
@@ -35,7 +45,7 @@ def shell(tree: Tree, stack, info=[0, 0]):
     if tree.type == TreeType.PushList:
         list, info = shell(tree.nodes[0], [], info)
         info_pop, info_push = info
-        stack.append(list)
+        stack.append(from_items(list))
         return stack, [info_pop, info_push+1]
     if tree.type == TreeType.PushQuote:
         stack.append(tree.nodes[0])
@@ -47,13 +57,22 @@ def shell(tree: Tree, stack, info=[0, 0]):
     if tree.type == TreeType.Cons:
         b = stack.pop()
         a = stack.pop()
-        stack.append([a] + b)
+        stack.append(List(a, b))
         return stack, [info_pop+2, info_push+1]
     if tree.type == TreeType.Add:
         b = stack.pop()
         a = stack.pop()
         stack.append(a + b)
         return stack, [info_pop+2, info_push+1]
+    if tree.type == TreeType.AddConst:
+        stack[-1] = stack[-1] + tree.nodes[0]
+        return stack, [info_pop+1, info_push+1]
+    if tree.type == TreeType.SubConst:
+        stack[-1] = stack[-1] - tree.nodes[0]
+        return stack, [info_pop+1, info_push+1]
+    if tree.type == TreeType.DupLtConst:
+        stack.append(stack[-1] < tree.nodes[0])
+        return stack, [info_pop, info_push+1]
     if tree.type == TreeType.Sub:
         b = stack.pop()
         a = stack.pop()
@@ -67,7 +86,7 @@ def shell(tree: Tree, stack, info=[0, 0]):
     if tree.type == TreeType.Div:
         b = stack.pop()
         a = stack.pop()
-        stack.append(a / b)
+        stack.append(int_div(a, b))
         return stack, [info_pop+2, info_push+1]
     if tree.type == TreeType.Lt:
         b = stack.pop()
@@ -122,10 +141,65 @@ def shell(tree: Tree, stack, info=[0, 0]):
                 break
             stack, [info_pop, info_push] = shell(b, stack, [info_pop, info_push])
         return stack, [info_pop+2, info_push]
+    if tree.type == TreeType.Range:
+        stack.append(from_items(range(stack.pop())))
+        return stack, [info_pop+1, info_push+1]
+    if tree.type == TreeType.Len:
+        stack.append(len(stack.pop()))
+        return stack, [info_pop+1, info_push+1]
+    if tree.type == TreeType.Sum:
+        stack.append(sum(stack.pop()))
+        return stack, [info_pop+1, info_push+1]
+    if tree.type in [TreeType.Map, TreeType.Filter]:
+        quote = stack.pop()
+        items = stack.pop()
+        result = []
+        for value in items:
+            stack.append(value)
+            stack, [info_pop, info_push] = shell(quote, stack, [info_pop, info_push+1])
+            if tree.type == TreeType.Map:
+                result.append(stack.pop())
+            elif stack.pop():
+                result.append(value)
+            info_pop += 1
+        stack.append(from_items(result))
+        return stack, [info_pop+2, info_push+1]
+    if tree.type == TreeType.PMap:
+        quote = stack.pop()
+        items = stack.pop()
+        stack.append(from_items(parallel_map(map_quote, items, quote)))
+        return stack, [info_pop+2, info_push+1]
+    if tree.type == TreeType.Fold:
+        quote = stack.pop()
+        value = stack.pop()
+        items = stack.pop()
+        stack.append(value)
+        for value in items:
+            stack.append(value)
+            stack, [info_pop, info_push] = shell(quote, stack, [info_pop, info_push+1])
+        return stack, [info_pop+3, info_push+1]
     if tree.type == TreeType.Print:
         a = stack.pop()
-        print(value_repr(a))
+        write(a)
         return stack, [info_pop+1, info_push+0]
+    if tree.type == TreeType.ReadLine:
+        stack.append(Text(standard.input.read_line()))
+        return stack, [info_pop, info_push+1]
+    if tree.type == TreeType.ReadInt:
+        stack.append(standard.input.read_int())
+        return stack, [info_pop, info_push+1]
+    if tree.type == TreeType.ReadChar:
+        stack.append(standard.input.read_char())
+        return stack, [info_pop, info_push+1]
+    if tree.type == TreeType.Eof:
+        stack.append(standard.input.eof())
+        return stack, [info_pop, info_push+1]
+    if tree.type == TreeType.WriteLine:
+        standard.output.write(to_text(stack.pop()) + "\n")
+        return stack, [info_pop+1, info_push]
+    if tree.type == TreeType.Flush:
+        standard.output.flush()
+        return stack, info
     if tree.type == TreeType.Expr:
         for node in tree.nodes:
             stack, info = shell(node, stack, info)
@@ -142,13 +216,70 @@ def completer(text, state):
 readline.set_completer(completer)
 readline.parse_and_bind("tab: complete")
 
-commands = ["stack", "quit", "help"]
+commands = ["stack", "quit", "help", "time", "bench"]
 
 def print_help():
-    print("HELP: Commands: `stack`, `quit`, `help`")
-    print("    :stack      Prints an ascii representation of the Stack.")
-    print("    :quit       Exits the shell.")
-    print("    :help       Opens this menu.")
+    print("HELP: Commands: `stack`, `quit`, `help`, `time`, `bench`")
+    print("    :stack           Prints an ascii representation of the Stack.")
+    print("    :quit            Exits the shell.")
+    print("    :help            Opens this menu.")
+    print("    :time <expr>     Runs <expr>, timing each stage.")
+    print("    :bench N <expr>  Runs <expr> N times on a copy of the Stack and reports latencies.")
+
+def milliseconds(seconds):
+    return f"{seconds * 1000:.3f} ms"
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
+
+def time_expr(text, stack, type_stack):
+    tokens, lex_time = timed(lambda: list(lex("<shell>", text)))
+    (tree, _), parse_time = timed(parse_expr, tokens)
+    type_stack, check_time = timed(lambda: typecheck(tree, type_stack, should_exit=False))
+    (tree, _), optimize_time = timed(optimize, tree, 2)
+    vm, execute_time = timed(lambda: execute(tree, stack, emit=write))
+    standard.output.flush()
+    for stage, seconds in [("lex", lex_time), ("parse", parse_time), ("typecheck", check_time), ("optimize", optimize_time), ("execute", execute_time)]:
+        print(f"{stage:>10} {milliseconds(seconds)}")
+    if type_stack:
+        print(f"{value_repr(stack[-1])} : {type_stack[-1]}")
+    print(f"Executed {vm.steps} ops.")
+    return stack, type_stack
+
+input_words = [TreeType.ReadLine, TreeType.ReadInt, TreeType.ReadChar, TreeType.Eof]
+
+def input_word(tree):
+    if not isinstance(tree, Tree):
+        return None
+    if tree.type in input_words:
+        return tree
+    return next((node for node in map(input_word, tree.nodes) if node), None)
+
+# Every run writes to a buffer of its own that is thrown away. Input words are
+# refused, since each run would consume the shell's own input.
+def bench_expr(count, text, stack, type_stack):
+    tree, _ = parse_expr(lex("<shell>", text))
+    typecheck(tree, type_stack, should_exit=False)
+    node = input_word(tree)
+    if node is not None:
+        print(f"{node.location} BENCH ERROR: :bench can not run '{node}', it would read the shell's input")
+        return
+    tree, _ = optimize(tree, 2)
+    code = lower(tree)
+    def once():
+        vm = VM(code, list(stack), emit=lambda v: None, streams=Streams(output=Output(io.StringIO())))
+        vm.run()
+        return vm
+    for _ in range(max(1, count // 10)):
+        once()
+    samples = sorted(timed(once)[1] for _ in range(count))
+    p99 = samples[min(len(samples) - 1, int(len(samples) * 0.99))]
+    print(f"{count} runs, {once().steps} ops each")
+    print(f"      mean {milliseconds(statistics.mean(samples))}")
+    print(f"    median {milliseconds(statistics.median(samples))}")
+    print(f"       p99 {milliseconds(p99)}")
 
 def run(stack, type_stack):
     text = input("hastack> ")
@@ -161,21 +292,38 @@ def run(stack, type_stack):
     if text in [":help", ":h", "help"]:
         print_help()
         return stack, type_stack
+    if text.startswith(":time "):
+        try:
+            return time_expr(text[len(":time "):], stack, type_stack)
+        except TypeError:
+            return [], []
+    if text.startswith(":bench "):
+        count, _, expr = text[len(":bench "):].strip().partition(" ")
+        if not count.isdigit() or int(count) < 1 or not expr.strip():
+            print("Usage: :bench N <expr>")
+            return stack, type_stack
+        try:
+            bench_expr(int(count), expr, stack, type_stack)
+        except TypeError:
+            pass
+        return stack, type_stack
     tokens = lex("<shell>", text)
     tree, _ = parse_expr(tokens)
     try:
         type_stack = typecheck(tree, type_stack, should_exit=False)
-        stack, info = shell(tree, stack, [0, 0])
-        info_pop, info_push = info
+        tree, _ = optimize(tree, 2)
+        vm = execute(tree, stack, emit=write)
+        standard.output.flush()
         if type_stack:
             print(f"{value_repr(stack[-1])} : {type_stack[-1]}")
-        print(f"Popped {info_pop} elements, pushed {info_push}.")
+        print(f"Executed {vm.steps} ops.")
     except TypeError:
         type_stack = []
         stack = []
     return stack, type_stack
 
-stack = []
-type_stack = []
-while True:
-    stack, type_stack = run(stack, type_stack)
\ No newline at end of file
+if __name__ == "__main__":
+    stack = []
+    type_stack = []
+    while True:
+        stack, type_stack = run(stack, type_stack)
@@ -0,0 +1,123 @@
+# Buffered standard input and output shared by the Python executors. Output is
+# collected and written in blocks of BUFFER_SIZE bytes (set with
+# $STACKLY_BUFFER); `flush` and the end of the program write what is left.
+# Input is memory-mapped when stdin is a regular file and otherwise read in
+# blocks of the same size.
+import mmap
+import os
+import re
+import sys
+
+BUFFER_SIZE = int(os.environ.get("STACKLY_BUFFER", 1 << 16))
+
+int_pattern = re.compile(rb"\s*(-?\d+)")
+space_pattern = re.compile(rb"\s*")
+
+class Output:
+  def __init__(self, file=None, size=BUFFER_SIZE):
+    self.file = file
+    self.size = size
+    self.parts = []
+    self.pending = 0
+
+  def write(self, text):
+    self.parts.append(text)
+    self.pending += len(text)
+    if self.pending >= self.size:
+      self.flush()
+
+  def flush(self):
+    file = self.file or sys.stdout
+    file.write("".join(self.parts))
+    file.flush()
+    self.parts.clear()
+    self.pending = 0
+
+# At the end of the input read-line gives an empty line, read-char a NUL and
+# read-int 0; eof? tells them apart from real input.
+class Input:
+  def __init__(self, file=None, size=BUFFER_SIZE):
+    self.file = file
+    self.size = size
+    self.data = b""
+    self.pos = 0
+    self.mapped = None
+
+  def open(self):
+    file = self.file or sys.stdin.buffer
+    try:
+      self.data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+      self.mapped = True
+    except (OSError, ValueError, AttributeError):
+      self.mapped = False
+    self.file = file
+
+  def fill(self):
+    if self.mapped is None:
+      self.open()
+      if self.mapped:
+        return len(self.data) > 0
+    if self.mapped:
+      return False
+    read = getattr(self.file, "read1", self.file.read)
+    chunk = read(self.size)
+    if not chunk:
+      return False
+    self.data = self.data[self.pos:] + chunk
+    self.pos = 0
+    return True
+
+  def eof(self):
+    return self.pos >= len(self.data) and not self.fill()
+
+  def read_line(self):
+    start = self.pos
+    while True:
+      end = self.data.find(b"\n", start)
+      if end >= 0:
+        line = self.data[self.pos:end]
+        self.pos = end + 1
+        return line.decode()
+      start = len(self.data) - self.pos
+      if not self.fill():
+        line = self.data[self.pos:]
+        self.pos = len(self.data)
+        return line.decode()
+      start += self.pos
+
+  def read_char(self):
+    if self.eof():
+      return "\0"
+    lead = self.data[self.pos]
+    width = 1 if lead < 0xC0 else 2 if lead < 0xE0 else 3 if lead < 0xF0 else 4
+    while len(self.data) - self.pos < width and self.fill():
+      pass
+    char = self.data[self.pos:self.pos + width].decode(errors="replace")
+    self.pos += width
+    return char
+
+  def read_int(self):
+    while True:
+      match = int_pattern.match(self.data, self.pos)
+      end = match.end() if match else space_pattern.match(self.data, self.pos).end()
+      if not match and self.data[end:end + 2] == b"-":
+        end += 1
+      if end < len(self.data) or not self.fill():
+        break
+    if match:
+      self.pos = end
+      return int(match.group(1))
+    self.pos = end
+    if self.pos >= len(self.data):
+      return 0
+    token = self.data[self.pos:self.pos + 20].split()[0].decode(errors="replace")
+    standard.output.flush()
+    print(f"<stdin> INPUT ERROR: Expected an integer, got '{token}'")
+    exit(1)
+
+class Streams:
+  def __init__(self, input=None, output=None):
+    self.input = input or Input()
+    self.output = output or Output()
+
+standard = Streams()
@@ -1,15 +1,20 @@
 from enum import Enum, auto
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from typing import Union
-from parsing import TreeType
+import contextlib
+import io
+from parsing import Tree, TreeType
 from lexer import Location
 
-SHOULD_EXIT = True
+EFFECT_CACHE_SIZE = 4096
 
 @dataclass
 class Effect:
   pops: 'list[Type]'
   pushes: 'list[Type]'
+  # Pairs of quote bodies that met while the effect was inferred, see
+  # merge_bodies.
+  bodies: list = field(default_factory=list)
   def __repr__(self):
     return f"{str(self.pops)} => {str(self.pushes)}"
 
@@ -80,104 +85,390 @@ def quote_type(tree, loc) -> Type:
     loc,
   )
 
-var_count = -1
-
 def new_var(loc) -> Type:
-  global var_count
-  var_count += 1
+  checker.var_count += 1
   return Type(
     Kind.Var,
-    f"v{var_count}",
+    f"v{checker.var_count}",
     loc,
   )
 
 def new_multi(loc) -> Type:
-  global var_count
-  var_count += 1
+  checker.var_count += 1
   return Type(
     Kind.Multi,
-    f"m{var_count}",
+    f"m{checker.var_count}",
     loc,
   )
 
-def unify(
-    a: Type,
-    b: Type,
-    env = {},
-    ) -> Union[Type, None]:
-  if b.type == Kind.Var:
-    env[b.effect] = a
-    return a, env
+# Type variables are union-find nodes keyed by name. A class root may be bound
+# to a type (Var) or to a row of types (Multi). Every run has its own
+# Substitution, so bindings never outlive the program they came from.
+class Substitution:
+  def __init__(self):
+    self.parent = {}
+    self.rank = {}
+    self.bound = {}
+
+  def find(self, name):
+    root = name
+    while self.parent.get(root, root) != root:
+      root = self.parent[root]
+    while name != root:
+      self.parent[name], name = root, self.parent[name]
+    return root
+
+  def union(self, a, b):
+    if self.rank.get(a, 0) < self.rank.get(b, 0):
+      a, b = b, a
+    self.parent[b] = a
+    if self.rank.get(a, 0) == self.rank.get(b, 0):
+      self.rank[a] = self.rank.get(a, 0) + 1
+    return a
+
+# The state of one run: the substitution, the variable counter and the quote
+# summaries. typecheck and infer_effect each run under a Checker of their own
+# and restore the one they interrupted when they finish, so a check started
+# inside another, such as an import reached while checking, shares nothing
+# with it.
+class Checker:
+  def __init__(self, should_exit=True):
+    self.should_exit = should_exit
+    self.var_count = -1
+    self.subst = Substitution()
+    self.effect_cache = {}
+    self.quotes = Substitution()
+    self.bodies = {}
+
+checker = Checker()
+
+@contextlib.contextmanager
+def running(run):
+  global checker
+  outer = checker
+  checker = run
+  try:
+    yield run
+  finally:
+    checker = outer
+
+def is_var(type):
+  return type.type in [Kind.Var, Kind.Multi]
+
+def resolve(type, env=None):
+  env = checker.subst if env is None else env
+  if type.type != Kind.Var:
+    return type
+  root = env.find(type.effect)
+  if root in env.bound:
+    return env.bound[root]
+  return type if root == type.effect else Type(Kind.Var, root, type.location)
+
+def expand_row(types, env):
+  row = []
+  for type in types:
+    if type.type == Kind.Multi:
+      root = env.find(type.effect)
+      if root in env.bound:
+        row.extend(expand_row(env.bound[root], env))
+        continue
+      type = Type(Kind.Multi, root, type.location)
+    row.append(resolve(type, env))
+  return row
+
+def occurs(name, type, env):
+  if type.type == Kind.Multi:
+    root = env.find(type.effect)
+    if root == name:
+      return True
+    return root in env.bound and any(occurs(name, t, env) for t in env.bound[root])
+  type = resolve(type, env)
+  if type.type == Kind.Var:
+    return type.effect == name
+  if type.type == Kind.List:
+    return occurs(name, type.effect, env)
+  if type.type == Kind.Quote and isinstance(type.effect, Effect):
+    return any(occurs(name, t, env) for t in type.effect.pops + type.effect.pushes)
+  return False
+
+def bind_row(multi, rest, other, env):
+  if len(other) < len(rest):
+    return False
+  split = len(other) - len(rest)
+  head = other[:split]
+  if len(head) == 1 and head[0].type == Kind.Multi:
+    if head[0].effect != multi.effect:
+      env.union(multi.effect, head[0].effect)
+  elif any(occurs(multi.effect, t, env) for t in head):
+    return False
+  else:
+    env.bound[multi.effect] = head
+  return all(unify(a, b, env) is not None for a, b in zip(rest, other[split:]))
+
+def unify_rows(xs, ys, env):
+  xs = expand_row(xs, env)
+  ys = expand_row(ys, env)
+  if xs and xs[0].type == Kind.Multi:
+    return bind_row(xs[0], xs[1:], ys, env)
+  if ys and ys[0].type == Kind.Multi:
+    return bind_row(ys[0], ys[1:], xs, env)
+  if len(xs) != len(ys):
+    return False
+  return all(unify(a, b, env) is not None for a, b in zip(xs, ys))
+
+def unify(a: Type, b: Type, env=None) -> Union[Type, None]:
+  env = checker.subst if env is None else env
+  a = resolve(a, env)
+  b = resolve(b, env)
+  if a.type == Kind.Var and b.type == Kind.Var:
+    if a.effect != b.effect:
+      env.union(a.effect, b.effect)
+    return a
+  if a.type == Kind.Var or b.type == Kind.Var:
+    var, other = (a, b) if a.type == Kind.Var else (b, a)
+    if occurs(var.effect, other, env):
+      return None
+    env.bound[var.effect] = other
+    return other
   if a.type != b.type:
-    return None, env
+    return None
   if a.type == Kind.List:
-    a_elem = a.effect
-    b_elem = b.effect
-    c, env = unify(a_elem, b_elem, env)
+    c = unify(a.effect, b.effect, env)
     if not c:
-      return None, env
-    return Type(Kind.List, c, a.location), env
+      return None
+    return Type(Kind.List, c, a.location)
   if a.type == Kind.Quote:
-    return a, env
-  return a, env
+    if isinstance(a.effect, Tree) and isinstance(b.effect, Tree):
+      merge_bodies(a.effect, b.effect)
+    if isinstance(a.effect, Effect) and isinstance(b.effect, Effect):
+      if not unify_rows(a.effect.pops, b.effect.pops, env):
+        return None
+      if not unify_rows(a.effect.pushes, b.effect.pushes, env):
+        return None
+    return a
+  if a.type == Kind.Multi:
+    a_root = env.find(a.effect)
+    b_root = env.find(b.effect)
+    if a_root != b_root:
+      env.union(a_root, b_root)
+    return a
+  return a
+
+# A quote type pushed by `{...}` carries that body, but quote types unify
+# whatever their bodies are, so once two of them meet, in the branches of an
+# if or the elements of a list, a value of either type may run either body.
+# The bodies that may run for a quote type are its class in Checker.quotes,
+# a union-find over the ids of the bodies.
+def merge_bodies(a, b):
+  quotes = checker.quotes
+  x = quotes.find(id(a))
+  y = quotes.find(id(b))
+  if x != y:
+    members = bodies(a) + bodies(b)
+    checker.bodies.pop(x, None)
+    checker.bodies.pop(y, None)
+    checker.bodies[quotes.union(x, y)] = members
+
+def bodies(body):
+  return checker.bodies.get(checker.quotes.find(id(body)), [body])
 
-def apply_env(type, env):
-  global SHOULD_EXIT
+def apply_env(type, env=None):
+  env = checker.subst if env is None else env
   if type.type == Kind.Quote:
-    pops = []
-    for p in type.effect.pops:
-      app = apply_env(p, env)
-      if isinstance(app, list):
-        pops.extend(app)
-      else:
-        pops.append(app)
-    pushes = []
-    for p in type.effect.pushes:
-      app = apply_env(p, env)
-      if isinstance(app, list):
-        pushes.extend(app)
-      else:
-        pushes.append(app)
+    if not isinstance(type.effect, Effect):
+      return type
+    pops = [apply_env(t, env) for t in expand_row(type.effect.pops, env)]
+    pushes = [apply_env(t, env) for t in expand_row(type.effect.pushes, env)]
     return Type(Kind.Quote, Effect(pops, pushes), type.location)
-  if type.type == Kind.Var:
-    if env.get(type.effect) != None:
-      return env[type.effect]
   if type.type == Kind.Multi:
-    if env.get(type.effect) != None:
-      return env[type.effect]
+    row = expand_row([type], env)
+    if len(row) == 1 and row[0].type == Kind.Multi:
+      return row[0]
+    return [apply_env(t, env) for t in row]
+  type = resolve(type, env)
+  if type.type == Kind.List:
+    return Type(Kind.List, apply_env(type.effect, env), type.location)
+  return type
+
+def instantiate(type, names, keep=lambda name: False):
+  if type.type == Kind.Multi:
+    subst = checker.subst
+    root = subst.find(type.effect)
+    if root in subst.bound:
+      return [instantiate(t, names, keep) for t in expand_row([type], subst)]
+    type = Type(Kind.Multi, root, type.location)
+  type = resolve(type)
+  if is_var(type):
+    if keep(type.effect):
+      return type
+    if type.effect not in names:
+      fresh = new_var if type.type == Kind.Var else new_multi
+      names[type.effect] = fresh(type.location).effect
+    return Type(type.type, names[type.effect], type.location)
+  if type.type == Kind.List:
+    return Type(Kind.List, instantiate(type.effect, names, keep), type.location)
+  if type.type == Kind.Quote and isinstance(type.effect, Effect):
+    pops = [instantiate(t, names, keep) for t in expand_row(type.effect.pops, checker.subst)]
+    pushes = [instantiate(t, names, keep) for t in expand_row(type.effect.pushes, checker.subst)]
+    return Type(Kind.Quote, Effect(pops, pushes), type.location)
   return type
 
 def assert_enough_args(tree, expected, got):
-  global SHOULD_EXIT
   if got < expected:
     print(f"{tree.location} TYPE ERROR: Not enough arguments on the stack for the '{tree.type.name}' operator, expected at least {expected}, got {got}")
-    if SHOULD_EXIT: exit(1)
+    if checker.should_exit: exit(1)
     else: raise TypeError()
 
 def assert_type(tree, pos, expected, got):
-  global SHOULD_EXIT
-  if not unify(got, expected)[0]:
-    print(f"{tree.location} TYPE ERROR: Invalid type for the {pos} argument of the '{tree}' operator, expected '{expected}', got '{got}'")
-    if SHOULD_EXIT: exit(1)
+  if not unify(got, expected):
+    print(f"{tree.location} TYPE ERROR: Invalid type for the {pos} argument of the '{tree}' operator, expected '{apply_env(expected)}', got '{apply_env(got)}'")
+    if checker.should_exit: exit(1)
     else: raise TypeError()
   
+# A quote body is checked once per distinct input stack. The summary keeps the
+# effect it had on that stack (the slots it reached below and what it left in
+# their place) so later uses of the same quote replay the effect instead of
+# walking the body again. Without this nested if/while bodies are rechecked an
+# exponential number of times. Variables created while checking the body are
+# instantiated afresh on every replay.
+@dataclass
+class Summary:
+  effect: Effect
+  inputs: list
+  refs: list
+  first: int
+
+class Tracked(list):
+  def __init__(self, items):
+    super().__init__(items)
+    self.low = len(items)
+  def pop(self, *args):
+    value = super().pop(*args)
+    self.low = min(self.low, len(self))
+    return value
+
+def type_key(type, refs):
+  type = resolve(type)
+  if type.type == Kind.List:
+    return (type.type, type_key(type.effect, refs))
+  if type.type == Kind.Quote:
+    if isinstance(type.effect, Effect):
+      pops = tuple(type_key(t, refs) for t in type.effect.pops)
+      pushes = tuple(type_key(t, refs) for t in type.effect.pushes)
+      return (type.type, pops, pushes)
+    refs.append(type.effect)
+    return (type.type, id(type.effect))
+  return (type.type, type.effect)
+
+def summarize(tree, stack):
+  first = checker.var_count
+  tracked = Tracked(stack)
+  result = check(tree, tracked)
+  pops = stack[tracked.low:]
+  pushes = result[tracked.low:]
+  inputs = [next((i for i, p in enumerate(pops) if p is t), None) for t in pushes]
+  return Summary(Effect(pops, pushes), inputs, [], first)
+
+def check_quote(tree, stack):
+  refs = [tree]
+  key = (id(tree), tuple(type_key(t, refs) for t in stack))
+  effect_cache = checker.effect_cache
+  summary = effect_cache.get(key)
+  if summary is None:
+    summary = summarize(tree, stack)
+    summary.refs = refs
+    if len(effect_cache) >= EFFECT_CACHE_SIZE:
+      del effect_cache[next(iter(effect_cache))]
+    effect_cache[key] = summary
+    fresh = lambda t, names: t
+  else:
+    old = lambda name: int(name[1:]) <= summary.first
+    fresh = lambda t, names: instantiate(t, names, old)
+  names = {}
+  pops = [stack.pop() for _ in summary.effect.pops][::-1]
+  for i, t in zip(summary.inputs, summary.effect.pushes):
+    stack.append(fresh(t, names) if i is None else pops[i])
+  return stack
+
+# Stack effects inferred for library macros (see modules.py), keyed by the id
+# of the macro's body tree. A use of such a macro unifies the effect with the
+# stack instead of checking the body. The effects are stored with the names
+# they were inferred under and renamed on every use.
+macro_effects = {}
+
+def rename(type, names):
+  if is_var(type):
+    if type.effect not in names:
+      fresh = new_var if type.type == Kind.Var else new_multi
+      names[type.effect] = fresh(type.location).effect
+    return Type(type.type, names[type.effect], type.location)
+  if type.type == Kind.List:
+    return Type(Kind.List, rename(type.effect, names), type.location)
+  if type.type == Kind.Quote and isinstance(type.effect, Effect):
+    pops = [rename(t, names) for t in type.effect.pops]
+    pushes = [rename(t, names) for t in type.effect.pushes]
+    return Type(Kind.Quote, Effect(pops, pushes), type.location)
+  return type
+
+def apply_effect(effect, stack):
+  if len(stack) < len(effect.pops):
+    return False
+  names = {}
+  pops = [rename(t, names) for t in effect.pops]
+  pushes = [rename(t, names) for t in effect.pushes]
+  for a, b in zip(stack[len(stack) - len(pops):], pops):
+    if not unify(a, b):
+      return False
+  for a, b in effect.bodies:
+    merge_bodies(a, b)
+  for _ in pops:
+    stack.pop()
+  stack.extend(resolve(t) for t in pushes)
+  return True
+
+def prints_types(tree):
+  seen = set()
+  work = [tree]
+  while work:
+    node = work.pop()
+    if not isinstance(node, Tree) or id(node) in seen:
+      continue
+    if node.type == TreeType.PrintType:
+      return True
+    seen.add(id(node))
+    work.extend(node.nodes)
+  return False
+
+def infer_effect(tree, max_pops=8):
+  if prints_types(tree):
+    return None
+  with contextlib.redirect_stdout(io.StringIO()):
+    for count in range(max_pops + 1):
+      with running(Checker(should_exit=False)):
+        inputs = [new_var(tree.location) for _ in range(count)]
+        try:
+          outputs = check(tree, inputs.copy())
+        except Exception:
+          continue
+        merged = [(members[0], body) for members in checker.bodies.values() for body in members[1:]]
+        return Effect([apply_env(t) for t in inputs], [apply_env(t) for t in outputs], merged)
+  return None
+
 def compare_quotes(tree, stack, quotes, offset=0, self=False):
-  global SHOULD_EXIT
   if self:
     quote = quotes
-    new = typecheck(quote.effect, stack.copy())
+    new = check_quote(quote.effect, stack.copy())
     [new.pop() for _ in range(offset)]
     for a, b in zip(stack, new):
-      u, _ = unify(a, b)
-      if not u:
-        print(f"{b.location} TYPE ERROR: Invalid type when evaluating quotes: expected '{a}', got '{b}'")
-        if SHOULD_EXIT: exit(1)
+      if not unify(a, b):
+        print(f"{b.location} TYPE ERROR: Invalid type when evaluating quotes: expected '{apply_env(a)}', got '{apply_env(b)}'")
+        if checker.should_exit: exit(1)
         else: raise TypeError()
     return
   results = []
   for quote in quotes:
     qstack = stack.copy()
-    results.append(typecheck(quote.effect, qstack))
+    results.append(check_quote(quote.effect, qstack))
   first = results[0]
   for r in results:
     [r.pop() for _ in range(offset)]
@@ -185,19 +476,86 @@ def compare_quotes(tree, stack, quotes, offset=0, self=False):
     if len(result) != len(first):
       qs = "".join(["  " + str(q) + "\n" for q in quotes])
       print(f"{tree.location} TYPE ERROR: The quotes passed into '{tree}' are not congruent in shape: [\n{qs}]")
-      if SHOULD_EXIT: exit(1)
+      if checker.should_exit: exit(1)
       else: raise TypeError()
     for a, b in zip(first, result):
-      u, _ = unify(a, b)
-      if not u:
-        print(f"{b.location} TYPE ERROR: Invalid type when evaluating quotes: expected '{a}', got '{b}'")
-        if SHOULD_EXIT: exit(1)
+      if not unify(a, b):
+        print(f"{b.location} TYPE ERROR: Invalid type when evaluating quotes: expected '{apply_env(a)}', got '{apply_env(b)}'")
+        if checker.should_exit: exit(1)
         else: raise TypeError()
 
-def typecheck(tree, stack=[], should_exit=True):
-  global SHOULD_EXIT
-  if not should_exit:
-    SHOULD_EXIT = False
+# The quote given to map, filter and fold runs once per element on a stack of
+# its own, holding only `inputs`. It has to leave exactly as many values as
+# `outputs` lists, of the same types.
+def check_element_quote(tree, quote, inputs, outputs):
+  result = check_quote(quote.effect, list(inputs))
+  if len(result) != len(outputs):
+    expected = Effect([apply_env(t) for t in inputs], [apply_env(t) for t in outputs])
+    print(f"{quote.location} TYPE ERROR: The quote passed into '{tree}' must have the effect {{{expected}}}, it leaves {len(result)} values instead of {len(outputs)}")
+    if checker.should_exit: exit(1)
+    else: raise TypeError()
+  for a, b in zip(outputs, result):
+    if not unify(a, b):
+      print(f"{b.location} TYPE ERROR: Invalid type returned by the quote passed into '{tree}': expected '{apply_env(a)}', got '{apply_env(b)}'")
+      if checker.should_exit: exit(1)
+      else: raise TypeError()
+
+# pmap runs its quote on other cores in no fixed order, so the quote may not
+# use any word that reaches outside the stack.
+impure_words = [
+  TreeType.Print, TreeType.ReadLine, TreeType.ReadInt, TreeType.ReadChar,
+  TreeType.Eof, TreeType.WriteLine, TreeType.Flush,
+]
+
+def impure_word(tree):
+  seen = set()
+  work = [tree]
+  while work:
+    node = work.pop()
+    if not isinstance(node, Tree) or id(node) in seen:
+      continue
+    if node.type in impure_words:
+      return node
+    seen.add(id(node))
+    work.extend(node.nodes)
+  return None
+
+def holds_quote(type):
+  type = resolve(type)
+  if type.type == Kind.List:
+    return holds_quote(type.effect)
+  return type.type == Kind.Quote
+
+# The proof is that every body the quote may run, with every quote nested in
+# it, uses no impure word, so the quote has to come from a `{...}` the
+# checker saw, directly or through macros and other quotes. Elements and
+# results may not be quotes, whose bodies could be evaluated inside it.
+def check_pure_quote(tree, quote, elem, out):
+  body = resolve(quote).effect
+  if not isinstance(body, Tree):
+    print(f"{tree.location} TYPE ERROR: The quote passed into '{tree}' must come from a quote literal, so that it can be proven pure")
+    if checker.should_exit: exit(1)
+    else: raise TypeError()
+  for body in bodies(body):
+    node = impure_word(body)
+    if node is not None:
+      print(f"{node.location} TYPE ERROR: The quote passed into '{tree}' must be pure, it uses '{node}'")
+      if checker.should_exit: exit(1)
+      else: raise TypeError()
+  for type in [elem, out]:
+    if holds_quote(type):
+      print(f"{tree.location} TYPE ERROR: The values passed through '{tree}' can not be quotes, got '{apply_env(type)}'")
+      if checker.should_exit: exit(1)
+      else: raise TypeError()
+
+def typecheck(tree, stack=None, should_exit=True):
+  with running(Checker(should_exit)):
+    names = {}
+    stack = [instantiate(t, names) for t in stack or []]
+    stack = check(tree, stack)
+    return [apply_env(t) for t in stack]
+
+def check(tree, stack):
   if tree.type == TreeType.Noop:
     return stack
   if tree.type == TreeType.PushInt:
@@ -210,13 +568,13 @@ def typecheck(tree, stack=[], should_exit=True):
     stack.append(char_type(tree.location))
     return stack
   if tree.type == TreeType.PushList:
-    lstack = typecheck(tree.nodes[0], [])
+    lstack = check(tree.nodes[0], [])
     elem = new_var(tree.location)
     for t in lstack:
-      c, _ = unify(t, elem)
+      c = unify(t, elem)
       if not c:
         print(f"{t.location} TYPE ERROR: Attempting to create a list with different types")
-        if SHOULD_EXIT: exit(1)
+        if checker.should_exit: exit(1)
         else: raise TypeError()
       elem = c
     stack.append(list_type(elem, tree.location))
@@ -276,7 +634,7 @@ def typecheck(tree, stack=[], should_exit=True):
     assert_type(tree, "second", quote_type(e, tree.location), b)
     assert_type(tree, "third", b, c)
     compare_quotes(tree, stack, [b, c])
-    stack = typecheck(b.effect, stack)
+    stack = check_quote(b.effect, stack)
     return stack
   if tree.type == TreeType.While:
     assert_enough_args(tree, 2, len(stack))
@@ -293,18 +651,87 @@ def typecheck(tree, stack=[], should_exit=True):
   if tree.type == TreeType.Eval:
     assert_enough_args(tree, 1, len(stack))
     quote = stack.pop()
-    assert_type(tree, "first", quote_type(tree, tree.location), quote)
-    stack = typecheck(quote.effect, stack)
+    assert_type(tree, "first", quote_type(None, tree.location), quote)
+    stack = check_quote(quote.effect, stack)
+    return stack
+  if tree.type == TreeType.Range:
+    assert_enough_args(tree, 1, len(stack))
+    a = stack.pop()
+    assert_type(tree, "first", int_type(tree.location), a)
+    stack.append(list_type(int_type(tree.location), tree.location))
+    return stack
+  if tree.type in [TreeType.Len, TreeType.Sum]:
+    assert_enough_args(tree, 1, len(stack))
+    a = stack.pop()
+    elem = int_type(tree.location) if tree.type == TreeType.Sum else new_var(tree.location)
+    assert_type(tree, "first", list_type(elem, tree.location), a)
+    stack.append(int_type(tree.location))
+    return stack
+  if tree.type in [TreeType.Map, TreeType.Filter]:
+    assert_enough_args(tree, 2, len(stack))
+    b = stack.pop()
+    a = stack.pop()
+    elem = new_var(tree.location)
+    assert_type(tree, "first", list_type(elem, tree.location), a)
+    assert_type(tree, "second", quote_type(None, tree.location), b)
+    out = new_var(tree.location) if tree.type == TreeType.Map else bool_type(tree.location)
+    check_element_quote(tree, b, [elem], [out])
+    stack.append(list_type(out if tree.type == TreeType.Map else elem, tree.location))
+    return stack
+  if tree.type == TreeType.PMap:
+    assert_enough_args(tree, 2, len(stack))
+    b = stack.pop()
+    a = stack.pop()
+    elem = new_var(tree.location)
+    out = new_var(tree.location)
+    assert_type(tree, "first", list_type(elem, tree.location), a)
+    assert_type(tree, "second", quote_type(None, tree.location), b)
+    check_element_quote(tree, b, [elem], [out])
+    check_pure_quote(tree, b, elem, out)
+    stack.append(list_type(out, tree.location))
+    return stack
+  if tree.type == TreeType.Fold:
+    assert_enough_args(tree, 3, len(stack))
+    c = stack.pop()
+    b = stack.pop()
+    a = stack.pop()
+    elem = new_var(tree.location)
+    assert_type(tree, "first", list_type(elem, tree.location), a)
+    assert_type(tree, "third", quote_type(None, tree.location), c)
+    check_element_quote(tree, c, [b, elem], [b])
+    stack.append(b)
+    return stack
+  if tree.type == TreeType.ReadLine:
+    stack.append(list_type(char_type(tree.location), tree.location))
+    return stack
+  if tree.type == TreeType.ReadInt:
+    stack.append(int_type(tree.location))
+    return stack
+  if tree.type == TreeType.ReadChar:
+    stack.append(char_type(tree.location))
+    return stack
+  if tree.type == TreeType.Eof:
+    stack.append(bool_type(tree.location))
+    return stack
+  if tree.type == TreeType.WriteLine:
+    assert_enough_args(tree, 1, len(stack))
+    a = stack.pop()
+    assert_type(tree, "first", list_type(char_type(tree.location), tree.location), a)
+    return stack
+  if tree.type == TreeType.Flush:
     return stack
   if tree.type == TreeType.PrintType:
     assert_enough_args(tree, 1, len(stack))
     type = stack.pop()
-    print(f"(type?) {tree.location} {type}")
+    print(f"(type?) {tree.location} {apply_env(type)}")
     stack.append(type)
     return stack
   if tree.type == TreeType.Expr:
+    known = macro_effects.get(id(tree))
+    if known and apply_effect(known[1], stack):
+      return stack
     for node in tree.nodes:
-      stack = typecheck(node, stack)
+      stack = check(node, stack)
     return stack
   print(tree)
   assert False
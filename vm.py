@@ -0,0 +1,475 @@
+from dataclasses import dataclass, field
+from parsing import Tree, TreeType
+from optimizer import element_expr
+from conslist import List, EMPTY, Text, from_items, reverse, to_text
+from streams import standard
+from parallel import parallel_map
+
+# Opcodes are plain ints so the dispatch loop compares small ints instead of
+# enum members. Each instruction is an (op, arg) tuple.
+PUSH = 0
+DUP = 1
+ADD = 2
+SUB = 3
+MUL = 4
+DIV = 5
+LT = 6
+GT = 7
+LTE = 8
+GTE = 9
+EQ = 10
+NOT = 11
+CONS = 12
+PRINT = 13
+JUMP = 14
+JUMP_IF_FALSE = 15
+PUSH_QUOTE = 16
+CALL = 17
+IF = 18
+LOOP_ENTER = 19
+LOOP_CALL = 20
+LOOP_EXIT = 21
+MARK = 22
+MAKE_LIST = 23
+RETURN = 24
+ADD_CONST = 25
+SUB_CONST = 26
+DUP_LT_CONST = 27
+BREAK = 28
+RANGE = 29
+LEN = 30
+SUM = 31
+EACH_ENTER = 32
+EACH_NEXT = 33
+EACH_CALL = 34
+EACH_KEEP = 35
+EACH_EXIT = 36
+LIST_EXPR = 37
+READ_LINE = 38
+READ_INT = 39
+READ_CHAR = 40
+EOF = 41
+WRITE_LINE = 42
+FLUSH = 43
+PMAP = 44
+
+op_names = {
+  value: name for name, value in globals().items()
+  if name.isupper() and isinstance(value, int)
+}
+
+const_ops = {
+  TreeType.AddConst: ADD_CONST,
+  TreeType.SubConst: SUB_CONST,
+  TreeType.DupLtConst: DUP_LT_CONST,
+}
+
+binary_ops = {
+  TreeType.Add: ADD,
+  TreeType.Sub: SUB,
+  TreeType.Mul: MUL,
+  TreeType.Div: DIV,
+  TreeType.Lt: LT,
+  TreeType.Gt: GT,
+  TreeType.Lte: LTE,
+  TreeType.Gte: GTE,
+  TreeType.Eq: EQ,
+  TreeType.Cons: CONS,
+}
+
+list_ops = {
+  TreeType.Range: RANGE,
+  TreeType.Len: LEN,
+  TreeType.Sum: SUM,
+}
+
+io_ops = {
+  TreeType.ReadLine: READ_LINE,
+  TreeType.ReadInt: READ_INT,
+  TreeType.ReadChar: READ_CHAR,
+  TreeType.Eof: EOF,
+  TreeType.WriteLine: WRITE_LINE,
+  TreeType.Flush: FLUSH,
+}
+
+element_exprs = {
+  TreeType.Add: "{a} + {b}",
+  TreeType.Sub: "{a} - {b}",
+  TreeType.Mul: "{a} * {b}",
+  TreeType.Div: "int_div({a}, {b})",
+  TreeType.Lt: "{a} < {b}",
+  TreeType.Gt: "{a} > {b}",
+  TreeType.Lte: "{a} <= {b}",
+  TreeType.Gte: "{a} >= {b}",
+  TreeType.Eq: "{a} == {b}",
+  TreeType.Not: "not {a}",
+}
+
+def int_div(a, b):
+  return a // b if (a < 0) == (b < 0) else -(-a // b)
+
+@dataclass
+class Code:
+  ops: list = field(default_factory=list)
+  locations: list = field(default_factory=list)
+  consts: list = field(default_factory=list)
+  tree: Tree = None
+  def __repr__(self):
+    return repr(self.tree)
+
+def disassemble(code, indent=""):
+  lines = []
+  for pc, (op, arg) in enumerate(code.ops):
+    if op == PUSH_QUOTE:
+      lines.append(f"{indent}{pc:4} {op_names[op]} {arg}")
+      lines.append(disassemble(code.consts[arg], indent + "    "))
+      continue
+    text = "" if arg is None else f" {arg!r}"
+    lines.append(f"{indent}{pc:4} {op_names[op]}{text}")
+  return "\n".join(lines)
+
+def emit(code, op, arg, location):
+  code.ops.append((op, arg))
+  code.locations.append(location)
+  return len(code.ops) - 1
+
+def patch(code, at):
+  op, _ = code.ops[at]
+  code.ops[at] = (op, len(code.ops))
+
+def is_quote(node):
+  return node.type == TreeType.PushQuote
+
+# `{...} map` and `{...} filter` whose quote is plain arithmetic run as one
+# list comprehension instead of calling the quote for every element.
+def list_expr(quote, type):
+  found = element_expr(quote, element_exprs)
+  if found is None:
+    return None
+  expr, _ = found
+  if type == TreeType.Map:
+    source = f"lambda items: from_items([{expr} for x in items])"
+  else:
+    source = f"lambda items: from_items([x for x in items if {expr}])"
+  return eval(source, {"from_items": from_items, "int_div": int_div})
+
+def lower_expr(code, nodes):
+  i = 0
+  while i < len(nodes):
+    node = nodes[i]
+    rest = nodes[i+1:i+3]
+    if len(rest) == 2 and is_quote(node) and is_quote(rest[0]) and rest[1].type == TreeType.If:
+      at = emit(code, JUMP_IF_FALSE, None, rest[1].location)
+      lower_node(code, node.nodes[0])
+      skip = emit(code, JUMP, None, rest[1].location)
+      patch(code, at)
+      lower_node(code, rest[0].nodes[0])
+      patch(code, skip)
+      i += 3
+      continue
+    if len(rest) == 2 and is_quote(node) and is_quote(rest[0]) and rest[1].type == TreeType.While:
+      start = len(code.ops)
+      lower_node(code, node.nodes[0])
+      at = emit(code, JUMP_IF_FALSE, None, rest[1].location)
+      lower_node(code, rest[0].nodes[0])
+      emit(code, JUMP, start, rest[1].location)
+      patch(code, at)
+      i += 3
+      continue
+    if rest and is_quote(node) and rest[0].type == TreeType.Eval:
+      lower_node(code, node.nodes[0])
+      i += 2
+      continue
+    if rest and is_quote(node) and rest[0].type in [TreeType.Map, TreeType.Filter]:
+      function = list_expr(node.nodes[0], rest[0].type)
+      if function is not None:
+        emit(code, LIST_EXPR, function, rest[0].location)
+        i += 2
+        continue
+    lower_node(code, node)
+    i += 1
+
+def lower_node(code, tree):
+  loc = tree.location
+  if tree.type == TreeType.Expr:
+    lower_expr(code, tree.nodes)
+    return
+  if tree.type in [TreeType.Noop, TreeType.PrintType]:
+    return
+  if tree.type == TreeType.PushInt:
+    emit(code, PUSH, tree.nodes[0], loc)
+    return
+  if tree.type == TreeType.PushBool:
+    emit(code, PUSH, tree.nodes[0] == "True", loc)
+    return
+  if tree.type == TreeType.PushChar:
+    emit(code, PUSH, tree.nodes[0], loc)
+    return
+  if tree.type == TreeType.PushList:
+    emit(code, MARK, None, loc)
+    lower_node(code, tree.nodes[0])
+    emit(code, MAKE_LIST, None, loc)
+    return
+  if tree.type == TreeType.PushQuote:
+    code.consts.append(lower(tree.nodes[0]))
+    emit(code, PUSH_QUOTE, len(code.consts) - 1, loc)
+    return
+  if tree.type in binary_ops:
+    emit(code, binary_ops[tree.type], None, loc)
+    return
+  if tree.type in const_ops:
+    emit(code, const_ops[tree.type], tree.nodes[0], loc)
+    return
+  if tree.type in list_ops:
+    emit(code, list_ops[tree.type], None, loc)
+    return
+  if tree.type in io_ops:
+    emit(code, io_ops[tree.type], None, loc)
+    return
+  if tree.type in [TreeType.Map, TreeType.Filter, TreeType.Fold]:
+    kind = tree.type.value
+    emit(code, EACH_ENTER, kind, loc)
+    start = emit(code, EACH_NEXT, None, loc)
+    emit(code, EACH_CALL, None, loc)
+    emit(code, EACH_KEEP, kind, loc)
+    emit(code, JUMP, start, loc)
+    patch(code, start)
+    emit(code, EACH_EXIT, kind, loc)
+    return
+  if tree.type == TreeType.PMap:
+    emit(code, PMAP, None, loc)
+    return
+  if tree.type == TreeType.Dup:
+    emit(code, DUP, None, loc)
+    return
+  if tree.type == TreeType.Not:
+    emit(code, NOT, None, loc)
+    return
+  if tree.type == TreeType.Print:
+    emit(code, PRINT, None, loc)
+    return
+  if tree.type == TreeType.Eval:
+    emit(code, CALL, None, loc)
+    return
+  if tree.type == TreeType.If:
+    emit(code, IF, None, loc)
+    return
+  if tree.type == TreeType.While:
+    emit(code, LOOP_ENTER, None, loc)
+    start = emit(code, LOOP_CALL, 0, loc)
+    at = emit(code, JUMP_IF_FALSE, None, loc)
+    emit(code, LOOP_CALL, 1, loc)
+    emit(code, JUMP, start, loc)
+    patch(code, at)
+    emit(code, LOOP_EXIT, None, loc)
+    return
+  assert False, f"Not implemented: {tree.type.name}"
+
+def lower(tree: Tree) -> Code:
+  code = Code(tree=tree)
+  lower_node(code, tree)
+  emit(code, RETURN, None, tree.location)
+  return code
+
+class VM:
+  def __init__(self, code, stack=None, emit=print, streams=None):
+    self.code = code
+    self.pc = 0
+    self.stack = [] if stack is None else stack
+    self.frames = []
+    self.aux = []
+    self.emit = emit
+    self.streams = standard if streams is None else streams
+    self.steps = 0
+    self.stop = None
+    self.done = False
+
+  # Runs until the program returns or, if stop is set, until steps reaches it.
+  # A stopped VM resumes where it left off on the next call.
+  def run(self):
+    code = self.code
+    ops = code.ops
+    consts = code.consts
+    pc = self.pc
+    frames = self.frames
+    aux = self.aux
+    stack = self.stack
+    push = stack.append
+    pop = stack.pop
+    emit = self.emit
+    steps = self.steps
+    stop = -1 if self.stop is None else self.stop
+    while True:
+      if steps == stop:
+        break
+      op, arg = ops[pc]
+      pc += 1
+      steps += 1
+      if op == PUSH:
+        push(arg)
+      elif op == DUP:
+        push(stack[-1])
+      elif op == ADD:
+        b = pop()
+        stack[-1] = stack[-1] + b
+      elif op == ADD_CONST:
+        stack[-1] = stack[-1] + arg
+      elif op == DUP_LT_CONST:
+        push(stack[-1] < arg)
+      elif op == JUMP_IF_FALSE:
+        if not pop():
+          pc = arg
+      elif op == JUMP:
+        pc = arg
+      elif op == LT:
+        b = pop()
+        stack[-1] = stack[-1] < b
+      elif op == SUB:
+        b = pop()
+        stack[-1] = stack[-1] - b
+      elif op == SUB_CONST:
+        stack[-1] = stack[-1] - arg
+      elif op == MUL:
+        b = pop()
+        stack[-1] = stack[-1] * b
+      elif op == DIV:
+        b = pop()
+        a = stack[-1]
+        stack[-1] = a // b if (a < 0) == (b < 0) else -(-a // b)
+      elif op == GT:
+        b = pop()
+        stack[-1] = stack[-1] > b
+      elif op == LTE:
+        b = pop()
+        stack[-1] = stack[-1] <= b
+      elif op == GTE:
+        b = pop()
+        stack[-1] = stack[-1] >= b
+      elif op == EQ:
+        b = pop()
+        stack[-1] = stack[-1] == b
+      elif op == NOT:
+        stack[-1] = not stack[-1]
+      elif op == PRINT:
+        emit(pop())
+      elif op == PUSH_QUOTE:
+        push(consts[arg])
+      elif op == CALL:
+        frames.append((code, pc))
+        code = pop()
+        ops = code.ops
+        consts = code.consts
+        pc = 0
+      elif op == IF:
+        c = pop()
+        b = pop()
+        frames.append((code, pc))
+        code = b if pop() else c
+        ops = code.ops
+        consts = code.consts
+        pc = 0
+      elif op == LOOP_CALL:
+        frames.append((code, pc))
+        code = aux[-1][arg]
+        ops = code.ops
+        consts = code.consts
+        pc = 0
+      elif op == LOOP_ENTER:
+        b = pop()
+        aux.append((pop(), b))
+      elif op == LOOP_EXIT:
+        aux.pop()
+      elif op == CONS:
+        b = pop()
+        stack[-1] = List(stack[-1], b)
+      elif op == MARK:
+        aux.append(len(stack))
+      elif op == MAKE_LIST:
+        start = aux.pop()
+        items = stack[start:]
+        del stack[start:]
+        push(from_items(items))
+      elif op == RETURN:
+        if not frames:
+          self.done = True
+          pc -= 1
+          break
+        code, pc = frames.pop()
+        ops = code.ops
+        consts = code.consts
+      elif op == RANGE:
+        stack[-1] = from_items(range(stack[-1]))
+      elif op == LEN:
+        stack[-1] = len(stack[-1])
+      elif op == SUM:
+        stack[-1] = sum(stack[-1])
+      elif op == LIST_EXPR:
+        stack[-1] = arg(stack[-1])
+      elif op == EACH_ENTER:
+        quote = pop()
+        if arg == "fold":
+          value = pop()
+          aux.append((quote, pop(), EMPTY))
+          push(value)
+        else:
+          aux.append((quote, pop(), EMPTY))
+      elif op == EACH_NEXT:
+        node = aux[-1][1]
+        if node.size:
+          push(node.head)
+        else:
+          pc = arg
+      elif op == EACH_CALL:
+        frames.append((code, pc))
+        code = aux[-1][0]
+        ops = code.ops
+        consts = code.consts
+        pc = 0
+      elif op == EACH_KEEP:
+        quote, node, result = aux[-1]
+        if arg == "map":
+          result = List(pop(), result)
+        elif arg == "filter" and pop():
+          result = List(node.head, result)
+        aux[-1] = (quote, node.tail, result)
+      elif op == EACH_EXIT:
+        result = aux.pop()[2]
+        if arg != "fold":
+          push(reverse(result))
+      elif op == READ_LINE:
+        push(Text(self.streams.input.read_line()))
+      elif op == READ_INT:
+        push(self.streams.input.read_int())
+      elif op == READ_CHAR:
+        push(self.streams.input.read_char())
+      elif op == EOF:
+        push(self.streams.input.eof())
+      elif op == WRITE_LINE:
+        self.streams.output.write(to_text(pop()) + "\n")
+      elif op == FLUSH:
+        self.streams.output.flush()
+      elif op == PMAP:
+        quote = pop()
+        stack[-1] = from_items(parallel_map(map_quote, stack[-1], quote.tree))
+      elif op == BREAK:
+        pc -= 1
+        steps -= 1
+        break
+    self.code = code
+    self.pc = pc
+    self.steps = steps
+    return stack
+
+# pmap's quote is sent to the workers as its tree, which they lower again,
+# because the lowered code holds compiled functions that can not be pickled.
+def map_quote(tree, items):
+  code = lower(tree)
+  results = []
+  for value in items:
+    results.append(VM(code, [value]).run()[0])
+  return results
+
+def execute(tree, stack=None, emit=print, streams=None):
+  vm = VM(lower(tree), stack, emit, streams)
+  vm.run()
+  return vm